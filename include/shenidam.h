@@ -35,6 +35,11 @@ extern "C" {
  * Audio position determiner.
  */
 typedef void* shenidam_t;
+/**
+ * Reads num_samples 1-channel samples starting at sample offset into buffer and returns the number of samples read
+ * (less than num_samples only at the end of the audio).
+ */
+typedef size_t (*shenidam_read_callback)(void* read_data,size_t offset,float* buffer,size_t num_samples);
 /**
  * The LPCM buffer formats.
  */
@@ -47,6 +52,39 @@ enum SHENIDAM_FORMAT{
 	FORMAT_SINGLE, //float
 	FORMAT_DOUBLE //double
 };
+/**
+ * The FFTW planner rigors (higher takes longer to plan and usually gives faster transforms).
+ */
+enum SHENIDAM_PLANNER_RIGOR{
+	PLANNER_ESTIMATE, //FFTW_ESTIMATE
+	PLANNER_MEASURE, //FFTW_MEASURE
+	PLANNER_PATIENT //FFTW_PATIENT
+};
+/**
+ * The transform sizes used for correlating (padded lengths of base and track).
+ */
+enum SHENIDAM_FFT_SIZES{
+	FFT_SIZES_SMOOTH, //smallest of 2^k, 5*2^k/8, 3*2^k/4 and 7*2^k/8
+	FFT_SIZES_POWER_OF_TWO //next power of two
+};
+/**
+ * The stages of matching a track, timed when timings are enabled with shenidam_set_timings.
+ */
+enum SHENIDAM_STAGES{
+	STAGE_RESAMPLING, //converting, normalizing and resampling the track to the working rate
+	STAGE_FFT, //transforming the track and correlating it with the bases
+	STAGE_REFINEMENT, //refining the in point at the base rate
+	NUM_STAGES
+};
+/**
+ * The time spent in a stage and the working buffers it held.
+ */
+typedef struct
+{
+	double wall_time; //in seconds
+	double cpu_time; //in seconds, of the calling thread only
+	size_t peak_bytes;
+} shenidam_stage_timing_t;
 enum SHENIDAM_ERROR_CODES
 {
 	SUCCESS = 0, //No error, the command returned successfully
@@ -54,6 +92,7 @@ enum SHENIDAM_ERROR_CODES
 	ALREADY_SET_BASE_SIGNAL = 2,
 	BASE_SIGNAL_NOT_SET = 3,
 	NULL_OBJECT = 4,
+	IO_ERROR = 5,
 	ALLOCATION_ERROR = 100,
 };
 /**
@@ -74,6 +113,67 @@ shenidam_t shenidam_create(double base_sample_rate,int num_threads);
  * @return SUCCESS or error code.
  */
 int shenidam_set_resampling_quality(shenidam_t res,int src_converter);
+/**
+ * Sets the FFTW planner rigor of the shenidam object (default PLANNER_ESTIMATE).
+ * Plans are created once per transform size and kept in the shenidam object.
+ * 
+ * @param shenidam_obj the shenidam object.
+ * @param rigor one of SHENIDAM_PLANNER_RIGOR.
+ * @return SUCCESS or error code.
+ */
+int shenidam_set_planner_rigor(shenidam_t shenidam_obj,int rigor);
+/**
+ * Sets the transform sizes of the shenidam object (default FFT_SIZES_SMOOTH).
+ * Smooth sizes are at most a quarter above the padded length, where the next power of two can be almost twice as long.
+ * A track may also take a larger size (up to the power of two) for which the base spectra are already cached.
+ * 
+ * @param shenidam_obj the shenidam object.
+ * @param fft_sizes one of SHENIDAM_FFT_SIZES.
+ * @return SUCCESS or error code.
+ */
+int shenidam_set_fft_sizes(shenidam_t shenidam_obj,int fft_sizes);
+/**
+ * Sets the length of the base blocks correlated with a track (default 0, a single transform of the whole base and track).
+ * With blocks, the transforms are about as long as a block plus the track, instead of the base plus the track,
+ * which bounds memory for very long bases. Blocks are processed concurrently when the library is built with OpenMP.
+ * Has no effect when the whole base and track fit in one such transform.
+ * 
+ * @param shenidam_obj the shenidam object.
+ * @param block_length the block length in seconds, or 0.
+ * @return SUCCESS or error code.
+ */
+int shenidam_set_block_size(shenidam_t shenidam_obj,double block_length);
+/**
+ * Enables or disables the timing of the matching stages (disabled by default).
+ * 
+ * @param shenidam_obj the shenidam object.
+ * @param enabled non-zero to time the stages.
+ * @return SUCCESS or error code.
+ */
+int shenidam_set_timings(shenidam_t shenidam_obj,int enabled);
+/**
+ * Gets the stage timings of the last shenidam_get_audio_range or shenidam_get_best_audio_range call made by the calling thread
+ * (all zero if timings were disabled).
+ * 
+ * @param shenidam_obj the shenidam object.
+ * @param timings an array of NUM_STAGES timings, indexed by SHENIDAM_STAGES.
+ * @return SUCCESS or error code.
+ */
+int shenidam_get_timings(shenidam_t shenidam_obj,shenidam_stage_timing_t* timings);
+/**
+ * Loads FFTW wisdom (accumulated plans) from a file. Should be called before processing.
+ * 
+ * @param filename the wisdom file.
+ * @return SUCCESS or error code.
+ */
+int shenidam_import_wisdom(const char* filename);
+/**
+ * Saves the FFTW wisdom accumulated by this process to a file (replacing it atomically).
+ * 
+ * @param filename the wisdom file.
+ * @return SUCCESS or error code.
+ */
+int shenidam_export_wisdom(const char* filename);
 /**
  * Sets the 1-channel "base" audio track (with a certain format, sample (LPCM) buffer, number of samples and sample rate), on which positions will be calculated.
  * 
@@ -85,9 +185,43 @@ int shenidam_set_resampling_quality(shenidam_t res,int src_converter);
  * @return SUCCESS or error code.
  */
 int shenidam_set_base_audio(shenidam_t shenidam_obj,int format, void* samples,size_t num_samples,double sample_rate);
+/**
+ * Adds a 1-channel base audio track to the set of bases tracks are matched against with shenidam_get_best_audio_range.
+ * The first base added is the one used by shenidam_get_audio_range (as if set by shenidam_set_base_audio).
+ * All the bases should be added before matching any track.
+ * 
+ * @param shenidam_obj the shenidam object.
+ * @param format the (raw) format the samples are in.
+ * @param samples the base samples in the specified format.
+ * @param num_samples the number of samples.
+ * @param sample_rate the base sample rate.
+ * @param base_index if not NULL, receives the index of the new base (0 for the first).
+ * @return SUCCESS or error code.
+ */
+int shenidam_add_base_audio(shenidam_t shenidam_obj,int format, void* samples,size_t num_samples,double sample_rate,int* base_index);
+/**
+ * Adds a 1-channel base audio track read through a callback, as shenidam_add_base_audio, without keeping the base in memory.
+ * The samples are read once in order and resampled to the working sample rate as they come, only the working rate signal is kept.
+ * Afterwards, the callback is called again (never concurrently) for the few seconds of full rate samples needed to refine each track's position,
+ * so read_data must stay valid until the shenidam object is destroyed.
+ * 
+ * @param shenidam_obj the shenidam object.
+ * @param read the callback reading the base samples.
+ * @param read_data passed to the callback.
+ * @param num_samples the number of samples (reading stops earlier if the callback returns less than asked).
+ * @param sample_rate the base sample rate.
+ * @param base_index if not NULL, receives the index of the new base (0 for the first).
+ * @return SUCCESS or error code.
+ */
+int shenidam_add_base_audio_callback(shenidam_t shenidam_obj,shenidam_read_callback read,void* read_data,size_t num_samples,double sample_rate,int* base_index);
 
 /**
  * Sets the 1-channel "track" (with a certain format, sample (LPCM) buffer, number of samples and sample rate) of which we calculate the start position (in_point) and actual duration in n terms of samples (length).
+ * The spectrum of the base is computed once per transform size and kept in the shenidam object for subsequent tracks,
+ * for the two most recently used sizes of each base.
+ * The working buffers are kept as well (one set per concurrent caller, grown to the largest track seen), so that tracks of
+ * similar lengths are matched without allocating; they are freed by shenidam_destroy.
+ * Once the base is set, this function may be called concurrently from several threads on the same shenidam object.
  * 
  * @param shenidam_obj the shenidam object.
  * @param input_format the (raw) format the samples are in.
@@ -99,6 +233,48 @@ int shenidam_set_base_audio(shenidam_t shenidam_obj,int format, void* samples,si
  * @return SUCCESS, or error code.
  */
 int shenidam_get_audio_range(shenidam_t shenidam_obj,int input_format,void* samples,size_t num_samples,double sample_rate,intmax_t* in_point,size_t* length);
+/**
+ * Like shenidam_get_audio_range, against every base added with shenidam_add_base_audio: finds the base the track matches best and the track's position in it.
+ * The track spectrum is computed once, at a transform size shared by all the bases.
+ * Bases are compared by their correlation peak divided by the norm of the overlapping part of the base.
+ * 
+ * @param shenidam_obj the shenidam object.
+ * @param input_format the (raw) format the samples are in.
+ * @param samples the track samples in the specified format.
+ * @param num_samples the number of samples.
+ * @param sample_rate the track sample rate.
+ * @param base_index the index of the best matching base.
+ * @param in_point the sample index of that base in which the audio starts (can be negative).
+ * @param length the length of the matching portion of that base.
+ * @return SUCCESS, or error code.
+ */
+int shenidam_get_best_audio_range(shenidam_t shenidam_obj,int input_format,void* samples,size_t num_samples,double sample_rate,int* base_index,intmax_t* in_point,size_t* length);
+/**
+ * Refines an in point (in samples of the first base) found at the working sample rate, to the precision of the base sample rate.
+ * Only a window of the track (at most a few seconds, in the middle of the overlap) is compared with the base, within the error of the working rate.
+ * shenidam_get_audio_range already does this, this is for in points determined otherwise (e.g. on a proxy of the track).
+ * 
+ * @param shenidam_obj the shenidam object.
+ * @param input_format the (raw) format the samples are in.
+ * @param samples the track samples in the specified format.
+ * @param num_samples the number of samples.
+ * @param sample_rate the track sample rate.
+ * @param in_point the approximate in point, replaced by the refined one.
+ * @return SUCCESS, or error code.
+ */
+int shenidam_refine_audio_range(shenidam_t shenidam_obj,int input_format,void* samples,size_t num_samples,double sample_rate,intmax_t* in_point);
+/**
+ * Like shenidam_refine_audio_range, giving a fractional in point (the correlation peak is interpolated between samples).
+ * 
+ * @param shenidam_obj the shenidam object.
+ * @param input_format the (raw) format the samples are in.
+ * @param samples the track samples in the specified format.
+ * @param num_samples the number of samples.
+ * @param sample_rate the track sample rate.
+ * @param in_point the approximate in point, replaced by the refined one.
+ * @return SUCCESS, or error code.
+ */
+int shenidam_refine_audio_range_subsample(shenidam_t shenidam_obj,int input_format,void* samples,size_t num_samples,double sample_rate,double* in_point);
 /**
  * Destroy the audio position determiner.
  * 
@@ -22,32 +22,52 @@ from __future__ import division
 from __future__ import unicode_literals
 import threading
 import sys
+import time
+import errno
+import select
+import collections
 import re
 import uuid
 import subprocess
 import os.path
 import shutil
 import tempfile
-import codecs
+import functools
+import hashlib
+import sqlite3
+import contextlib
+import json
+import copy
+import struct
+import array
+import ctypes
+import ctypes.util
 try:
     import Queue as squeue
 except ImportError:
     import queue as squeue
 try:
-    import cStringIO as StringIO
+    import numpy
 except ImportError:
-    import StringIO
+    numpy = None
 
 import shlex
 
+try:
+    unicode
+except NameError:
+    # Python 3
+    unicode = str
+    basestring = str
+
 _encoding = sys.getfilesystemencoding().lower() or "utf-8"
 
 def encode(string):
-    if isinstance(string,str):
+    if isinstance(string,bytes):
         try:
-            return unicode(string,_encoding)
-        except UnicodeEncodeError:
-            return unicode(string,'latin-1')
+            return string.decode(_encoding)
+        except UnicodeDecodeError:
+            return string.decode('latin-1')
     return unicode(string)
     
 def encode_if_string(string):
@@ -60,60 +80,152 @@ BASENAME_NOEXT_PATTERN = re.compile("{base}")
 DIRNAME_PATTERN = re.compile("{dir}")
 EXT_PATTERN = re.compile("{ext}")
 
+def split_command(command):
+    # shlex only handles bytes on Python 2, and text on Python 3.
+    if bytes is str:
+        return shlex.split(encode(command).encode(_encoding))
+    return shlex.split(encode(command))
 def do_nothing(*args,**kwds):
     pass
 def forward(stream):
     def inner(line):
         stream.write(line)
     return inner
-class StreamReader(threading.Thread):
-    def __init__(self,callbacks,stream,queue):
-        self.callbacks = callbacks
-        self.stream = stream
-        self.queue = queue
-        super(StreamReader,self).__init__()
-    def run(self):
-        try:
-            line = encode(self.stream.readline());
-            while line:
-                for callback in self.callbacks:
-                    callback(line)
-                line = encode(self.stream.readline());
-        except BaseException as e:
-            self.queue.put(e)
-            
+class RingBuffer(object):
+    # Keeps the last max_size bytes written to it.
+    def __init__(self,max_size):
+        self.max_size = max_size
+        self.chunks = collections.deque()
+        self.size = 0
+    def write(self,data):
+        self.chunks.append(data)
+        self.size += len(data)
+        while self.size > self.max_size:
+            excess = self.size - self.max_size
+            if len(self.chunks[0]) <= excess:
+                self.size -= len(self.chunks.popleft())
+            else:
+                self.chunks[0] = self.chunks[0][excess:]
+                self.size -= excess
+    def getvalue(self):
+        return b"".join(self.chunks)
+class OutputCapture(object):
+    # Keeps the last max_size bytes of a stream, and calls callback with each of its lines (or with max_size bytes of
+    # a longer line).
+    def __init__(self,callback,max_size):
+        self.callback = callback
+        self.max_size = max_size
+        self.buffer = RingBuffer(max_size)
+        self.partial = b""
+    def write(self,data):
+        self.buffer.write(data)
+        lines = (self.partial+data).split(b"\n")
+        self.partial = lines.pop()
+        for line in lines:
+            self.callback(encode(line+b"\n"))
+        if len(self.partial) > self.max_size:
+            self.callback(encode(self.partial))
+            self.partial = b""
+    def close(self):
+        if self.partial:
+            self.callback(encode(self.partial))
+            self.partial = b""
+    def getvalue(self):
+        return self.buffer.getvalue()
+class CancelListeners(object):
+    # Callbacks called (in the canceling thread) on cancel, or as soon as they are added once canceled.
+    def __init__(self):
+        self.canceled = False
+        self.listeners = []
+        self.listeners_lock = threading.Lock()
+    def add_cancel_listener(self,callback):
+        with self.listeners_lock:
+            self.listeners.append(callback)
+            canceled = self.canceled
+        if canceled:
+            callback()
+    def remove_cancel_listener(self,callback):
+        with self.listeners_lock:
+            self.listeners.remove(callback)
+    def notify_cancel(self):
+        with self.listeners_lock:
+            self.canceled = True
+            listeners = list(self.listeners)
+        for callback in listeners:
+            callback()
+
 class ProcessRunner(object):
-    def __init__(self,command,stdout_callback=do_nothing,stderr_callback=do_nothing,periodic_notifier=do_nothing):
+    # Runs the command, calling the callbacks with each line of its output as it comes, and keeping the last max_capture
+    # bytes of each stream. The streams, the exit of the command and cancel() are waited on together (cancel() may be
+    # called from any thread, and is called when any of cancelables is canceled). periodic_notifier is called every
+    # notify_interval seconds meanwhile.
+    def __init__(self,command,stdout_callback=do_nothing,stderr_callback=do_nothing,periodic_notifier=do_nothing,cancelables=(),max_capture=1<<20,notify_interval=0.5):
         self.command = command
         self.stdout_callback = stdout_callback
         self.stderr_callback = stderr_callback
         self.periodic_notifier = periodic_notifier
+        self.cancelables = cancelables
+        self.max_capture = max_capture
+        self.notify_interval = notify_interval
+        self.wake_fd = None
+        self.wake_lock = threading.Lock()
+        self.canceled = False
+    def cancel(self):
+        with self.wake_lock:
+            self.canceled = True
+            if self.wake_fd is not None:
+                os.write(self.wake_fd,b"\0")
     def __call__(self):
-        stdout_sio = codecs.getwriter(_encoding)(StringIO.StringIO())
-        stderr_sio = codecs.getwriter(_encoding)(StringIO.StringIO())
-        process = None
-        exception_queue = squeue.Queue()
         print(repr(self.command))
-        process = subprocess.Popen(shlex.split(self.command.encode(_encoding)),bufsize=1,stdin=None,stdout=subprocess.PIPE,stderr=subprocess.PIPE,shell=False)
+        wake_read,self.wake_fd = os.pipe()
+        process = None
         try:
-            stdout_reader = StreamReader([forward(stdout_sio),self.stdout_callback],process.stdout,exception_queue)
-            stderr_reader = StreamReader([forward(stderr_sio),self.stderr_callback],process.stderr,exception_queue)
-            stdout_reader.start();
-            stderr_reader.start();
-            while process.poll() is None:
+            for x in self.cancelables:
+                x.add_cancel_listener(self.cancel)
+            if self.canceled:
+                raise CanceledException()
+            process = subprocess.Popen(split_command(self.command),bufsize=0,stdin=None,stdout=subprocess.PIPE,stderr=subprocess.PIPE,shell=False)
+            captures = [OutputCapture(self.stdout_callback,self.max_capture),OutputCapture(self.stderr_callback,self.max_capture)]
+            streams = {process.stdout.fileno():captures[0],process.stderr.fileno():captures[1]}
+            next_notification = time.time()+self.notify_interval
+            while streams:
                 try:
-                    exception = exception_queue.get(timeout=0.1)
-                    print(repr(exception))
-                except squeue.Empty:
-                    pass
-                else:
-                    raise exception
-                self.periodic_notifier()
+                    readable = select.select(list(streams)+[wake_read],[],[],max(0,next_notification-time.time()))[0]
+                except select.error as e:
+                    if e.args[0] == errno.EINTR:
+                        continue
+                    raise
+                if wake_read in readable:
+                    raise CanceledException()
+                for fd in readable:
+                    data = os.read(fd,65536)
+                    if not data:
+                        streams.pop(fd).close()
+                        continue
+                    streams[fd].write(data)
+                if time.time() >= next_notification:
+                    self.periodic_notifier()
+                    next_notification = time.time()+self.notify_interval
+            process.wait()
         except:
-            process.terminate();
+            if process is not None and process.poll() is None:
+                process.terminate()
+                process.wait()
             raise
-        return process.returncode,stdout_sio.getvalue(),stderr_sio.getvalue()
+        finally:
+            for x in self.cancelables:
+                x.remove_cancel_listener(self.cancel)
+            with self.wake_lock:
+                os.close(self.wake_fd)
+                self.wake_fd = None
+            os.close(wake_read)
+            if process is not None:
+                process.stdout.close()
+                process.stderr.close()
+        return process.returncode,captures[0].getvalue(),captures[1].getvalue()
 
+TIMING_STAGES = ("decode","resampling","fft","refinement","writing")
+_timing_fields = {"wall_time":float,"cpu_time":float,"peak_bytes":int}
 def _parse_event(line):
     res = {}
     for x in line.split(";"):
@@ -125,13 +237,26 @@ def _parse_event(line):
             res[x[0].strip()]=None
         else:
             res[x[0].strip()]=x[1].strip()
+    if res.get("MESSAGE")=="stage-timing":
+        for key,convert in _timing_fields.items():
+            if res.get(key) is not None:
+                res[key] = convert(res[key])
+    return res
+def performance_totals(performance):
+    # One entry per stage, in TIMING_STAGES order: the times summed over the tracks and the largest peak.
+    res = []
+    for stage in TIMING_STAGES:
+        timings = [x for x in performance if x["stage"]==stage]
+        if timings:
+            res.append({"stage":stage,"tracks":len(timings),"wall_time":sum(x["wall_time"] for x in timings),
+                "cpu_time":sum(x["cpu_time"] for x in timings),"peak_bytes":max(x["peak_bytes"] for x in timings)})
     return res
 def message_handler_print(stream):
     def inner(line,event):
         stream.write(line)
     return inner
 class Shenidam(object):
-    def __init__(self,executable,extra_args="",message_callback=do_nothing,error_callback=forward(sys.stderr),periodic_notifier=do_nothing):
+    def __init__(self,executable,extra_args="",message_callback=do_nothing,error_callback=forward(sys.stderr),periodic_notifier=do_nothing,cancelables=()):
         def mycallback(line):
             if line.startswith("MESSAGE:"):
                 return message_callback(line,_parse_event(line))
@@ -140,28 +265,446 @@ class Shenidam(object):
         self.extra_args = extra_args
         self.error_callback = error_callback
         self.periodic_notifier = periodic_notifier
-    def __call__(self,base,input_tracks,output_tracks):
+        self.cancelables = cancelables
+    def command(self,base,input_tracks,output_tracks,alternative_bases=()):
         if len(input_tracks) <= 0:
             raise ValueError("No input tracks")
         if len(output_tracks) > 0 and len(input_tracks) != len(output_tracks):
             raise ValueError("Invalid number of input tracks")
-        args= u"-i "
+        args = u""
+        for x in alternative_bases:
+            args+= "-ab \"{0}\" ".format(encode(x))
+        args+= u"-i "
         for x in input_tracks:
             args+= "\"{0}\" ".format(encode(x))
         if len(output_tracks)>0:
             args+= "-o "
             for x in output_tracks:
                 args+= "\"{0}\" ".format(encode(x))
-        cmd = "\"{executable}\" -m {extra_args} -n {numargs} -b \"{base}\" {args}".format(executable=self.executable,base=base,numargs=len(input_tracks),args=args,extra_args=encode(self.extra_args))
-        res,stdout,stderr = ProcessRunner(cmd,self.output_callback,self.error_callback,self.periodic_notifier)()
+        return "\"{executable}\" -m {extra_args} -n {numargs} -b \"{base}\" {args}".format(executable=self.executable,base=base,numargs=len(input_tracks),args=args,extra_args=encode(self.extra_args))
+    def __call__(self,base,input_tracks,output_tracks,alternative_bases=()):
+        cmd = self.command(base,input_tracks,output_tracks,alternative_bases)
+        res,stdout,stderr = ProcessRunner(cmd,self.output_callback,self.error_callback,self.periodic_notifier,self.cancelables)()
         return cmd,res,stdout,stderr
-    def can_open(self,filename):
-        cmd = "\"{executable}\" -b \"{filename}\" -c".format(executable=encode(self.executable),filename=encode(filename))
-        return not subprocess.call(shlex.split(cmd.encode(_encoding)),stdin=None,stdout=None,stderr=None,shell=False)
+    def probe_command(self,filenames):
+        return "\"{executable}\" -m -c -n {num} -i {files}".format(executable=encode(self.executable),num=len(filenames),files=" ".join("\"{0}\"".format(encode(x)) for x in filenames))
+    def probe(self,filenames):
+        # Whether each file can be opened, through a single run. See probe_results.
+        process = subprocess.Popen(split_command(self.probe_command(filenames)),stdin=None,stdout=subprocess.PIPE,stderr=subprocess.PIPE,shell=False)
+        stdout,stderr = process.communicate()
+        return probe_results(encode(stdout).splitlines(),len(filenames))
+def probe_results(lines,num_files):
+    # The files are answered in order, one message each. Those left unanswered by a run that crashed or was killed are
+    # None: not probed, rather than not openable.
+    events = [_parse_event(x) for x in lines if x.startswith("MESSAGE:")]
+    res = [x["MESSAGE"]=="can-open-file" for x in events[:num_files]]
+    return res+[None for i in range(num_files-len(res))]
+class ShenidamServer(object):
+    # A shenidam executable in server mode (-S), answering one JSON line per request. Keeping one around keeps its base loaded.
+    def __init__(self,executable,extra_args=""):
+        self.command = "\"{executable}\" -S {extra_args}".format(executable=encode(executable),extra_args=encode(extra_args))
+        self.stderr = tempfile.TemporaryFile()
+        self.process = subprocess.Popen(split_command(self.command),stdin=subprocess.PIPE,stdout=subprocess.PIPE,stderr=self.stderr,shell=False)
+        self.lock = threading.Lock()
+        self.base = None
+        self.base_info = None
+        self.base_file = None
+        self.base_copy = None
+    def request(self,request):
+        with self.lock:
+            try:
+                self.process.stdin.write((json.dumps(request)+"\n").encode("utf-8"))
+                self.process.stdin.flush()
+                response = self.process.stdout.readline()
+            except (IOError,OSError):
+                response = None
+            if not response:
+                self.stderr.seek(0)
+                raise SubprocessError("Command '{cmd}' failed, error stream was:\n{error}".format(cmd=self.command,error=encode(self.stderr.read())))
+        response = json.loads(response.decode("utf-8"))
+        if response["status"] != "ok":
+            raise ShenidamError("{0} '{1}': {2}".format(request["command"],request.get("file",""),response["error"]))
+        return response
+    def load_base(self,base_fn,key=None,temporary=False):
+        # key identifies the content of the base, by default its path and mtime. The server reads the slices it writes from
+        # the base file, so a temporary base_fn is linked to a file of its own, kept until another base is loaded.
+        if key is None:
+            key = (encode(base_fn),os.path.getmtime(base_fn))
+        if key != self.base:
+            self.release_base()
+            if temporary:
+                self.base_copy = os.path.join(os.path.dirname(base_fn),"shenidam-av-tmp-"+uuid.uuid4().hex)
+                _link_or_copy(base_fn,self.base_copy)
+                base_fn = self.base_copy
+            self.base_info = self.request({"command":"load-base","file":encode(base_fn)})
+            self.base = key
+            self.base_file = base_fn
+        return self.base_info
+    def loaded_file(self,key):
+        # The file the base identified by key was loaded from, if it is the loaded one.
+        return self.base_file if self.base is not None and key == self.base else None
+    def release_base(self):
+        self.base = None
+        self.base_info = None
+        self.base_file = None
+        if self.base_copy is not None:
+            delete_filenames([self.base_copy])
+            self.base_copy = None
+    def map(self,track_fn,output_fn=None):
+        request = {"command":"map","file":encode(track_fn)}
+        if output_fn:
+            request["output"] = encode(output_fn)
+        response = self.request(request)
+        return response["determined_in"],response["determined_length"]
+    def write_slice(self,output_fn,in_point,length):
+        self.request({"command":"write-slice","file":encode(output_fn),"in":in_point,"length":length})
+    def close(self):
+        if self.process.poll() is None:
+            try:
+                self.request({"command":"quit"})
+            except (SubprocessError,ShenidamError):
+                self.process.terminate()
+            self.process.wait()
+        self.release_base()
+        self.stderr.close()
+    def __enter__(self):
+        return self
+    def __exit__(self,type,value,traceback):
+        self.close()
+        return False
+
+FORMAT_BYTE,FORMAT_SHORT,FORMAT_INT,FORMAT_LONG,FORMAT_LONG_LONG,FORMAT_SINGLE,FORMAT_DOUBLE = range(7)
+_FORMAT_SIZES = {FORMAT_BYTE:ctypes.sizeof(ctypes.c_byte),FORMAT_SHORT:ctypes.sizeof(ctypes.c_short),FORMAT_INT:ctypes.sizeof(ctypes.c_int),
+    FORMAT_LONG:ctypes.sizeof(ctypes.c_long),FORMAT_LONG_LONG:ctypes.sizeof(ctypes.c_longlong),FORMAT_SINGLE:ctypes.sizeof(ctypes.c_float),
+    FORMAT_DOUBLE:ctypes.sizeof(ctypes.c_double)}
+_ARRAY_FORMATS = {"b":FORMAT_BYTE,"h":FORMAT_SHORT,"i":FORMAT_INT,"l":FORMAT_LONG,"q":FORMAT_LONG_LONG,"f":FORMAT_SINGLE,"d":FORMAT_DOUBLE}
+_NUMPY_FORMATS = {"int8":FORMAT_BYTE,"int16":FORMAT_SHORT,"int32":FORMAT_INT,"int64":FORMAT_LONG_LONG,"float32":FORMAT_SINGLE,"float64":FORMAT_DOUBLE}
+# shenidam -rq levels (0-4) to libsamplerate converters, as in shenidam_main.cpp
+_SRC_CONVERTERS = [3,4,2,1,0]
+_libraries = {}
+
+class ShenidamError(Exception):
+    pass
+
+def load_library(path=None):
+    if path is None:
+        path = ctypes.util.find_library("shenidam") or "libshenidam.so"
+    if path in _libraries:
+        return _libraries[path]
+    lib = ctypes.CDLL(path)
+    lib.shenidam_create.restype = ctypes.c_void_p
+    lib.shenidam_create.argtypes = [ctypes.c_double,ctypes.c_int]
+    lib.shenidam_set_resampling_quality.restype = ctypes.c_int
+    lib.shenidam_set_resampling_quality.argtypes = [ctypes.c_void_p,ctypes.c_int]
+    lib.shenidam_set_base_audio.restype = ctypes.c_int
+    lib.shenidam_set_base_audio.argtypes = [ctypes.c_void_p,ctypes.c_int,ctypes.c_void_p,ctypes.c_size_t,ctypes.c_double]
+    lib.shenidam_get_audio_range.restype = ctypes.c_int
+    lib.shenidam_get_audio_range.argtypes = [ctypes.c_void_p,ctypes.c_int,ctypes.c_void_p,ctypes.c_size_t,ctypes.c_double,ctypes.POINTER(ctypes.c_int64),ctypes.POINTER(ctypes.c_size_t)]
+    lib.shenidam_refine_audio_range_subsample.restype = ctypes.c_int
+    lib.shenidam_refine_audio_range_subsample.argtypes = [ctypes.c_void_p,ctypes.c_int,ctypes.c_void_p,ctypes.c_size_t,ctypes.c_double,ctypes.POINTER(ctypes.c_double)]
+    lib.shenidam_add_base_audio_callback.restype = ctypes.c_int
+    lib.shenidam_add_base_audio_callback.argtypes = [ctypes.c_void_p,_READ_CALLBACK,ctypes.c_void_p,ctypes.c_size_t,ctypes.c_double,ctypes.POINTER(ctypes.c_int)]
+    lib.shenidam_add_base_audio.restype = ctypes.c_int
+    lib.shenidam_add_base_audio.argtypes = [ctypes.c_void_p,ctypes.c_int,ctypes.c_void_p,ctypes.c_size_t,ctypes.c_double,ctypes.POINTER(ctypes.c_int)]
+    lib.shenidam_get_best_audio_range.restype = ctypes.c_int
+    lib.shenidam_get_best_audio_range.argtypes = [ctypes.c_void_p,ctypes.c_int,ctypes.c_void_p,ctypes.c_size_t,ctypes.c_double,ctypes.POINTER(ctypes.c_int),ctypes.POINTER(ctypes.c_int64),ctypes.POINTER(ctypes.c_size_t)]
+    lib.shenidam_set_planner_rigor.restype = ctypes.c_int
+    lib.shenidam_set_planner_rigor.argtypes = [ctypes.c_void_p,ctypes.c_int]
+    lib.shenidam_set_block_size.restype = ctypes.c_int
+    lib.shenidam_set_block_size.argtypes = [ctypes.c_void_p,ctypes.c_double]
+    lib.shenidam_set_timings.restype = ctypes.c_int
+    lib.shenidam_set_timings.argtypes = [ctypes.c_void_p,ctypes.c_int]
+    lib.shenidam_get_timings.restype = ctypes.c_int
+    lib.shenidam_get_timings.argtypes = [ctypes.c_void_p,ctypes.POINTER(_StageTiming)]
+    lib.shenidam_import_wisdom.restype = ctypes.c_int
+    lib.shenidam_import_wisdom.argtypes = [ctypes.c_char_p]
+    lib.shenidam_export_wisdom.restype = ctypes.c_int
+    lib.shenidam_export_wisdom.argtypes = [ctypes.c_char_p]
+    lib.shenidam_destroy.restype = ctypes.c_int
+    lib.shenidam_destroy.argtypes = [ctypes.c_void_p]
+    lib.shenidam_get_error_message.restype = ctypes.c_char_p
+    lib.shenidam_get_error_message.argtypes = [ctypes.c_int]
+    _libraries[path] = lib
+    return lib
+
+class _StageTiming(ctypes.Structure):
+    _fields_ = [("wall_time",ctypes.c_double),("cpu_time",ctypes.c_double),("peak_bytes",ctypes.c_size_t)]
+# The stages timed by the library, in SHENIDAM_STAGES order.
+_LIBRARY_STAGES = ("resampling","fft","refinement")
+_READ_CALLBACK = ctypes.CFUNCTYPE(ctypes.c_size_t,ctypes.c_void_p,ctypes.c_size_t,ctypes.POINTER(ctypes.c_float),ctypes.c_size_t)
+def _samples_pointer(samples,format=None):
+    # Returns (pointer, number of samples, format, object to keep alive), without copying the samples whenever the buffer allows it.
+    if hasattr(samples,"dtype") and hasattr(samples,"ctypes"):
+        if not samples.flags["C_CONTIGUOUS"]:
+            raise ValueError("Sample array must be contiguous")
+        if format is None:
+            if samples.dtype.name not in _NUMPY_FORMATS:
+                raise ValueError("Unsupported sample type '{0}'".format(samples.dtype.name))
+            format = _NUMPY_FORMATS[samples.dtype.name]
+        return ctypes.c_void_p(samples.ctypes.data),samples.size,format,samples
+    if isinstance(samples,array.array):
+        if format is None:
+            if samples.typecode not in _ARRAY_FORMATS:
+                raise ValueError("Unsupported sample type '{0}'".format(samples.typecode))
+            format = _ARRAY_FORMATS[samples.typecode]
+        address,length = samples.buffer_info()
+        return ctypes.c_void_p(address),length,format,samples
+    if format is None:
+        format = FORMAT_SINGLE
+    num_bytes = len(samples)
+    try:
+        holder = (ctypes.c_char*num_bytes).from_buffer(samples)
+    except TypeError:
+        # read-only buffers (str/bytes) cannot be shared with ctypes.
+        holder = ctypes.create_string_buffer(bytes(samples),num_bytes)
+    return ctypes.cast(holder,ctypes.c_void_p),num_bytes//_FORMAT_SIZES[format],format,holder
+
+class ShenidamMatcher(object):
+    def __init__(self,sample_rate=1000,num_threads=1,resampling_quality=2,library=None,planner_rigor=0,wisdom_file=None,block_size=0):
+        self.lib = load_library(library)
+        self.wisdom_file = encode(wisdom_file).encode(_encoding) if wisdom_file else None
+        if self.wisdom_file:
+            self.lib.shenidam_import_wisdom(self.wisdom_file)
+        self.handle = self.lib.shenidam_create(sample_rate,num_threads)
+        self.base_readers = []
+        if not self.handle:
+            raise ShenidamError("Could not create shenidam object")
+        self.check(self.lib.shenidam_set_resampling_quality(self.handle,_SRC_CONVERTERS[resampling_quality]))
+        self.check(self.lib.shenidam_set_planner_rigor(self.handle,planner_rigor))
+        self.check(self.lib.shenidam_set_block_size(self.handle,block_size))
+    def check(self,error):
+        if error:
+            raise ShenidamError(encode(self.lib.shenidam_get_error_message(error)))
+    def set_base_audio(self,samples,sample_rate,format=None):
+        pointer,num_samples,format,holder = _samples_pointer(samples,format)
+        self.check(self.lib.shenidam_set_base_audio(self.handle,format,pointer,num_samples,sample_rate))
+    def get_audio_range(self,samples,sample_rate,format=None):
+        pointer,num_samples,format,holder = _samples_pointer(samples,format)
+        in_point = ctypes.c_int64()
+        length = ctypes.c_size_t()
+        self.check(self.lib.shenidam_get_audio_range(self.handle,format,pointer,num_samples,sample_rate,ctypes.byref(in_point),ctypes.byref(length)))
+        return in_point.value,length.value
+    def refine_audio_range(self,samples,sample_rate,in_point,format=None):
+        pointer,num_samples,format,holder = _samples_pointer(samples,format)
+        in_point = ctypes.c_double(in_point)
+        self.check(self.lib.shenidam_refine_audio_range_subsample(self.handle,format,pointer,num_samples,sample_rate,ctypes.byref(in_point)))
+        return in_point.value
+    def add_base_audio(self,samples,sample_rate,format=None):
+        pointer,num_samples,format,holder = _samples_pointer(samples,format)
+        base_index = ctypes.c_int()
+        self.check(self.lib.shenidam_add_base_audio(self.handle,format,pointer,num_samples,sample_rate,ctypes.byref(base_index)))
+        return base_index.value
+    def add_base_wav(self,filename):
+        # The file (mono 32-bit float WAV) is read by the library as needed and stays open until the matcher is closed.
+        f = open(filename,"rb")
+        try:
+            info = read_wav_header(f)
+            if info.format_tag != 3 or info.channels != 1 or info.bits_per_sample != 32:
+                raise WavFormatError("Not a mono 32-bit float WAV file")
+        except:
+            f.close()
+            raise
+        def read(read_data,offset,buffer,num_samples):
+            f.seek(info.data_offset+offset*4)
+            data = f.read(num_samples*4)
+            ctypes.memmove(buffer,data,len(data))
+            return len(data)//4
+        callback = _READ_CALLBACK(read)
+        self.base_readers.append((f,callback))
+        base_index = ctypes.c_int()
+        self.check(self.lib.shenidam_add_base_audio_callback(self.handle,callback,None,info.num_frames,info.sample_rate,ctypes.byref(base_index)))
+        return base_index.value
+    def get_best_audio_range(self,samples,sample_rate,format=None):
+        pointer,num_samples,format,holder = _samples_pointer(samples,format)
+        base_index = ctypes.c_int()
+        in_point = ctypes.c_int64()
+        length = ctypes.c_size_t()
+        self.check(self.lib.shenidam_get_best_audio_range(self.handle,format,pointer,num_samples,sample_rate,ctypes.byref(base_index),ctypes.byref(in_point),ctypes.byref(length)))
+        return base_index.value,in_point.value,length.value
+    def set_timings(self,enabled):
+        self.check(self.lib.shenidam_set_timings(self.handle,int(bool(enabled))))
+    def get_timings(self):
+        # The stage timings of the last get_audio_range or get_best_audio_range call of this thread.
+        timings = (_StageTiming*len(_LIBRARY_STAGES))()
+        self.check(self.lib.shenidam_get_timings(self.handle,timings))
+        return dict((stage,{"wall_time":x.wall_time,"cpu_time":x.cpu_time,"peak_bytes":x.peak_bytes}) for stage,x in zip(_LIBRARY_STAGES,timings))
+    def close(self):
+        if self.handle:
+            self.lib.shenidam_destroy(self.handle)
+            self.handle = None
+            if self.wisdom_file:
+                self.lib.shenidam_export_wisdom(self.wisdom_file)
+        for f,callback in self.base_readers:
+            f.close()
+        self.base_readers = []
+    def __enter__(self):
+        return self
+    def __exit__(self,type,value,traceback):
+        self.close()
+        return False
+
+def parse_shenidam_args(extra_args):
+    res = {"sample_rate":1000.0,"resampling_quality":2,"num_threads":1,"planner_rigor":0,"wisdom_file":None,"block_size":0.0}
+    args = split_command(extra_args)
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        i+=1
+        if i == len(args):
+            break
+        if arg in ("-s","--sample-rate"):
+            res["sample_rate"] = float(args[i])
+        elif arg in ("-rq","--resampling-quality"):
+            res["resampling_quality"] = int(args[i])
+        elif arg in ("-T","--num-threads"):
+            res["num_threads"] = int(args[i])
+        elif arg in ("-P","--planner-rigor"):
+            res["planner_rigor"] = int(args[i])
+        elif arg in ("-W","--wisdom-file"):
+            res["wisdom_file"] = encode(args[i])
+        elif arg in ("-B","--block-size"):
+            res["block_size"] = float(args[i])
+        else:
+            continue
+        i+=1
+    return res
+
+class WavFormatError(Exception):
+    pass
+def _read_exact(stream,size):
+    data = stream.read(size)
+    if len(data) != size:
+        raise WavFormatError("Unexpected end of WAV header")
+    return data
+class WavInfo(object):
+    def __init__(self,fmt,data_offset,data_size):
+        if len(fmt) < 16:
+            raise WavFormatError("Invalid fmt chunk")
+        self.fmt = fmt
+        self.format_tag,self.channels,self.sample_rate,self.byte_rate,self.block_align,self.bits_per_sample = struct.unpack(str("<HHIIHH"),fmt[:16])
+        if self.format_tag == 0xFFFE and len(fmt) >= 26:
+            self.format_tag = struct.unpack(str("<H"),fmt[24:26])[0]
+        if self.block_align == 0:
+            raise WavFormatError("Invalid block alignment")
+        self.data_offset = data_offset
+        self.data_size = data_size
+        self.num_frames = data_size // self.block_align
+def read_wav_header(stream):
+    riff,size,wave = struct.unpack(str("<4sI4s"),_read_exact(stream,12))
+    if riff != b"RIFF" or wave != b"WAVE":
+        raise WavFormatError("Not a WAV file")
+    offset = 12
+    fmt = None
+    while True:
+        chunk_id,chunk_size = struct.unpack(str("<4sI"),_read_exact(stream,8))
+        offset+=8
+        if chunk_id == b"data":
+            if fmt is None:
+                raise WavFormatError("Missing fmt chunk")
+            return WavInfo(fmt,offset,chunk_size)
+        chunk = _read_exact(stream,chunk_size+(chunk_size&1))
+        offset+=len(chunk)
+        if chunk_id == b"fmt ":
+            fmt = chunk[:chunk_size]
+def can_open_wav(filename):
+    try:
+        with open(filename,"rb") as f:
+            info = read_wav_header(f)
+            return info.format_tag in (1,3)
+    except (IOError,OSError,WavFormatError,struct.error):
+        return False
+def write_wav_header(stream,info,num_frames):
+    data_size = num_frames*info.block_align
+    fmt_size = len(info.fmt)
+    stream.write(struct.pack(str("<4sI4s"),b"RIFF",4+8+fmt_size+(fmt_size&1)+8+data_size,b"WAVE"))
+    stream.write(struct.pack(str("<4sI"),b"fmt ",fmt_size))
+    stream.write(info.fmt+(b"\0" if fmt_size&1 else b""))
+    stream.write(struct.pack(str("<4sI"),b"data",data_size))
+def copy_partial_wav(base_fn,out_fn,in_point,length,frames_per_block=65536):
+    with open(base_fn,"rb") as f:
+        info = read_wav_header(f)
+        with open(out_fn,"wb") as out:
+            write_wav_header(out,info,length)
+            written = 0
+            if in_point < 0:
+                written = min(-in_point,length)
+                out.write(b"\0"*(written*info.block_align))
+            start = max(in_point,0)
+            end = min(in_point+length,info.num_frames)
+            f.seek(info.data_offset+start*info.block_align)
+            for i in range(start,end,frames_per_block):
+                n = min(frames_per_block,end-i)
+                out.write(_read_exact(f,n*info.block_align))
+                written+=n
+            if written < length:
+                out.write(b"\0"*((length-written)*info.block_align))
+def read_wav(filename):
+    with open(filename,"rb") as f:
+        info = read_wav_header(f)
+        return info,bytearray(_read_exact(f,info.num_frames*info.block_align))
+def read_audio_mono(avconv,filename,periodic_notifier=do_nothing,block_size=1<<20,tee=None):
+    # Decodes filename to mono 32-bit float samples through an avconv pipe, without temporary files. The samples are also
+    # written as a WAV file to tee, a seekable file object, if given.
+    cmd = "\"{avconv}\" -v 0 -loglevel error -i \"{filename}\" -vn -ac 1 -c:a pcm_f32le -f wav -".format(avconv=encode(avconv),filename=encode(filename))
+    with tempfile.TemporaryFile() as stderr:
+        process = subprocess.Popen(split_command(cmd),stdin=None,stdout=subprocess.PIPE,stderr=stderr,shell=False)
+        try:
+            info = read_wav_header(process.stdout)
+            if tee is not None:
+                write_wav_header(tee,info,0)
+            samples = bytearray()
+            chunk = process.stdout.read(block_size)
+            while chunk:
+                samples.extend(chunk)
+                if tee is not None:
+                    tee.write(chunk)
+                periodic_notifier()
+                chunk = process.stdout.read(block_size)
+            res = process.wait()
+            if tee is not None:
+                tee.seek(0)
+                write_wav_header(tee,info,len(samples)//info.block_align)
+        except WavFormatError:
+            if process.wait() == 0:
+                raise
+            res = process.returncode
+        except:
+            process.terminate()
+            process.wait()
+            raise
+        if res != 0:
+            stderr.seek(0)
+            raise SubprocessError("Command '{cmd}' failed, error stream was:\n{error}".format(cmd=cmd,error=encode(stderr.read())))
+    del samples[len(samples)-len(samples)%4:]
+    return info,samples
+
 class SubprocessError(Exception):
     def __init__(self,error):
         super(SubprocessError,self).__init__(error)
 
+class BackgroundProcess(object):
+    def __init__(self,command):
+        self.command = command
+        self.stderr = tempfile.TemporaryFile()
+        with open(os.devnull,"w") as devnull:
+            self.process = subprocess.Popen(split_command(command),stdin=None,stdout=devnull,stderr=self.stderr,shell=False)
+    def raise_error(self):
+        self.stderr.seek(0)
+        raise SubprocessError("Command '{cmd}' failed, error stream was:\n{error}".format(cmd=self.command,error=encode(self.stderr.read())))
+    def check(self):
+        if self.process.poll() not in (None,0):
+            self.raise_error()
+    def running(self):
+        return self.process.poll() is None
+    def finish(self):
+        if self.process.wait() != 0:
+            self.raise_error()
+    def terminate(self):
+        if self.process.poll() is None:
+            self.process.terminate()
+            self.process.wait()
+        self.stderr.close()
+
 def delete_filenames(filenames,delete=True):
     if delete:
         for fn in filenames:
@@ -178,11 +721,319 @@ class TemporaryFile(object):
     def __exit__(self,type,value,traceback):
         delete_filenames(self.filenames,self.delete)
         return False
-class StreamNotifier(object):
+def default_cache_dir():
+    return os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"),"shenidam")
+class AudioCache(object):
+    # Files keyed by the identity (path, size and mtime) of the file they were made from plus the parameters used.
+    # Entries are hard-linked (or copied) in and out, each use touches them, and the least recently used go once max_size bytes is exceeded.
+    def __init__(self,directory,max_size):
+        self.directory = directory
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+    def key(self,filename,params):
+        st = os.stat(filename)
+        identity = "{0}\0{1}\0{2!r}\0{3}".format(encode(os.path.abspath(filename)),st.st_size,st.st_mtime,encode(params))
+        return hashlib.sha1(identity.encode("utf-8")).hexdigest()
+    def fetch(self,key,filename):
+        path = os.path.join(self.directory,key)
+        try:
+            os.utime(path,None)
+            _link_or_copy(path,filename)
+        except (OSError,IOError):
+            return False
+        return True
+    def store(self,key,filename):
+        tmp = os.path.join(self.directory,".tmp-"+uuid.uuid4().hex)
+        try:
+            _link_or_copy(filename,tmp)
+            os.rename(tmp,os.path.join(self.directory,key))
+        except (OSError,IOError):
+            delete_filenames([tmp])
+            return
+        self.evict()
+    def evict(self):
+        with self.lock:
+            entries = []
+            for name in os.listdir(self.directory):
+                if name.startswith("."):
+                    continue
+                try:
+                    st = os.stat(os.path.join(self.directory,name))
+                except OSError:
+                    continue
+                entries.append((st.st_mtime,st.st_size,name))
+            entries.sort()
+            total = sum(x[1] for x in entries)
+            for mtime,size,name in entries:
+                if total <= self.max_size:
+                    break
+                delete_filenames([os.path.join(self.directory,name)])
+                total -= size
+def file_fingerprint(filename,sample_size=1<<20):
+    # The size and a hash of the first and last sample_size bytes: cheap on large media files, and unchanged by renames and copies.
+    size = os.path.getsize(filename)
+    h = hashlib.sha1(str(size).encode("ascii"))
+    with open(filename,"rb") as f:
+        h.update(f.read(sample_size))
+        if size > sample_size:
+            f.seek(max(size-sample_size,sample_size))
+            h.update(f.read(sample_size))
+    return h.hexdigest()
+class MappingStore(object):
+    # Positions found by earlier runs, by (base fingerprint, track fingerprint, sample rate, resampling quality).
+    def __init__(self,filename):
+        self.filename = filename
+        with contextlib.closing(sqlite3.connect(self.filename)) as db:
+            with db:
+                db.execute("CREATE TABLE IF NOT EXISTS mappings (base TEXT, track TEXT, sample_rate REAL, resampling_quality INTEGER, determined_in REAL, determined_length REAL, PRIMARY KEY (base,track,sample_rate,resampling_quality))")
+                try:
+                    db.execute("ALTER TABLE mappings ADD COLUMN base_index INTEGER DEFAULT 0")
+                except sqlite3.OperationalError:
+                    pass
+    def get(self,base,track,sample_rate,resampling_quality):
+        # base identifies the whole set of bases when there are several, base_index then tells which one the track is in.
+        with contextlib.closing(sqlite3.connect(self.filename)) as db:
+            row = db.execute("SELECT determined_in,determined_length,base_index FROM mappings WHERE base=? AND track=? AND sample_rate=? AND resampling_quality=?",(base,track,sample_rate,resampling_quality)).fetchone()
+        if row is None:
+            return None
+        return {"determined_in":row[0],"determined_length":row[1],"base_index":row[2]}
+    def put(self,base,track,sample_rate,resampling_quality,determined_in,determined_length,base_index=0):
+        with contextlib.closing(sqlite3.connect(self.filename)) as db:
+            with db:
+                db.execute("INSERT OR REPLACE INTO mappings (base,track,sample_rate,resampling_quality,determined_in,determined_length,base_index) VALUES (?,?,?,?,?,?,?)",(base,track,sample_rate,resampling_quality,determined_in,determined_length,base_index))
+class ProbeCache(object):
+    # Results of checking files with a tool, by tool and by the path, size and mtime of each file.
+    def __init__(self,filename):
+        self.filename = filename
+        directory = os.path.dirname(filename)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with contextlib.closing(sqlite3.connect(self.filename)) as db:
+            with db:
+                db.execute("CREATE TABLE IF NOT EXISTS probes (tool TEXT, path TEXT, size INTEGER, mtime REAL, result INTEGER, PRIMARY KEY (tool,path))")
+    def identity(self,filename):
+        st = os.stat(filename)
+        return encode(os.path.abspath(filename)),st.st_size,st.st_mtime
+    def get(self,tool,filenames):
+        # The stored result of each file, None when there is none or the file changed since.
+        res = []
+        with contextlib.closing(sqlite3.connect(self.filename)) as db:
+            for x in filenames:
+                try:
+                    path,size,mtime = self.identity(x)
+                except OSError:
+                    res.append(None)
+                    continue
+                row = db.execute("SELECT result FROM probes WHERE tool=? AND path=? AND size=? AND mtime=?",(tool,path,size,mtime)).fetchone()
+                res.append(bool(row[0]) if row is not None else None)
+        return res
+    def put(self,tool,filenames,results):
+        with contextlib.closing(sqlite3.connect(self.filename)) as db:
+            with db:
+                for x,result in zip(filenames,results):
+                    if result is None:
+                        continue
+                    try:
+                        path,size,mtime = self.identity(x)
+                    except OSError:
+                        continue
+                    db.execute("INSERT OR REPLACE INTO probes (tool,path,size,mtime,result) VALUES (?,?,?,?,?)",(tool,path,size,mtime,int(result)))
+def model_probe_cache(model):
+    if not model.cache_dir:
+        return None
+    try:
+        return ProbeCache(os.path.join(model.cache_dir,"probes.sqlite"))
+    except (OSError,sqlite3.Error):
+        return None
+def find_executable(name):
+    if os.path.dirname(name):
+        return name if os.path.isfile(name) else None
+    for directory in os.environ.get("PATH","").split(os.pathsep):
+        path = os.path.join(directory,name)
+        if os.path.isfile(path) and os.access(path,os.X_OK):
+            return path
+    return None
+def tool_identity(executable):
+    # Changes with the executable found on the path and its size and mtime, so that results are checked again after an upgrade.
+    path = find_executable(encode(executable))
+    if path is None:
+        return encode(executable)
+    st = os.stat(path)
+    return "{0}\0{1}\0{2!r}".format(encode(os.path.abspath(path)),st.st_size,st.st_mtime)
+PROBE_BATCH_SIZE = 256
+def probe_files(executable,filenames,cache=None):
+    # Whether the shenidam executable can open each file, None for a file its run left unanswered, which is not cached.
+    # Files not in cache are checked PROBE_BATCH_SIZE per run.
+    tool = tool_identity(executable)
+    res = cache.get(tool,filenames) if cache is not None else [None for x in filenames]
+    missing = [x for x,y in zip(filenames,res) if y is None]
+    found = {}
+    for start in range(0,len(missing),PROBE_BATCH_SIZE):
+        batch = missing[start:start+PROBE_BATCH_SIZE]
+        results = Shenidam(executable).probe(batch)
+        found.update(zip(batch,results))
+        if cache is not None:
+            cache.put(tool,batch,results)
+    return [y if y is not None else found[x] for x,y in zip(filenames,res)]
+_working_tools = set()
+def tool_runs(args,cache=None):
+    # Whether the command succeeds. Success is remembered for this process, and in cache (by the executable's path, size and mtime).
+    key = (tool_identity(args[0]),tuple(args[1:]))
+    if key in _working_tools:
+        return True
+    path = find_executable(encode(args[0]))
+    check = "run "+" ".join(encode(x) for x in args[1:])
+    if path is not None and cache is not None and cache.get(check,[path])[0]:
+        _working_tools.add(key)
+        return True
+    if subprocess.call(args,stdin=None,stdout=subprocess.PIPE,stderr=subprocess.PIPE,shell=False):
+        return False
+    _working_tools.add(key)
+    if path is not None and cache is not None:
+        cache.put(check,[path],[True])
+    return True
+FINGERPRINT_SAMPLE_RATE = 8000
+def _sliding_maximum(a,radius,axis):
+    res = a.copy()
+    src = numpy.swapaxes(a,0,axis)
+    dst = numpy.swapaxes(res,0,axis)
+    for shift in range(1,min(radius,len(src)-1)+1):
+        numpy.maximum(dst[shift:],src[:-shift],out=dst[shift:])
+        numpy.maximum(dst[:-shift],src[shift:],out=dst[:-shift])
+    return res
+def _wav_sample_reader(f,info):
+    # read(start,count) on a mono 32-bit float WAV file, zero padded past its end.
+    if info.format_tag != 3 or info.channels != 1 or info.bits_per_sample != 32:
+        raise WavFormatError("Not a mono 32-bit float WAV file")
+    def read(start,count):
+        res = numpy.zeros(count,dtype=numpy.float32)
+        n = min(count,info.num_frames-start)
+        if n > 0:
+            f.seek(info.data_offset+start*4)
+            data = numpy.frombuffer(f.read(n*4),dtype=numpy.dtype(str("<f4")))
+            res[:len(data)] = data
+        return res
+    return read
+class FingerprintIndex(object):
+    # Spectral peak landmarks of the bases, in an SQLite file, for finding which base a track comes from and roughly where
+    # without correlating it with every base. A landmark pairs a peak with one of the next fan_out peaks: its hash holds both
+    # frequencies and the time between them, and it is stored with the time of the first peak, in frames of hop samples.
+    # Samples are mono at FINGERPRINT_SAMPLE_RATE. Requires numpy.
+    frame_size = 1024
+    hop = 256
+    peak_radius_frames = 5
+    peak_radius_bins = 15
+    fan_out = 5
+    max_dt = 63
+    block_frames = 4096
+    def __init__(self,filename):
+        if numpy is None:
+            raise ShenidamError("The fingerprint index requires numpy")
+        self.filename = filename
+        self.lock = threading.Lock()
+        with contextlib.closing(sqlite3.connect(self.filename)) as db:
+            with db:
+                db.execute("CREATE TABLE IF NOT EXISTS bases (id INTEGER PRIMARY KEY, filename TEXT UNIQUE, fingerprint TEXT, duration REAL)")
+                db.execute("CREATE TABLE IF NOT EXISTS landmarks (hash INTEGER, base INTEGER, time INTEGER)")
+                db.execute("CREATE INDEX IF NOT EXISTS landmarks_hash ON landmarks (hash)")
+    def bases(self):
+        with contextlib.closing(sqlite3.connect(self.filename)) as db:
+            return [row[0] for row in db.execute("SELECT filename FROM bases ORDER BY id")]
+    def is_indexed(self,filename):
+        with contextlib.closing(sqlite3.connect(self.filename)) as db:
+            row = db.execute("SELECT fingerprint FROM bases WHERE filename=?",(os.path.abspath(filename),)).fetchone()
+        return row is not None and row[0] == file_fingerprint(filename)
+    def landmarks(self,read,num_samples):
+        # The hashes and times of the landmarks of num_samples samples, given by read(start,count) as float32 arrays.
+        num_frames = max(0,(num_samples-self.frame_size)//self.hop+1)
+        window = numpy.hanning(self.frame_size).astype(numpy.float32)
+        r = self.peak_radius_frames
+        peak_frames = [numpy.zeros(0,dtype=numpy.int64)]
+        peak_bins = [numpy.zeros(0,dtype=numpy.int64)]
+        for first in range(0,num_frames,self.block_frames):
+            last = min(num_frames,first+self.block_frames)
+            # Neighbourhoods cross the blocks, so that the peaks do not depend on where the blocks start.
+            start = max(0,first-r)
+            end = min(num_frames,last+r)
+            samples = read(start*self.hop,(end-start-1)*self.hop+self.frame_size)
+            frames = numpy.lib.stride_tricks.as_strided(samples,shape=(end-start,self.frame_size),strides=(samples.strides[0]*self.hop,samples.strides[0]))
+            spectrum = numpy.log(numpy.abs(numpy.fft.rfft(frames*window,axis=1))[:,1:]+1e-6)
+            neighbourhood = _sliding_maximum(_sliding_maximum(spectrum,r,0),self.peak_radius_bins,1)
+            peaks = (spectrum == neighbourhood) & (spectrum > spectrum.mean(axis=1)[:,numpy.newaxis])
+            peaks[:first-start] = False
+            peaks[last-start:] = False
+            f,b = numpy.nonzero(peaks)
+            peak_frames.append(f.astype(numpy.int64)+start)
+            peak_bins.append(b.astype(numpy.int64))
+        frames = numpy.concatenate(peak_frames)
+        bins = numpy.concatenate(peak_bins)
+        hashes = [numpy.zeros(0,dtype=numpy.int64)]
+        times = [numpy.zeros(0,dtype=numpy.int64)]
+        for k in range(1,self.fan_out+1):
+            dt = frames[k:]-frames[:len(frames)-k]
+            ok = (dt >= 1) & (dt <= self.max_dt)
+            hashes.append((bins[:len(bins)-k][ok]<<15)|(bins[k:][ok]<<6)|dt[ok])
+            times.append(frames[:len(frames)-k][ok])
+        return numpy.concatenate(hashes),numpy.concatenate(times)
+    def add(self,filename,read,num_samples):
+        # Indexes the base filename (replacing it if it was indexed already) from its samples.
+        hashes,times = self.landmarks(read,num_samples)
+        filename = os.path.abspath(filename)
+        with self.lock,contextlib.closing(sqlite3.connect(self.filename)) as db:
+            with db:
+                row = db.execute("SELECT id FROM bases WHERE filename=?",(filename,)).fetchone()
+                if row is not None:
+                    db.execute("DELETE FROM landmarks WHERE base=?",row)
+                    db.execute("DELETE FROM bases WHERE id=?",row)
+                base = db.execute("INSERT INTO bases (filename,fingerprint,duration) VALUES (?,?,?)",(filename,file_fingerprint(filename),num_samples/FINGERPRINT_SAMPLE_RATE)).lastrowid
+                db.executemany("INSERT INTO landmarks (hash,base,time) VALUES (?,?,?)",((h,base,t) for h,t in zip(hashes.tolist(),times.tolist())))
+    def candidates(self,read,num_samples,max_candidates=3,min_votes=5):
+        # The (base filename, offset in seconds, votes) where the track most likely starts, best first. Only the
+        # landmarks sharing a hash with the track are read, through the index on the hashes.
+        hashes,times = self.landmarks(read,num_samples)
+        track_times = {}
+        for h,t in zip(hashes.tolist(),times.tolist()):
+            track_times.setdefault(h,[]).append(t)
+        keys = list(track_times)
+        votes = {}
+        with contextlib.closing(sqlite3.connect(self.filename)) as db:
+            for i in range(0,len(keys),500):
+                batch = keys[i:i+500]
+                for h,base,t in db.execute("SELECT hash,base,time FROM landmarks WHERE hash IN ({0})".format(",".join("?"*len(batch))),batch):
+                    for track_t in track_times[h]:
+                        key = (base,t-track_t)
+                        votes[key] = votes.get(key,0)+1
+            names = dict(db.execute("SELECT id,filename FROM bases"))
+        # The frames of the track need not line up with those of the base, which spreads a match over two offsets.
+        scores = sorted(((n+votes.get((base,offset+1),0),base,offset) for (base,offset),n in votes.items()),reverse=True)
+        res = []
+        for score,base,offset in scores:
+            if score < min_votes or len(res) == max_candidates:
+                break
+            if not any(b == base and abs(o-offset) <= self.max_dt for b,o,v in res):
+                res.append((base,offset,score))
+        return [(names[base],offset*self.hop/FINGERPRINT_SAMPLE_RATE,score) for base,offset,score in res]
+    def add_wav(self,filename,wav_filename):
+        # wav_filename holds the audio of the base filename, mono 32-bit float at FINGERPRINT_SAMPLE_RATE.
+        with open(wav_filename,"rb") as f:
+            info = read_wav_header(f)
+            self.add(filename,_wav_sample_reader(f,info),info.num_frames)
+    def candidates_wav(self,wav_filename,max_candidates=3,min_votes=5):
+        with open(wav_filename,"rb") as f:
+            info = read_wav_header(f)
+            return self.candidates(_wav_sample_reader(f,info),info.num_frames,max_candidates,min_votes)
+def _link_or_copy(src,dst):
+    try:
+        os.link(src,dst)
+    except (OSError,AttributeError):
+        shutil.copyfile(src,dst)
+class StreamNotifier(CancelListeners):
     def __init__(self,stream):
+        super(StreamNotifier,self).__init__()
         self.stream = stream
         self.done = False
-        self.canceled = False
     def update_major(self,minor_levels = 0, raise_if_canceled = True):
         pass
     def update_minor(self,raise_if_canceled = True):
@@ -218,10 +1069,10 @@ def filename_from_pattern(i,filename,pattern):
     pattern = re.sub(DIRNAME_PATTERN,dirname,pattern)
     pattern = re.sub(EXT_PATTERN,ext,pattern)
     return pattern
-class CancelableProgressNotifier(object):
+class CancelableProgressNotifier(CancelListeners):
     def __init__(self,queue,num_major_levels):
+        super(CancelableProgressNotifier,self).__init__()
         self.queue = queue
-        self.canceled = False
         self.current_major_label = ""
         self.current_major_level = -1
         self.current_minor_level = 0
@@ -262,14 +1113,21 @@ class CancelableProgressNotifier(object):
         if self.canceled:
             raise CanceledException()
     def cancel(self):
-        self.canceled = True
+        self.notify_cancel()
             
 class ShenidamFileProcessor(object):
     def __init__(self,model,notifier):
         self.base_fn = model.base_fn
         self.input_tracks = model.input_tracks
         self.output_params = model.output_params
-        self.transcode_base = model.transcode_base if model.transcode_base is not None else not Shenidam(model.shenidam).can_open(model.base_fn)
+        self.track_outputs = model.track_outputs
+        self.in_process = model.in_process
+        self.shenidam_library = model.shenidam_library
+        self.proxy = model.proxy
+        self.proxy_window = model.proxy_window
+        self.proxy_margin = model.proxy_margin
+        self.alternative_bases = list(model.alternative_bases)
+        self.init_transcoding(model)
         self.tmp_dir = model.tmp_dir
         self.output_tmp_dir = model.output_tmp_dir if model.output_tmp_dir is not None else self.tmp_dir
         self.shenidam = model.shenidam
@@ -277,120 +1135,629 @@ class ShenidamFileProcessor(object):
         self.has_mapped_output = model.has_mapped_output
         self.output_mapping = model.output_mapping
         self.shenidam_extra_args = model.shenidam_extra_args
+        self.fft_planner_rigor = model.fft_planner_rigor
+        self.fft_wisdom_file = model.fft_wisdom_file
+        self.low_memory = model.low_memory
         self.shenidam = model.shenidam
         self.avconv = encode(model.avconv)
         self.verbose = not model.quiet and model.verbose
         self.quiet = model.quiet
         self.notifier = notifier
+        self.num_jobs = model.num_jobs
+        self.direct_remux = model.direct_remux
+        self.command_slots = model.command_slots if model.command_slots is not None else threading.BoundedSemaphore(max(self.num_jobs,1))
+        self.shenidam_server = model.shenidam_server
+        self.server = (model.server or model.shenidam_server is not None) and not self.alternative_bases
+        self.streaming = model.streaming and not model.in_process and not model.proxy and not self.server
+        self.abort = None
         self.mapping = []
+        self.track_indices = {}
+        self.current_track = None
+        self.probe_cache = model_probe_cache(model)
+        self.cache = AudioCache(os.path.join(model.cache_dir,"audio"),model.cache_size) if model.cache_dir else None
+        self.mapping_store = MappingStore(os.path.join(model.cache_dir,"mappings.sqlite")) if model.cache_dir and not model.remap else None
+        self.fingerprint_index = FingerprintIndex(model.fingerprint_index) if model.fingerprint_index else None
+        self.fingerprint_candidates = model.fingerprint_candidates
+        self.timing_report = model.timing_report
+        self.performance = []
+        self.pending_indices = list(range(len(self.input_tracks)))
+        self.pending_tracks = self.input_tracks
         self.audio_export_params = model.audio_export_params
         self.default_audio_remix_params = model.default_audio_remix_params if model.default_audio_remix_params is not None else "-c:a copy"
         self.default_av_audio_remix_params = model.default_av_audio_remix_params if model.default_av_audio_remix_params is not None else "-v:a copy -c:a copy"
+    def init_transcoding(self,model):
+        if self.proxy:
+            self.transcode_base = False
+            self.transcode_alternative_bases = [False for x in self.alternative_bases]
+            return
+        # The bases left to decide are probed together.
+        probed = ([model.base_fn] if model.base_fn is not None and model.transcode_base is None else [])+(self.alternative_bases if model.transcode_base is None else [])
+        needs_transcoding = dict(zip(probed,bases_need_transcoding(model,probed)))
+        if model.base_fn is None:
+            self.transcode_base = False
+        elif model.transcode_base is not None:
+            self.transcode_base = model.transcode_base
+        else:
+            self.transcode_base = needs_transcoding[model.base_fn]
+        self.transcode_alternative_bases = [model.transcode_base if model.transcode_base is not None else needs_transcoding[x] for x in self.alternative_bases]
     def create_temporary_file_name(self,output=False):
         tmp_dir = self.tmp_dir
         if output:
             tmp_dir = self.output_tmp_dir
         return os.path.join(tmp_dir,"shenidam-av-tmp-"+uuid.uuid4().hex)
+    def start_mapping(self,stored):
+        # self.mapping holds the mapping of each input track, None until one is stored or found. The others are pending.
+        self.mapping = list(stored)
+        self.pending_indices = [i for i,x in enumerate(stored) if x is None]
+        self.pending_tracks = [self.input_tracks[i] for i in self.pending_indices]
+    def set_track_files(self,track_fns):
+        # track_fns are the files given to shenidam for the pending tracks, by which its messages name them.
+        self.track_indices = {}
+        for i,x in zip(self.pending_indices,track_fns):
+            self.track_indices.setdefault(encode(x),[]).append(i)
     def shenidam_updater(self,line,event):
+        # shenidam skips the tracks it cannot read or map, so its messages are matched to the tracks by file name.
+        indices = self.track_indices.get(encode(event.get("file","")),[])
         if event["MESSAGE"] in ("base-read","track-read","track-position-determined","wrote-file"):
             self.notifier.update_minor()
             if event["MESSAGE"]=="base-read":
-                self.num_converted = -1
                 self.notifier.set_minor_text("Base file processed")
             elif event["MESSAGE"]=="track-read":
-                self.num_converted+=1
-                self.notifier.set_minor_text("Track '{0}' loaded".format(self.input_tracks[self.num_converted]))
+                self.current_track = self.input_tracks[indices[0]] if indices else encode(event["file"])
+                self.notifier.set_minor_text("Track '{0}' loaded".format(self.current_track))
             elif event["MESSAGE"]=="track-position-determined":
-                self.notifier.set_minor_text("Track '{0}' mapped".format(self.input_tracks[self.num_converted]))
-                self.mapping.append({"file":encode(event["file"]),"determined_in":float(event["determined_in"]),
-                    "determined_length":float(event["determined_length"])})
+                self.notifier.set_minor_text("Track '{0}' mapped".format(self.current_track))
+                for i in indices:
+                    self.mapping[i] = {"file":encode(event["file"]),"determined_in":float(event["determined_in"]),
+                        "determined_length":float(event["determined_length"]),"base_index":int(event.get("base_index") or 0)}
             elif event["MESSAGE"]=="wrote-file":
-                self.notifier.set_minor_text("Track '{0}' exported ".format(self.input_tracks[self.num_converted]))
-                
+                self.notifier.set_minor_text("Track '{0}' exported ".format(self.current_track))
+        elif event["MESSAGE"]=="stage-timing":
+            self.performance.append({"file":self.input_tracks[indices[0]] if indices else encode(event["file"]),"stage":event["stage"],"wall_time":event["wall_time"],
+                "cpu_time":event["cpu_time"],"peak_bytes":event["peak_bytes"]})
+    def performance_report(self):
+        return performance_totals(self.performance)
+
+    def bases(self):
+        return ([self.base_fn] if self.base_fn is not None else [])+self.alternative_bases
+    def mapped_base(self,mapping):
+        # Tracks located through the fingerprint index may map to any of its bases, which are then named in the mapping.
+        return mapping["base"] if "base" in mapping else self.bases()[mapping["base_index"]]
+    def mapping_key(self):
+        args = parse_shenidam_args(self.shenidam_args())
+        base = file_fingerprint(self.base_fn)
+        if self.alternative_bases:
+            base = hashlib.sha1(" ".join(file_fingerprint(x) for x in self.bases()).encode("ascii")).hexdigest()
+        return base,args["sample_rate"],args["resampling_quality"]
+    def stored_mappings(self):
+        if self.mapping_store is None:
+            return [None for x in self.input_tracks]
+        base,sample_rate,resampling_quality = self.mapping_key()
+        return [self.mapping_store.get(base,file_fingerprint(x),sample_rate,resampling_quality) for x in self.input_tracks]
+    def store_mappings(self,stored):
+        # Records the mappings found for the tracks that had none stored. Those that could not be mapped are left out.
+        if self.mapping_store is None:
+            return
+        base,sample_rate,resampling_quality = self.mapping_key()
+        for track,x,y in zip(self.input_tracks,stored,self.mapping):
+            if x is None and y is not None:
+                self.mapping_store.put(base,file_fingerprint(track),sample_rate,resampling_quality,y["determined_in"],y["determined_length"],y.get("base_index",0))
+    def probe_sample_rate(self,avfilename):
+        tmp = self.create_temporary_file_name()
+        with TemporaryFile([tmp]):
+            self.extract_window(avfilename,tmp,0.0,0.1)
+            with open(tmp,"rb") as f:
+                return read_wav_header(f).sample_rate
+    def mapping_sample_rates(self,base_fns):
+        # The rate of the positions of each mapping: that of the base as read by shenidam, or of the original base with
+        # proxies and fingerprint candidates.
+        rates = {}
+        res = []
+        for x in self.mapping:
+            if x is None:
+                res.append(None)
+                continue
+            key = x["base"] if "base" in x else x["base_index"]
+            if key not in rates:
+                base_fn = base_fns[x["base_index"]] if "base" not in x and not self.proxy else self.mapped_base(x)
+                if can_open_wav(base_fn):
+                    with open(base_fn,"rb") as f:
+                        rates[key] = read_wav_header(f).sample_rate
+                else:
+                    rates[key] = self.probe_sample_rate(self.mapped_base(x))
+            res.append(rates[key])
+        return res
+    def write_stored_slices(self,base_fns,stored,output_fns):
+        # base_fns are the bases as given to shenidam, transcoded or not.
+        base_rates = {}
+        for track,x,output_fn in zip(self.input_tracks,stored,output_fns):
+            if x is None:
+                continue
+            self.notifier.update_minor()
+            self.notifier.set_minor_text("Track '{0}' exported from its stored mapping".format(track))
+            in_point,length,base_index = int(x["determined_in"]),int(x["determined_length"]),x["base_index"]
+            if not self.proxy and can_open_wav(base_fns[base_index]):
+                copy_partial_wav(base_fns[base_index],output_fn,in_point,length)
+            else:
+                if base_index not in base_rates:
+                    base_rates[base_index] = self.probe_sample_rate(self.bases()[base_index])
+                self.write_base_slice(output_fn,in_point,length,base_rates[base_index],self.bases()[base_index])
     def convert(self):
         try:
+            if self.fingerprint_index is not None:
+                self.convert_with_index()
+                return
+            stored = self.stored_mappings()
+            self.start_mapping(stored)
+            if not self.pending_tracks and not self.has_mapped_output:
+                self.store_mappings(stored)
+                return
             base = self.base_fn
-            if self.transcode_base:
+            server_base = self.server_base()
+            if server_base is not None:
+                base = server_base
+            elif self.transcode_base or self.proxy:
                 base = self.create_temporary_file_name()
-            with TemporaryFile([base],self.transcode_base):
-                shenidam_e = Shenidam(self.shenidam)
-                transcoding_required = [not shenidam_e.can_open(x) for x in self.input_tracks]
-                input_fns_with_needs_transcoding = [((self.create_temporary_file_name() if transcoding_required[i] else x),transcoding_required[i]) for (i,x) in enumerate(self.input_tracks)]
+            alternative_bases = [self.create_temporary_file_name() if self.proxy or x else y for x,y in zip(self.transcode_alternative_bases,self.alternative_bases)]
+            base_temporary_fns = [x for x,y in zip([base]+alternative_bases,self.bases()) if x != y and x != server_base]
+            with TemporaryFile(base_temporary_fns):
+                if self.proxy or self.in_process:
+                    transcoding_required = [self.proxy for x in self.pending_tracks]
+                else:
+                    transcoding_required = [not x for x in probe_files(self.shenidam,self.pending_tracks,self.probe_cache)]
+                input_fns_with_needs_transcoding = [((self.create_temporary_file_name() if transcoding_required[i] else x),transcoding_required[i]) for (i,x) in enumerate(self.pending_tracks)]
                 input_transcoded_fns = [x for (x,y) in input_fns_with_needs_transcoding if y]
                 input_fns = [x for (x,y) in input_fns_with_needs_transcoding]
-                input_fns_to_transcode = [x for (i,x) in enumerate(self.input_tracks) if transcoding_required[i]]
-                self.notifier.update_major()#1 Transcoding base:
-                if self.transcode_base:
-                    self.notifier.set_major_text("Transcoding base")
-                    self.extract_audio(self.base_fn,base)
+                input_fns_to_transcode = [x for (i,x) in enumerate(self.pending_tracks) if transcoding_required[i]]
+                self.set_track_files(input_fns)
+                self.notifier.update_major()#1 Transcoding base (runs along with the extraction of the tracks):
                 with TemporaryFile(input_transcoded_fns):
-                    if self.has_mapped_output:
+                    if self.has_mapped_output and not self.direct_remux:
                         output_temp_files = [self.create_temporary_file_name() for x in self.input_tracks]
                     else:
                         output_temp_files = []
-                    self.notifier.update_major(len(input_fns_to_transcode))#2 Extracting audio:
-                    if len(input_fns_to_transcode):
+                    pending_output_fns = [x for x,y in zip(output_temp_files,stored) if y is None]
+                    extraction_tasks = [("Transcoding base",functools.partial(self.extract_audio,self.base_fn,base))] if self.transcode_base and server_base is None else []
+                    extraction_tasks += [("Transcoding base '{0}'".format(y),functools.partial(self.extract_audio,y,x)) for x,y in zip(alternative_bases,self.alternative_bases) if x != y]
+                    if self.proxy:
+                        extraction_tasks = [("Extracting proxy of base '{0}'".format(y),functools.partial(self.extract_proxy,y,x)) for x,y in zip([base]+alternative_bases,self.bases()) if x != server_base]
+                        extraction_tasks += [("Extracting proxy of file '{0}'".format(x),functools.partial(self.extract_proxy,x,y)) for x,y in zip(input_fns_to_transcode,input_transcoded_fns)]
+                    elif self.streaming:
+                        for x in input_transcoded_fns:
+                            os.mkfifo(x)
+                    else:
+                        extraction_tasks += [("Extracting audio of file '{0}'".format(x),functools.partial(self.extract_audio,x,y)) for x,y in zip(input_fns_to_transcode,input_transcoded_fns)]
+                    self.notifier.update_major(len(extraction_tasks))#2 Extracting audio:
+                    if len(extraction_tasks):
                         self.notifier.set_major_text("Extracting audio")
-                    for x,y in zip(input_fns_to_transcode,input_transcoded_fns):
-                        self.notifier.update_minor()
-                        self.notifier.set_minor_text("Extracting audio of file '{0}'".format(x))
-                        self.extract_audio(x,y)
+                    self.run_tasks(extraction_tasks)
                     with TemporaryFile(output_temp_files):
-                        self.notifier.update_major(len(input_fns)*2+(len(input_fns) if self.has_mapped_output else 0)+1)#3 Running shenidam:
+                        self.notifier.update_major(len(input_fns)*2+(len(input_fns) if output_temp_files or self.proxy else 0)+(len(self.bases()) if input_fns else 0)+(len(self.input_tracks)-len(input_fns) if output_temp_files else 0))#3 Running shenidam:
                         self.notifier.set_major_text("Running shenidam")
-                        self.run_shenidam(base,input_fns,output_temp_files)
+                        if not input_fns:
+                            pass
+                        elif self.proxy:
+                            self.run_proxy_matching(base,input_fns,pending_output_fns,alternative_bases)
+                        elif self.in_process:
+                            self.run_matcher(base,input_fns,pending_output_fns,alternative_bases)
+                        elif self.server:
+                            self.run_server(base,input_fns,pending_output_fns)
+                        elif self.streaming:
+                            self.run_shenidam_streaming(base,input_fns,pending_output_fns,zip(input_fns_to_transcode,input_transcoded_fns),alternative_bases)
+                        else:
+                            self.run_shenidam(base,input_fns,pending_output_fns,alternative_bases=alternative_bases)
+                        self.store_mappings(stored)
                         if not self.has_mapped_output:
                             return
-                        delete_filenames([base],self.transcode_base)
+                        if self.direct_remux:
+                            rates = self.mapping_sample_rates([base]+alternative_bases)
+                            delete_filenames(base_temporary_fns)
+                            delete_filenames(input_transcoded_fns)
+                            self.remux_direct(rates)
+                            return
+                        self.write_stored_slices([base]+alternative_bases,stored,output_temp_files)
+                        delete_filenames(base_temporary_fns)
                         delete_filenames(input_transcoded_fns)
-                        output_remixed_files = [[filename_from_pattern(ix[0],ix[1],output_pattern) for ix in enumerate(self.input_tracks)] for (output_pattern,d1,d2) in self.output_params]
-                        remixed_temp_files = [[self.create_temporary_file_name(True)+"."+os.path.basename(x) for x in y] for y in output_remixed_files]
-                        remixed_temp_files_all = [item for sublist in remixed_temp_files for item in sublist]
-                        with TemporaryFile(remixed_temp_files_all):
-                            self.notifier.update_major(len(self.output_params)*len(self.input_tracks))#4 remixing audio
-                            self.notifier.set_major_text("Remixing audio")
-                            for i,(output_pattern,audio_only,audio_remix_params) in enumerate(self.output_params):
-                                for input_av,audio,temp_output_av in zip(self.input_tracks,output_temp_files,remixed_temp_files[i]):
-                                    self.notifier.update_minor()
-                                    self.notifier.set_minor_text("Remixing file '{0}'".format(input_av))
-                                    self.remix_audio(input_av,audio,temp_output_av,audio_only,audio_remix_params)
-                            delete_filenames(output_temp_files)
-                            self.notifier.update_major(len(self.output_params)*len(self.input_tracks))#5 copying result
-                            self.notifier.set_major_text("Copying result")
-                            for i in range(len(output_remixed_files)):
-                                for output_av,temp_output_av in zip(output_remixed_files[i],remixed_temp_files[i]):
-                                    self.notifier.update_minor()
-                                    self.notifier.set_minor_text("Copying file '{0}'".format(output_av))
-                                    shutil.move(temp_output_av,output_av)
+                        self.remix_outputs(output_temp_files)
         finally:
             self.notifier.done=True
     
 
+    def remix_outputs(self,output_temp_files):
+        # output_temp_files are the mapped audio of the input tracks.
+        def remix(i,output_fn,audio_only,audio_remix_params):
+            self.remix_audio(self.input_tracks[i],output_temp_files[i],output_fn,audio_only,audio_remix_params)
+        self.write_outputs(remix,output_temp_files)
+    def remux_direct(self,rates):
+        # Each output takes its audio straight from the original base, cut and padded by avconv in the same run, so that no
+        # mapped audio is written. rates are the mapping_sample_rates.
+        def remix(i,output_fn,audio_only,audio_remix_params):
+            mapping = self.mapping[i]
+            self.remix_slice(self.input_tracks[i],self.mapped_base(mapping),mapping,rates[i],output_fn,audio_only,audio_remix_params)
+        self.write_outputs(remix)
+    def write_outputs(self,remix,done_fns=()):
+        # remix(i,output_fn,audio_only,audio_remix_params) writes an output of track i, here to a temporary file moved into
+        # place once they are all written. done_fns are deleted before moving. Tracks that could not be mapped have no output.
+        outputs = [x for x in output_files(self) if self.mapping[x[0]] is not None]
+        remixed_temp_files = [self.create_temporary_file_name(True)+"."+os.path.basename(x[1]) for x in outputs]
+        with TemporaryFile(remixed_temp_files):
+            self.notifier.update_major(len(outputs))#4 remixing audio
+            self.notifier.set_major_text("Remixing audio")
+            remix_tasks = []
+            for (i,output_av,audio_only,audio_remix_params),temp_output_av in zip(outputs,remixed_temp_files):
+                remix_tasks.append(("Remixing file '{0}'".format(self.input_tracks[i]),functools.partial(remix,i,temp_output_av,audio_only,audio_remix_params)))
+            self.run_tasks(remix_tasks)
+            delete_filenames(done_fns)
+            self.notifier.update_major(len(outputs))#5 copying result
+            self.notifier.set_major_text("Copying result")
+            for (i,output_av,audio_only,audio_remix_params),temp_output_av in zip(outputs,remixed_temp_files):
+                self.notifier.update_minor()
+                self.notifier.set_minor_text("Copying file '{0}'".format(output_av))
+                shutil.move(temp_output_av,output_av)
+    def convert_with_index(self):
+        # The given bases that are not in the index, or have changed since they were added, are indexed, then each track
+        # is located among all the bases of the index and aligned on the best of its candidates.
+        bases = [x for x in self.bases() if not self.fingerprint_index.is_indexed(x)]
+        self.notifier.update_major(len(bases))#1 Indexing bases:
+        if bases:
+            self.notifier.set_major_text("Indexing bases")
+        self.run_tasks([("Indexing base '{0}'".format(x),functools.partial(self.index_base,x)) for x in bases])
+        self.mapping = [None for x in self.input_tracks]
+        candidates = [None for x in self.input_tracks]
+        self.notifier.update_major(len(self.input_tracks))#2 Looking up the tracks:
+        self.notifier.set_major_text("Looking up tracks")
+        self.run_tasks([("Looking up track '{0}'".format(x),functools.partial(self.look_up_track,i,x,candidates)) for i,x in enumerate(self.input_tracks)])
+        output_temp_files = [self.create_temporary_file_name() for x in self.input_tracks] if self.has_mapped_output and not self.direct_remux else []
+        with TemporaryFile(output_temp_files):
+            self.notifier.update_major(len(self.input_tracks))#3 Running shenidam:
+            self.notifier.set_major_text("Running shenidam")
+            self.run_tasks([("Aligning track '{0}'".format(x),functools.partial(self.align_track,i,x,candidates[i],output_temp_files[i] if output_temp_files else None)) for i,x in enumerate(self.input_tracks)])
+            if output_temp_files:
+                self.remix_outputs(output_temp_files)
+            elif self.has_mapped_output:
+                self.remux_direct(self.mapping_sample_rates(self.bases()))
+    def extract_fingerprint_audio(self,avfilename,outfn):
+        self.run_extraction(avfilename,outfn,"-vn -ac 1 -ar {0} -c:a pcm_f32le -f wav".format(FINGERPRINT_SAMPLE_RATE))
+    def index_base(self,base_fn):
+        tmp = self.create_temporary_file_name()
+        with TemporaryFile([tmp]):
+            self.extract_fingerprint_audio(base_fn,tmp)
+            self.fingerprint_index.add_wav(base_fn,tmp)
+    def look_up_track(self,i,track_fn,candidates):
+        # candidates[i] is set to the track's duration (in seconds) and its candidates in the index.
+        tmp = self.create_temporary_file_name()
+        with TemporaryFile([tmp]):
+            self.extract_fingerprint_audio(track_fn,tmp)
+            with open(tmp,"rb") as f:
+                duration = read_wav_header(f).num_frames/FINGERPRINT_SAMPLE_RATE
+            found = self.fingerprint_index.candidates_wav(tmp,self.fingerprint_candidates)
+        if not found:
+            raise ShenidamError("Track '{0}' was not found in the fingerprint index".format(track_fn))
+        candidates[i] = duration,found
+    def align_track(self,i,track_fn,candidates,output_fn):
+        # As in refine_mapping, with the full-rate windows of the bases around each candidate as alternative bases.
+        duration,found = candidates
+        track_start = max([0.0]+[-offset for base_fn,offset,votes in found])
+        window = min(self.proxy_window,duration-track_start)
+        base_fns = []
+        base_starts = []
+        base_windows = []
+        track_window = self.create_temporary_file_name()
+        window_fns = [self.create_temporary_file_name() for x in found]
+        with TemporaryFile([track_window]+window_fns):
+            for (base_fn,offset,votes),base_window in zip(found,window_fns):
+                base_start = max(0.0,offset+track_start-self.proxy_margin)
+                self.extract_window(base_fn,base_window,base_start,max(window,0.0)+2*self.proxy_margin)
+                with open(base_window,"rb") as f:
+                    if read_wav_header(f).num_frames == 0:
+                        continue
+                base_fns.append(base_fn)
+                base_starts.append(base_start)
+                base_windows.append(base_window)
+            if not base_fns:
+                raise ShenidamError("Track '{0}' lies outside the bases of its fingerprint candidates".format(track_fn))
+            if window > 0:
+                self.extract_window(track_fn,track_window,track_start,window)
+                k,window_in,window_length = self.match_best_file(base_windows,track_window)
+            else:
+                k,window_in = 0,0
+            with open(base_windows[k],"rb") as f:
+                base_rate = read_wav_header(f).sample_rate
+        if window > 0:
+            in_point = int(round(base_starts[k]*base_rate))+window_in-int(round(track_start*base_rate))
+        else:
+            in_point = int(round(found[0][1]*base_rate))
+        length = int(round(duration*base_rate))
+        self.mapping[i] = {"file":encode(track_fn),"determined_in":float(in_point),"determined_length":float(length),"base_index":0,"base":base_fns[k]}
+        if output_fn:
+            self.write_base_slice(output_fn,in_point,length,base_rate,base_fns[k])
+    def run_tasks(self,tasks):
+        # tasks are (text,function) pairs, run by at most num_jobs threads. The first error cancels the other tasks and is raised once they are stopped.
+        if self.num_jobs <= 1 or len(tasks) <= 1:
+            for text,function in tasks:
+                self.notifier.update_minor()
+                self.notifier.set_minor_text(text)
+                function()
+            return
+        pending = squeue.Queue()
+        for task in tasks:
+            pending.put(task)
+        errors = []
+        lock = threading.Lock()
+        self.abort = CancelListeners()
+        def worker():
+            while not self.abort.canceled:
+                try:
+                    text,function = pending.get_nowait()
+                except squeue.Empty:
+                    return
+                try:
+                    with lock:
+                        self.notifier.set_minor_text(text)
+                    function()
+                    with lock:
+                        self.notifier.update_minor()
+                except BaseException as e:
+                    with lock:
+                        errors.append(e)
+                    self.abort.notify_cancel()
+                    return
+        threads = [threading.Thread(target=worker) for i in range(min(self.num_jobs,len(tasks)))]
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                while thread.is_alive():
+                    thread.join(0.1)
+        except BaseException:
+            self.abort.notify_cancel()
+            for thread in threads:
+                thread.join()
+            raise
+        finally:
+            self.abort = None
+        if errors:
+            raise errors[0]
+    def refresh(self):
+        if self.abort is not None and self.abort.canceled:
+            raise CanceledException()
+        self.notifier.refresh()
+    def cancelables(self):
+        # What stops the running commands at once: the notifier, and the other tasks failing.
+        return [self.notifier]+([self.abort] if self.abort is not None else [])
+
     def raise_subprocess_error(self,cmd,stderr,show_error=True):
         raise SubprocessError("Command '{cmd}' failed{error}".format(cmd=cmd,error=(", error stream was:\n"+encode(stderr)) if show_error else ""))
     def run_command(self,cmd):
         try:
             stderr_forward = forward(sys.stderr) if self.verbose else do_nothing;
             
-            res,stdout,stderr = ProcessRunner(cmd,stderr_forward,stderr_forward,self.notifier.refresh)()
+            with self.command_slots:
+                res,stdout,stderr = ProcessRunner(cmd,stderr_forward,stderr_forward,self.refresh,self.cancelables())()
             if res != 0:
                 self.raise_subprocess_error(cmd,stderr)
         except OSError as e:
             self.raise_subprocess_error(cmd,unicode(e))
+    def run_extraction(self,avfilename,outfn,params):
+        # Runs avconv with the output options params, going through the cache unless avfilename is one of our temporary files.
+        key = None
+        if self.cache is not None and not os.path.basename(avfilename).startswith("shenidam-av-tmp-"):
+            key = self.cache.key(avfilename,self.avconv+" "+params)
+            if self.cache.fetch(key,outfn):
+                return
+        self.run_command("\"{exec_}\" -y -v 0 -loglevel error -i \"{avfilename}\" {params} \"{outfn}\"".format(exec_=self.avconv,avfilename=encode(avfilename),outfn=encode(outfn),params=encode(params)))
+        if key is not None:
+            self.cache.store(key,outfn)
     def extract_audio(self,avfilename,outfn):
-        self.run_command("\"{exec_}\" -y -v 0 -loglevel error -i \"{avfilename}\" -vn {audio_export_params} \"{outfn}\"".format(exec_=self.avconv,avfilename=encode(avfilename),outfn=encode(outfn),audio_export_params=encode(self.audio_export_params)))
+        self.run_extraction(avfilename,outfn,"-vn "+self.audio_export_params)
+    def read_audio_mono(self,filename):
+        # On a cache miss, the samples read from the pipe are also written to the new cache entry.
+        if self.cache is None or os.path.basename(filename).startswith("shenidam-av-tmp-"):
+            return read_audio_mono(self.avconv,filename,self.notifier.refresh)
+        key = self.cache.key(filename,self.avconv+" -vn -ac 1 -c:a pcm_f32le -f wav")
+        tmp = self.create_temporary_file_name()
+        with TemporaryFile([tmp]):
+            if self.cache.fetch(key,tmp):
+                return read_wav(tmp)
+            with open(tmp,"wb") as f:
+                res = read_audio_mono(self.avconv,filename,self.notifier.refresh,tee=f)
+            self.cache.store(key,tmp)
+            return res
 
-    def run_shenidam(self,base_fn,track_fns,output_fns):
+    def proxy_sample_rate(self):
+        return int(parse_shenidam_args(self.shenidam_args())["sample_rate"])
+    def extract_proxy(self,avfilename,outfn):
+        self.run_extraction(avfilename,outfn,"-vn -ac 1 -ar {0} -c:a pcm_f32le -f wav".format(self.proxy_sample_rate()))
+    def extract_window(self,avfilename,outfn,start,duration,audio_export_params="-ac 1 -c:a pcm_f32le -f wav"):
+        # Input seeking, which is sample-accurate when transcoding audio.
+        self.run_command("\"{exec_}\" -y -v 0 -loglevel error -ss {start:.6f} -i \"{avfilename}\" -t {duration:.6f} -vn {audio_export_params} \"{outfn}\"".format(exec_=self.avconv,avfilename=encode(avfilename),outfn=encode(outfn),start=start,duration=duration,audio_export_params=encode(audio_export_params)))
+
+    def shenidam_args(self):
+        args = self.shenidam_extra_args
+        if self.fft_planner_rigor is not None:
+            args += " -P {0}".format(self.fft_planner_rigor)
+        if self.fft_wisdom_file:
+            args += " -W \"{0}\"".format(encode(self.fft_wisdom_file))
+        if self.low_memory:
+            args += " -lm"
+        if self.timing_report:
+            args += " -tm"
+        return args
+    def run_shenidam(self,base_fn,track_fns,output_fns,periodic_notifier=None,alternative_bases=()):
         try:
-            self.num_converted = 0
             stderr_forward = forward(sys.stderr) if self.verbose else do_nothing;
             message_handler = self.shenidam_updater
-            cmd,res,stdin,stderr = Shenidam(self.shenidam,self.shenidam_extra_args,message_handler,stderr_forward,self.notifier.refresh)(base_fn,track_fns,output_fns)
+            with self.command_slots:
+                cmd,res,stdin,stderr = Shenidam(self.shenidam,self.shenidam_args(),message_handler,stderr_forward,periodic_notifier or self.notifier.refresh,self.cancelables())(base_fn,track_fns,output_fns,alternative_bases)
             if res != 0:
                 self.raise_subprocess_error(cmd,stderr)
         except OSError as e:
             self.raise_subprocess_error(cmd,unicode(e))
 
+    def run_shenidam_streaming(self,base_fn,track_fns,output_fns,streams,alternative_bases=()):
+        # avconv decodes each (avfile,fifo) stream while shenidam reads the other end. A failing avconv stops shenidam, which would otherwise wait on its FIFO forever.
+        # At most num_jobs decoders run at once: shenidam opens the FIFOs in order, so the next one is started (at the next refresh) when one finishes.
+        processes = []
+        pending = list(streams)
+        def start_decoders():
+            while pending and sum(1 for process in processes if process.running()) < max(self.num_jobs,1):
+                avfilename,fifo = pending.pop(0)
+                processes.append(BackgroundProcess("\"{exec_}\" -y -v 0 -loglevel error -i \"{avfilename}\" -vn -ac 1 -c:a pcm_f32be -f au \"{fifo}\"".format(exec_=self.avconv,avfilename=encode(avfilename),fifo=encode(fifo))))
+        try:
+            start_decoders()
+            def refresh():
+                for process in processes:
+                    process.check()
+                start_decoders()
+                self.notifier.refresh()
+            self.run_shenidam(base_fn,track_fns,output_fns,refresh,alternative_bases)
+            for process in processes:
+                process.finish()
+        finally:
+            for process in processes:
+                process.terminate()
+    def run_matcher(self,base_fn,track_fns,output_fns,alternative_bases=()):
+        args = parse_shenidam_args(self.shenidam_args())
+        bases = [base_fn]+list(alternative_bases)
+        base_wavs = [self.create_temporary_file_name() for x in bases] if self.low_memory else []
+        with TemporaryFile(base_wavs),ShenidamMatcher(args["sample_rate"],args["num_threads"],args["resampling_quality"],self.shenidam_library,args["planner_rigor"],args["wisdom_file"],args["block_size"]) as matcher:
+            for i,x in enumerate(bases):
+                if self.low_memory:
+                    self.run_extraction(x,base_wavs[i],"-vn -ac 1 -c:a pcm_f32le -f wav")
+                    matcher.add_base_wav(base_wavs[i])
+                else:
+                    info,samples = self.read_audio_mono(x)
+                    matcher.add_base_audio(samples,info.sample_rate,FORMAT_SINGLE)
+                    del samples
+                self.shenidam_updater(None,{"MESSAGE":"base-read","file":x})
+            for i,track_fn in enumerate(track_fns):
+                info,samples = self.read_audio_mono(track_fn)
+                self.shenidam_updater(None,{"MESSAGE":"track-read","file":track_fn})
+                if alternative_bases:
+                    base_index,in_point,length = matcher.get_best_audio_range(samples,info.sample_rate,FORMAT_SINGLE)
+                else:
+                    base_index = 0
+                    in_point,length = matcher.get_audio_range(samples,info.sample_rate,FORMAT_SINGLE)
+                del samples
+                self.shenidam_updater(None,{"MESSAGE":"track-position-determined","file":track_fn,"determined_in":in_point,"determined_length":length,"base_index":base_index})
+                if output_fns:
+                    copy_partial_wav(([base_fn]+list(alternative_bases))[base_index],output_fns[i],in_point,length)
+                    self.shenidam_updater(None,{"MESSAGE":"wrote-file","file":output_fns[i]})
+
+    def run_proxy_matching(self,base_fn,track_fns,output_fns,alternative_bases=()):
+        # The bases and track_fns are proxies. The coarse positions found on them are refined on full-rate windows of the original files.
+        if self.in_process:
+            self.run_matcher(base_fn,track_fns,[],alternative_bases)
+        elif self.server:
+            self.run_server(base_fn,track_fns,[])
+        else:
+            self.run_shenidam(base_fn,track_fns,[],alternative_bases=alternative_bases)
+        self.run_tasks([("Refining track '{0}'".format(self.input_tracks[i]),functools.partial(self.refine_mapping,i,self.input_tracks[i],self.mapping[i],output_fns[k] if output_fns else None))
+            for k,i in enumerate(self.pending_indices) if self.mapping[i] is not None])
+    def match_files(self,base_fn,track_fn):
+        return self.match_best_file([base_fn],track_fn)[1:]
+    def match_best_file(self,base_fns,track_fn):
+        # Returns the index of the base the track matches best, and its in point and length in that base.
+        if self.in_process:
+            args = parse_shenidam_args(self.shenidam_args())
+            with ShenidamMatcher(args["sample_rate"],args["num_threads"],args["resampling_quality"],self.shenidam_library,args["planner_rigor"],args["wisdom_file"],args["block_size"]) as matcher:
+                for base_fn in base_fns:
+                    info,samples = read_wav(base_fn)
+                    matcher.add_base_audio(samples,info.sample_rate,FORMAT_SINGLE)
+                    del samples
+                info,samples = read_wav(track_fn)
+                return matcher.get_best_audio_range(samples,info.sample_rate,FORMAT_SINGLE)
+        events = []
+        def handler(line,event):
+            if event["MESSAGE"] == "track-position-determined":
+                events.append(event)
+        stderr_forward = forward(sys.stderr) if self.verbose else do_nothing;
+        try:
+            with self.command_slots:
+                cmd,res,stdout,stderr = Shenidam(self.shenidam,self.shenidam_args(),handler,stderr_forward,self.refresh,self.cancelables())(base_fns[0],[track_fn],[],base_fns[1:])
+        except OSError as e:
+            self.raise_subprocess_error(self.shenidam,unicode(e))
+        if res != 0 or not events:
+            self.raise_subprocess_error(cmd,stderr)
+        return int(events[0].get("base_index") or 0),int(events[0]["determined_in"]),int(events[0]["determined_length"])
+    def refine_mapping(self,i,track_fn,mapping,output_fn):
+        # Times are in seconds. The first proxy_window seconds of the track that lie within the base are matched against the base around the coarse position.
+        # mapping is the coarse one of input track i, which is replaced by the refined one.
+        rate = self.proxy_sample_rate()
+        base_index = mapping["base_index"]
+        base_fn = self.bases()[base_index]
+        coarse_in = mapping["determined_in"]/rate
+        duration = mapping["determined_length"]/rate
+        track_start = max(0.0,-coarse_in)
+        window = min(self.proxy_window,duration-track_start)
+        base_start = max(0.0,coarse_in+track_start-self.proxy_margin)
+        base_window = self.create_temporary_file_name()
+        track_window = self.create_temporary_file_name()
+        with TemporaryFile([base_window,track_window]):
+            self.extract_window(base_fn,base_window,base_start,max(window,0.0)+2*self.proxy_margin)
+            with open(base_window,"rb") as f:
+                base_info = read_wav_header(f)
+            base_rate = base_info.sample_rate
+            in_point = int(round(coarse_in*base_rate))
+            if window > 0 and base_info.num_frames > 0:
+                self.extract_window(track_fn,track_window,track_start,window)
+                window_in,window_length = self.match_files(base_window,track_window)
+                in_point = int(round(base_start*base_rate))+window_in-int(round(track_start*base_rate))
+        length = int(round(duration*base_rate))
+        self.mapping[i] = {"file":encode(track_fn),"determined_in":float(in_point),"determined_length":float(length),"base_index":base_index}
+        if output_fn:
+            self.write_base_slice(output_fn,in_point,length,base_rate,base_fn)
+    def write_base_slice(self,output_fn,in_point,length,base_rate,base_fn):
+        # Only the part of the slice that lies within the base is decoded, copy_partial_wav pads the rest with silence.
+        start = max(in_point,0)
+        tmp = self.create_temporary_file_name()
+        with TemporaryFile([tmp]):
+            self.extract_window(base_fn,tmp,start/base_rate,max(in_point+length-start,1)/base_rate,self.audio_export_params)
+            copy_partial_wav(tmp,output_fn,in_point-start,length)
+
+    def server_base_key(self):
+        # Identifies the base as loaded by a server: the original base, and how it was transcoded, if it was.
+        if self.proxy:
+            params = "proxy {0}".format(self.proxy_sample_rate())
+        else:
+            params = self.audio_export_params if self.transcode_base else None
+        return file_fingerprint(self.base_fn),params
+    def server_base(self):
+        # The file the model's server loaded this base from, in an earlier run, if it still has it loaded.
+        if not self.server or self.shenidam_server is None:
+            return None
+        return self.shenidam_server.loaded_file(self.server_base_key())
+    def run_server(self,base_fn,track_fns,output_fns):
+        # Uses the model's server if it has one, which then keeps the base loaded for the next run.
+        server = self.shenidam_server or ShenidamServer(self.shenidam,self.shenidam_args())
+        try:
+            server.load_base(base_fn,self.server_base_key(),server is self.shenidam_server and base_fn != self.base_fn)
+            self.shenidam_updater(None,{"MESSAGE":"base-read","file":base_fn})
+            for i,track_fn in enumerate(track_fns):
+                self.refresh()
+                self.shenidam_updater(None,{"MESSAGE":"track-read","file":track_fn})
+                in_point,length = server.map(track_fn,output_fns[i] if output_fns else None)
+                self.shenidam_updater(None,{"MESSAGE":"track-position-determined","file":track_fn,"determined_in":in_point,"determined_length":length})
+                if output_fns:
+                    self.shenidam_updater(None,{"MESSAGE":"wrote-file","file":output_fns[i]})
+        finally:
+            if server is not self.shenidam_server:
+                server.close()
+
+    def remix_slice(self,avfilename,base_fn,mapping,base_rate,output_fn,audio_only,audio_remix_params):
+        # The part of the slice that lies within the base is read (input seeking), resampled to base_rate, the rate the
+        # mapping counts samples at, then delayed and padded with silence to the slice, in samples. The audio is encoded, so
+        # the default parameters only copy the video.
+        in_point,length = int(mapping["determined_in"]),int(mapping["determined_length"])
+        start = max(in_point,0)
+        if audio_remix_params is None or audio_remix_params.strip() == "default":
+            audio_remix_params = "" if audio_only else "-c:v copy"
+        base_input = "-ss {start:.6f} -t {duration:.6f} -i \"{base_fn}\"".format(start=start/base_rate,duration=max(in_point+length-start,1)/base_rate,base_fn=encode(base_fn))
+        audio_filter = "aresample={rate},adelay=delays={delay}S:all=1,apad=whole_len={length},atrim=end_sample={length}".format(rate=base_rate,delay=start-in_point,length=length)
+        if audio_only:
+            self.run_command("\"{avconv}\" -y -v 0 -loglevel error {base_input} -vn -af \"{audio_filter}\" {audio_remix_params} \"{output_fn}\"".format(avconv = self.avconv, base_input=base_input,audio_filter=audio_filter,output_fn=encode(output_fn),audio_remix_params=encode(audio_remix_params)))
+        else:
+            self.run_command("\"{avconv}\" -y -v 0 -loglevel error -i \"{avfilename}\" {base_input} -map 0:v -map 1:a -af \"{audio_filter}\" {audio_remix_params} \"{output_fn}\"".format(avconv = self.avconv, avfilename=encode(avfilename),base_input=base_input,audio_filter=audio_filter,output_fn=encode(output_fn),audio_remix_params=encode(audio_remix_params)))
     def remix_audio(self,avfilename,track_fn,output_fn,audio_only,audio_remix_params):
         if audio_remix_params is None or audio_remix_params.strip() == "default":
             audio_remix_params = self.default_audio_remix_params if audio_only else self.default_av_audio_remix_params
@@ -413,9 +1780,35 @@ class FileProcessorModel(object):
     output_tmp_dir = None
     has_mapped_output = True
     output_mapping = u""
+    in_process = False
+    shenidam_library = None
+    fft_planner_rigor = None
+    fft_wisdom_file = None
+    low_memory = False
+    num_jobs = 1
+    streaming = False
+    proxy = False
+    proxy_window = 10.0
+    proxy_margin = 1.0
+    cache_dir = default_cache_dir()
+    cache_size = 2<<30
+    remap = False
+    server = False
+    shenidam_server = None
+    fingerprint_index = None
+    fingerprint_candidates = 3
+    timing_report = None
+    # (seq,output_params) of each input track, in place of output_params, when the tracks come from several jobs.
+    track_outputs = None
+    # A semaphore bounding the commands run at once, shared by the processors of a batch.
+    command_slots = None
+    manifest = None
+    temp_disk_budget = None
+    direct_remux = False
     def __init__(self):
         self.output_params=[]
         self.input_tracks = []
+        self.alternative_bases = []
         self.mapping = []
     def __setattr__(self,key,value):
         return super(FileProcessorModel,self).__setattr__(key,encode_if_string(value))
@@ -435,25 +1828,234 @@ def check_file_read(path):
         raise ModelException("'"+path+"' is a directory")
     if not os.access(path,os.R_OK):
         raise ModelException("Cannot read file '"+path+"'")
-def check_model(model):
-    check_file_read(model.base_fn)
+def bases_need_transcoding(model,filenames):
+    if model.in_process:
+        return [model.has_mapped_output and not can_open_wav(x) for x in filenames]
+    return [not x for x in probe_files(model.shenidam,filenames,model_probe_cache(model))]
+def output_files(model):
+    # (index of the input track, output filename, audio_only, audio_remix_params) of each output file.
+    res = []
+    for i,track in enumerate(model.input_tracks):
+        seq,output_params = model.track_outputs[i] if model.track_outputs is not None else (i,model.output_params)
+        for output_pattern,audio_only,audio_remix_params in output_params:
+            if output_pattern:
+                res.append((i,filename_from_pattern(seq,track,output_pattern),audio_only,audio_remix_params))
+    return res
+def check_model(model,check_tools=True):
+    if model.base_fn is not None or not model.fingerprint_index:
+        check_file_read(model.base_fn)
+    for x in model.alternative_bases:
+        check_file_read(x)
     if not model.input_tracks:
         raise ModelException("No input tracks")
-    if model.has_mapped_output and not model.output_params:
+    outputs = output_files(model) if model.has_mapped_output else []
+    if model.has_mapped_output and not outputs:
         raise ModelException("No output tracks")
     for x in model.input_tracks:
         check_file_read(x)
-    if model.has_mapped_output:
-        for y,d1,d2 in model.output_params:
-            for i,x in enumerate(model.input_tracks):
-                check_file_write(filename_from_pattern(i,x,y))
+    for i,x,d1,d2 in outputs:
+        check_file_write(x)
     if model.output_mapping:
         check_file_write(model.output_mapping)
+    if model.timing_report:
+        if model.in_process or model.server or model.shenidam_server is not None:
+            raise ModelException("Stage timings are only sent by the shenidam executable, not in process or in server mode")
+        check_file_write(model.timing_report)
     if model.output_tmp_dir is not None and ( not os.path.isdir(model.tmp_dir) or not os.access(model.tmp_dir,os.W_OK)):
         raise ModelException("Cannot write to temporary directory '"+model.tmp_dir+"'")
     if model.output_tmp_dir is not None and ( not os.path.isdir(model.output_tmp_dir) or not os.access(model.output_tmp_dir,os.W_OK)):
         raise ModelException("Cannot write to output temporary directory '"+model.output_tmp_dir+"'")
-    if subprocess.call([model.avconv ,"-version"],stdin=None,stdout=subprocess.PIPE,stderr=subprocess.PIPE,shell=False):
+    if model.cache_dir:
+        try:
+            if not os.path.isdir(model.cache_dir):
+                os.makedirs(model.cache_dir)
+        except OSError:
+            raise ModelException("Cannot create cache directory '"+model.cache_dir+"'")
+        if not os.access(model.cache_dir,os.W_OK):
+            raise ModelException("Cannot write to cache directory '"+model.cache_dir+"'")
+    if model.fingerprint_index:
+        if numpy is None:
+            raise ModelException("The fingerprint index requires numpy")
+        check_file_write(model.fingerprint_index)
+    if check_tools:
+        check_model_tools(model)
+def check_model_tools(model):
+    cache = model_probe_cache(model)
+    if not tool_runs([model.avconv,"-version"],cache):
         raise ModelException("Cannot run avconv. Check path.")
-    if subprocess.call([model.shenidam,"--shenidam-return-only"],stdin=None,stdout=subprocess.PIPE,stderr=subprocess.PIPE,shell=False):
+    if model.in_process:
+        try:
+            load_library(model.shenidam_library)
+        except OSError:
+            raise ModelException("Cannot load the shenidam library. Check path.")
+    elif not tool_runs([model.shenidam,"--shenidam-return-only"],cache):
         raise ModelException("Cannot run shenidam. Check path.")
+
+class BatchJob(object):
+    # One job of a manifest. mapping (whose entries name their base), performance and error are set once it has run.
+    def __init__(self,name,base_fn,alternative_bases,input_tracks,output_params,output_mapping=""):
+        self.name = name
+        self.base_fn = base_fn
+        self.alternative_bases = alternative_bases
+        self.input_tracks = input_tracks
+        self.output_params = output_params
+        self.output_mapping = output_mapping
+        self.mapping = None
+        self.performance = []
+        self.error = None
+def _string_list(value):
+    if isinstance(value,basestring):
+        value = [value]
+    return [encode(x) for x in value]
+def _manifest_job(i,entry,defaults):
+    name = encode(entry.get("name") or "job {0}".format(i+1))
+    tracks = _string_list(entry.get("tracks") or [])
+    if not tracks:
+        raise ModelException("No tracks in job '{0}'".format(name))
+    if entry.get("output") is None:
+        output_params = defaults.output_params
+    else:
+        audio_only = entry.get("audio_only",defaults.output_params[0][1] if defaults.output_params else False)
+        output_params = [[x,bool(audio_only),encode_if_string(entry.get("audio_remix_params"))] for x in _string_list(entry["output"])]
+    return BatchJob(name,encode_if_string(entry.get("base",defaults.base_fn)),_string_list(entry.get("bases",defaults.alternative_bases)),
+        tracks,output_params,encode(entry.get("mapping") or ""))
+def _read_manifest_tsv(data):
+    lines = [x.rstrip("\r") for x in data.split("\n") if x.strip()]
+    if not lines:
+        return []
+    header = [x.strip().upper() for x in lines[0].split("\t")]
+    for column in ("JOB","BASE","TRACK"):
+        if column not in header:
+            raise ValueError("no {0} column".format(column))
+    jobs = collections.OrderedDict()
+    for line in lines[1:]:
+        row = dict(zip(header,line.split("\t")))
+        job = jobs.setdefault(row["JOB"],{"name":row["JOB"],"base":row["BASE"],"tracks":[]})
+        job["tracks"].append(row["TRACK"])
+        if row.get("OUTPUT") and row["OUTPUT"] not in job.setdefault("output",[]):
+            job["output"].append(row["OUTPUT"])
+        if row.get("MAPPING"):
+            job["mapping"] = row["MAPPING"]
+    return list(jobs.values())
+def load_manifest(filename,defaults):
+    # Either a JSON list of jobs, objects with tracks and optionally name, base, bases (the alternative bases), output
+    # (one or more patterns), audio_only, audio_remix_params and mapping (a mapping file for the job), or a tab-separated
+    # file of one track per line, with a JOB, BASE, TRACK and optionally OUTPUT and MAPPING header. What a job leaves out is
+    # taken from defaults, a FileProcessorModel.
+    with open(filename,"rb") as f:
+        data = f.read().decode("utf-8")
+    try:
+        if data.lstrip().startswith(("[","{")):
+            entries = json.loads(data)
+            if isinstance(entries,dict):
+                entries = entries["jobs"]
+        else:
+            entries = _read_manifest_tsv(data)
+        return [_manifest_job(i,x,defaults) for i,x in enumerate(entries)]
+    except (ValueError,KeyError,AttributeError,TypeError) as e:
+        raise ModelException("Invalid manifest '{0}': {1}".format(filename,e))
+class BatchScheduler(object):
+    # Runs the jobs of a manifest, those sharing their bases as a single processor run, so that the bases are transcoded
+    # and loaded once. The runs take model.num_jobs threads and share model.num_jobs command slots. A run only starts if
+    # its temporary files, estimated at twice the size of its input files, fit in model.temp_disk_budget bytes along with
+    # those of the running ones (or if none is running). A failing run sets the error of its jobs, the others go on.
+    def __init__(self,jobs,model,notifier):
+        self.jobs = jobs
+        self.model = model
+        self.notifier = notifier
+        self.slots = threading.BoundedSemaphore(max(model.num_jobs,1))
+        self.budget = threading.Condition()
+        self.reserved = 0
+        self.running = 0
+    def groups(self):
+        # Jobs are checked on their own first, so that one with a missing file does not fail those sharing its bases.
+        groups = collections.OrderedDict()
+        for job in self.jobs:
+            try:
+                check_model(self.group_model([job]),False)
+            except ModelException as e:
+                job.error = e
+                continue
+            groups.setdefault((job.base_fn,tuple(job.alternative_bases)),[]).append(job)
+        return list(groups.values())
+    def group_model(self,jobs):
+        model = copy.copy(self.model)
+        model.base_fn = jobs[0].base_fn
+        model.alternative_bases = list(jobs[0].alternative_bases)
+        model.input_tracks = [x for job in jobs for x in job.input_tracks]
+        model.track_outputs = [(i,job.output_params) for job in jobs for i in range(len(job.input_tracks))]
+        model.output_params = []
+        model.output_mapping = ""
+        model.mapping = []
+        model.command_slots = self.slots
+        return model
+    def temporary_bytes(self,model):
+        return 2*sum(os.path.getsize(x) for x in ([model.base_fn] if model.base_fn is not None else [])+model.alternative_bases+model.input_tracks)
+    def reserve(self,size):
+        with self.budget:
+            while self.running and self.model.temp_disk_budget and self.reserved+size > self.model.temp_disk_budget:
+                if self.notifier.canceled:
+                    raise CanceledException()
+                self.budget.wait(0.1)
+            self.reserved += size
+            self.running += 1
+    def release(self,size):
+        with self.budget:
+            self.reserved -= size
+            self.running -= 1
+            self.budget.notify_all()
+    def run_group(self,jobs):
+        model = self.group_model(jobs)
+        try:
+            size = self.temporary_bytes(model)
+            self.reserve(size)
+            try:
+                processor = ShenidamFileProcessor(model,self.notifier)
+                processor.convert()
+            finally:
+                self.release(size)
+        except Exception as e:
+            for job in jobs:
+                job.error = e
+            return
+        found = dict((x,dict(y,base=processor.mapped_base(y))) for x,y in zip(processor.input_tracks,processor.mapping) if y is not None)
+        owners = {}
+        for job in jobs:
+            unmapped = [x for x in job.input_tracks if x not in found]
+            if unmapped:
+                job.error = ShenidamError("Track '{0}' could not be mapped".format("', '".join(unmapped)))
+            else:
+                job.mapping = [found[x] for x in job.input_tracks]
+            for x in job.input_tracks:
+                owners.setdefault(x,[]).append(job)
+        # A track given in several jobs has its stages timed once per job, in the order of the jobs.
+        seen = collections.Counter()
+        for x in processor.performance:
+            k = seen[x["file"],x["stage"]]
+            seen[x["file"],x["stage"]] += 1
+            if k < len(owners[x["file"]]):
+                owners[x["file"]][k].performance.append(x)
+    def run(self):
+        pending = squeue.Queue()
+        for group in self.groups():
+            pending.put(group)
+        def worker():
+            while not self.notifier.canceled:
+                try:
+                    jobs = pending.get_nowait()
+                except squeue.Empty:
+                    return
+                self.run_group(jobs)
+        threads = [threading.Thread(target=worker) for i in range(min(max(self.model.num_jobs,1),pending.qsize()))]
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                while thread.is_alive():
+                    thread.join(0.1)
+        except BaseException:
+            self.notifier.notify_cancel()
+            for thread in threads:
+                thread.join()
+            raise
+        return self.jobs
@@ -0,0 +1,243 @@
+"""
+    Copyright 2010 Nabil Stendardo <nabil@stendardo.org>
+
+    This file is part of Shenidam.
+
+    Shenidam is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) version 2 of the same License.
+
+    Shenidam is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with Shenidam.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+# The file processing pipeline on asyncio subprocesses (Python 3.5 or later), so that one event loop can run many
+# jobs. Cancelling the task awaiting AsyncFileProcessor.convert() terminates its commands and removes its temporary
+# files.
+import asyncio
+import functools
+import os
+import shutil
+import sys
+
+from shenidam import (ShenidamFileProcessor,Shenidam,ModelException,OutputCapture,TemporaryFile,
+    encode,forward,do_nothing,split_command,can_open_wav,copy_partial_wav,read_wav_header,delete_filenames,output_files,
+    probe_results,tool_identity,PROBE_BATCH_SIZE)
+
+async def run_process(command,stdout_callback=do_nothing,stderr_callback=do_nothing,max_capture=1<<20):
+    # The asyncio counterpart of shenidam.ProcessRunner, returning (returncode,stdout,stderr).
+    process = await asyncio.create_subprocess_exec(*split_command(command),stdin=asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.PIPE,stderr=asyncio.subprocess.PIPE)
+    captures = [OutputCapture(stdout_callback,max_capture),OutputCapture(stderr_callback,max_capture)]
+    async def read(stream,capture):
+        while True:
+            data = await stream.read(65536)
+            if not data:
+                capture.close()
+                return
+            capture.write(data)
+    try:
+        await asyncio.gather(read(process.stdout,captures[0]),read(process.stderr,captures[1]))
+        await process.wait()
+    except BaseException:
+        if process.returncode is None:
+            process.terminate()
+            await asyncio.shield(process.wait())
+        raise
+    return process.returncode,captures[0].getvalue(),captures[1].getvalue()
+
+def _current_task():
+    if hasattr(asyncio,"current_task"):
+        return asyncio.current_task()
+    return asyncio.Task.current_task()
+
+class AsyncFileProcessor(ShenidamFileProcessor):
+    # The stages of ShenidamFileProcessor.convert() with the shenidam executable. limit is an asyncio.Semaphore bounding
+    # the commands run at once, which may be shared by many processors; by default each gets its own, of num_jobs.
+    # Canceling the notifier cancels the task running convert().
+    def __init__(self,model,notifier,limit=None):
+        if model.proxy or model.in_process or model.server or model.shenidam_server is not None or model.streaming or model.fingerprint_index or model.direct_remux:
+            raise ModelException("The asyncio processor only runs the shenidam executable, not in proxy, in process, server, streaming, fingerprint index or direct remux mode")
+        super(AsyncFileProcessor,self).__init__(model,notifier)
+        self.limit = limit if limit is not None else asyncio.Semaphore(max(self.num_jobs,1))
+    def init_transcoding(self,model):
+        # Left to convert(), where checking the bases does not block the loop.
+        self.transcode_base = False if model.base_fn is None else model.transcode_base
+        self.transcode_alternative_bases = [model.transcode_base for x in self.alternative_bases]
+
+    async def run_blocking(self,function,*args):
+        # File copies, fingerprints and SQLite queries run on the loop's default executor, not on the loop.
+        return await asyncio.get_event_loop().run_in_executor(None,functools.partial(function,*args))
+    async def run_command_async(self,cmd,stdout_callback=None,check=True):
+        stderr_forward = forward(sys.stderr) if self.verbose else do_nothing
+        async with self.limit:
+            try:
+                res,stdout,stderr = await run_process(cmd,stdout_callback or stderr_forward,stderr_forward)
+            except OSError as e:
+                self.raise_subprocess_error(cmd,str(e))
+        if check and res != 0:
+            self.raise_subprocess_error(cmd,stderr)
+        return res
+    async def probe_async(self,filenames):
+        # As shenidam.probe_files.
+        tool = tool_identity(self.shenidam)
+        res = await self.run_blocking(self.probe_cache.get,tool,filenames) if self.probe_cache is not None else [None for x in filenames]
+        missing = [x for x,y in zip(filenames,res) if y is None]
+        found = {}
+        for start in range(0,len(missing),PROBE_BATCH_SIZE):
+            batch = missing[start:start+PROBE_BATCH_SIZE]
+            lines = []
+            await self.run_command_async(Shenidam(self.shenidam).probe_command(batch),lines.append,check=False)
+            results = probe_results(lines,len(batch))
+            found.update(zip(batch,results))
+            if self.probe_cache is not None:
+                await self.run_blocking(self.probe_cache.put,tool,batch,results)
+        return [y if y is not None else found[x] for x,y in zip(filenames,res)]
+    async def run_tasks_async(self,tasks):
+        # tasks are (text,coroutine function) pairs, run together. The first error cancels the other tasks and is raised once they are stopped.
+        async def run(text,function):
+            self.notifier.set_minor_text(text)
+            await function()
+            self.notifier.update_minor()
+        futures = [asyncio.ensure_future(run(text,function)) for text,function in tasks]
+        try:
+            await asyncio.gather(*futures)
+        except BaseException:
+            for x in futures:
+                x.cancel()
+            await asyncio.gather(*futures,return_exceptions=True)
+            raise
+
+    async def run_extraction_async(self,avfilename,outfn,params):
+        key = None
+        if self.cache is not None and not os.path.basename(avfilename).startswith("shenidam-av-tmp-"):
+            key = self.cache.key(avfilename,self.avconv+" "+params)
+            if await self.run_blocking(self.cache.fetch,key,outfn):
+                return
+        await self.run_command_async("\"{exec_}\" -y -v 0 -loglevel error -i \"{avfilename}\" {params} \"{outfn}\"".format(exec_=self.avconv,avfilename=encode(avfilename),outfn=encode(outfn),params=encode(params)))
+        if key is not None:
+            await self.run_blocking(self.cache.store,key,outfn)
+    async def extract_audio_async(self,avfilename,outfn):
+        await self.run_extraction_async(avfilename,outfn,"-vn "+self.audio_export_params)
+    async def extract_window_async(self,avfilename,outfn,start,duration,audio_export_params="-ac 1 -c:a pcm_f32le -f wav"):
+        await self.run_command_async("\"{exec_}\" -y -v 0 -loglevel error -ss {start:.6f} -i \"{avfilename}\" -t {duration:.6f} -vn {audio_export_params} \"{outfn}\"".format(exec_=self.avconv,avfilename=encode(avfilename),outfn=encode(outfn),start=start,duration=duration,audio_export_params=encode(audio_export_params)))
+    async def probe_sample_rate_async(self,avfilename):
+        tmp = self.create_temporary_file_name()
+        with TemporaryFile([tmp]):
+            await self.extract_window_async(avfilename,tmp,0.0,0.1)
+            with open(tmp,"rb") as f:
+                return read_wav_header(f).sample_rate
+    async def write_base_slice_async(self,output_fn,in_point,length,base_rate,base_fn):
+        start = max(in_point,0)
+        tmp = self.create_temporary_file_name()
+        with TemporaryFile([tmp]):
+            await self.extract_window_async(base_fn,tmp,start/base_rate,max(in_point+length-start,1)/base_rate,self.audio_export_params)
+            await self.run_blocking(copy_partial_wav,tmp,output_fn,in_point-start,length)
+    async def write_stored_slices_async(self,base_fns,stored,output_fns):
+        base_rates = {}
+        for track,x,output_fn in zip(self.input_tracks,stored,output_fns):
+            if x is None:
+                continue
+            self.notifier.update_minor()
+            self.notifier.set_minor_text("Track '{0}' exported from its stored mapping".format(track))
+            in_point,length,base_index = int(x["determined_in"]),int(x["determined_length"]),x["base_index"]
+            if can_open_wav(base_fns[base_index]):
+                await self.run_blocking(copy_partial_wav,base_fns[base_index],output_fn,in_point,length)
+            else:
+                if base_index not in base_rates:
+                    base_rates[base_index] = await self.probe_sample_rate_async(self.bases()[base_index])
+                await self.write_base_slice_async(output_fn,in_point,length,base_rates[base_index],self.bases()[base_index])
+    async def run_shenidam_async(self,base_fn,track_fns,output_fns,alternative_bases=()):
+        shenidam_e = Shenidam(self.shenidam,self.shenidam_args(),self.shenidam_updater)
+        await self.run_command_async(shenidam_e.command(base_fn,track_fns,output_fns,alternative_bases),shenidam_e.output_callback)
+    async def remix_audio_async(self,avfilename,track_fn,output_fn,audio_only,audio_remix_params):
+        if audio_remix_params is None or audio_remix_params.strip() == "default":
+            audio_remix_params = self.default_audio_remix_params if audio_only else self.default_av_audio_remix_params
+        if audio_only:
+            await self.run_command_async("\"{avconv}\" -y -v 0 -loglevel error -i \"{track_fn}\" {audio_remix_params} \"{output_fn}\"".format(avconv = self.avconv, track_fn=encode(track_fn),output_fn=encode(output_fn),audio_remix_params=encode(audio_remix_params)))
+        else:
+            await self.run_command_async("\"{avconv}\" -y -v 0 -loglevel error -i \"{avfilename}\" -i \"{track_fn}\" -map 0:v -map 1:a  {audio_remix_params} \"{output_fn}\"".format(avconv = self.avconv, avfilename=encode(avfilename),track_fn=encode(track_fn),output_fn=encode(output_fn),audio_remix_params=encode(audio_remix_params)))
+    async def remix_outputs_async(self,output_temp_files):
+        outputs = [x for x in output_files(self) if self.mapping[x[0]] is not None]
+        remixed_temp_files = [self.create_temporary_file_name(True)+"."+os.path.basename(x[1]) for x in outputs]
+        with TemporaryFile(remixed_temp_files):
+            self.notifier.update_major(len(outputs))#4 remixing audio
+            self.notifier.set_major_text("Remixing audio")
+            remix_tasks = []
+            for (i,output_av,audio_only,audio_remix_params),temp_output_av in zip(outputs,remixed_temp_files):
+                input_av = self.input_tracks[i]
+                remix_tasks.append(("Remixing file '{0}'".format(input_av),functools.partial(self.remix_audio_async,input_av,output_temp_files[i],temp_output_av,audio_only,audio_remix_params)))
+            await self.run_tasks_async(remix_tasks)
+            delete_filenames(output_temp_files)
+            self.notifier.update_major(len(outputs))#5 copying result
+            self.notifier.set_major_text("Copying result")
+            for (i,output_av,audio_only,audio_remix_params),temp_output_av in zip(outputs,remixed_temp_files):
+                self.notifier.update_minor()
+                self.notifier.set_minor_text("Copying file '{0}'".format(output_av))
+                # A copy when the output is on another file system.
+                await self.run_blocking(shutil.move,temp_output_av,output_av)
+
+    async def convert(self):
+        task = _current_task()
+        loop = asyncio.get_event_loop()
+        cancel = lambda: loop.call_soon_threadsafe(task.cancel)
+        self.notifier.add_cancel_listener(cancel)
+        try:
+            await self.convert_tracks()
+        finally:
+            self.notifier.remove_cancel_listener(cancel)
+            self.notifier.done=True
+    async def convert_tracks(self):
+        stored = await self.run_blocking(self.stored_mappings)
+        self.start_mapping(stored)
+        if not self.pending_tracks and not self.has_mapped_output:
+            return
+        probed = ([self.base_fn] if self.transcode_base is None else [])+[x for x,y in zip(self.alternative_bases,self.transcode_alternative_bases) if y is None]
+        needs_transcoding = dict(zip(probed,[not x for x in await self.probe_async(probed)]))
+        if self.transcode_base is None:
+            self.transcode_base = needs_transcoding[self.base_fn]
+        self.transcode_alternative_bases = [x if x is not None else needs_transcoding[y] for x,y in zip(self.transcode_alternative_bases,self.alternative_bases)]
+        base = self.base_fn
+        if self.transcode_base:
+            base = self.create_temporary_file_name()
+        alternative_bases = [self.create_temporary_file_name() if x else y for x,y in zip(self.transcode_alternative_bases,self.alternative_bases)]
+        base_temporary_fns = [x for x,y in zip([base]+alternative_bases,self.bases()) if x != y]
+        with TemporaryFile(base_temporary_fns):
+            transcoding_required = [not x for x in await self.probe_async(self.pending_tracks)]
+            input_fns_with_needs_transcoding = [((self.create_temporary_file_name() if transcoding_required[i] else x),transcoding_required[i]) for (i,x) in enumerate(self.pending_tracks)]
+            input_transcoded_fns = [x for (x,y) in input_fns_with_needs_transcoding if y]
+            input_fns = [x for (x,y) in input_fns_with_needs_transcoding]
+            input_fns_to_transcode = [x for (i,x) in enumerate(self.pending_tracks) if transcoding_required[i]]
+            self.set_track_files(input_fns)
+            self.notifier.update_major()#1 Transcoding base (runs along with the extraction of the tracks):
+            with TemporaryFile(input_transcoded_fns):
+                if self.has_mapped_output:
+                    output_temp_files = [self.create_temporary_file_name() for x in self.input_tracks]
+                else:
+                    output_temp_files = []
+                pending_output_fns = [x for x,y in zip(output_temp_files,stored) if y is None]
+                extraction_tasks = [("Transcoding base",functools.partial(self.extract_audio_async,self.base_fn,base))] if self.transcode_base else []
+                extraction_tasks += [("Transcoding base '{0}'".format(y),functools.partial(self.extract_audio_async,y,x)) for x,y in zip(alternative_bases,self.alternative_bases) if x != y]
+                extraction_tasks += [("Extracting audio of file '{0}'".format(x),functools.partial(self.extract_audio_async,x,y)) for x,y in zip(input_fns_to_transcode,input_transcoded_fns)]
+                self.notifier.update_major(len(extraction_tasks))#2 Extracting audio:
+                if len(extraction_tasks):
+                    self.notifier.set_major_text("Extracting audio")
+                await self.run_tasks_async(extraction_tasks)
+                with TemporaryFile(output_temp_files):
+                    self.notifier.update_major(len(input_fns)*2+(len(input_fns) if self.has_mapped_output else 0)+(len(self.bases()) if input_fns else 0)+(len(self.input_tracks)-len(input_fns) if self.has_mapped_output else 0))#3 Running shenidam:
+                    self.notifier.set_major_text("Running shenidam")
+                    if input_fns:
+                        await self.run_shenidam_async(base,input_fns,pending_output_fns,alternative_bases)
+                    await self.run_blocking(self.store_mappings,stored)
+                    if not self.has_mapped_output:
+                        return
+                    await self.write_stored_slices_async([base]+alternative_bases,stored,output_temp_files)
+                    delete_filenames(base_temporary_fns)
+                    delete_filenames(input_transcoded_fns)
+                    await self.remix_outputs_async(output_temp_files)
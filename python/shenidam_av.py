@@ -120,6 +120,57 @@ def parse_params(model):
 	            return 1;
             model.shenidam_extra_args = unicode(argv[i].strip())
             i+=1
+        elif arg == "-ip" or arg == "--in-process":
+            model.in_process = True
+        elif arg == "-sv" or arg == "--server":
+            model.server = True
+        elif arg == "-lm" or arg == "--low-memory":
+            model.low_memory = True
+        elif arg == "-sl" or arg == "--shenidam-library":
+            if i >= argc:
+	            return 1;
+            model.shenidam_library = unicode(argv[i].strip())
+            i+=1
+        elif arg == "-fr" or arg == "--fft-planner-rigor":
+            if i >= argc:
+	            return 1;
+            model.fft_planner_rigor = int(argv[i].strip())
+            i+=1
+        elif arg == "-fw" or arg == "--fft-wisdom":
+            if i >= argc:
+	            return 1;
+            model.fft_wisdom_file = unicode(argv[i].strip())
+            i+=1
+        elif arg == "-j" or arg == "--jobs":
+            if i >= argc:
+	            return 1;
+            model.num_jobs = int(argv[i].strip())
+            i+=1
+        elif arg == "-st" or arg == "--streaming":
+            model.streaming = True
+        elif arg == "-dr" or arg == "--direct-remux":
+            model.direct_remux = True
+        elif arg == "-px" or arg == "--proxy":
+            model.proxy = True
+        elif arg == "-pw" or arg == "--proxy-window":
+            if i >= argc:
+	            return 1;
+            model.proxy_window = float(argv[i].strip())
+            i+=1
+        elif arg == "-cd" or arg == "--cache-directory":
+            if i >= argc:
+	            return 1;
+            model.cache_dir = unicode(argv[i].strip())
+            i+=1
+        elif arg == "-cs" or arg == "--cache-size":
+            if i >= argc:
+	            return 1;
+            model.cache_size = int(float(argv[i].strip())*(1<<20))
+            i+=1
+        elif arg == "-nc" or arg == "--no-cache":
+            model.cache_dir = None
+        elif arg == "-rm" or arg == "--remap":
+            model.remap = True
         elif arg == "-ntb" or arg == "--no-transcode-base":
             model.transcode_base = False
         elif arg == "-o" or arg == "--output":
@@ -132,6 +183,36 @@ def parse_params(model):
 	            return 1;
             model.base_fn = unicode(argv[i].strip())
             i+=1
+        elif arg == "-ab" or arg == "--add-base":
+            if i >= argc:
+	            return 1;
+            model.alternative_bases.append(unicode(argv[i].strip()))
+            i+=1
+        elif arg == "-fi" or arg == "--fingerprint-index":
+            if i >= argc:
+	            return 1;
+            model.fingerprint_index = unicode(argv[i].strip())
+            i+=1
+        elif arg == "-fc" or arg == "--fingerprint-candidates":
+            if i >= argc:
+	            return 1;
+            model.fingerprint_candidates = int(argv[i].strip())
+            i+=1
+        elif arg == "-tr" or arg == "--timing-report":
+            if i >= argc:
+	            return 1;
+            model.timing_report = unicode(argv[i].strip())
+            i+=1
+        elif arg == "-M" or arg == "--manifest":
+            if i >= argc:
+	            return 1;
+            model.manifest = unicode(argv[i].strip())
+            i+=1
+        elif arg == "-tdb" or arg == "--temporary-disk-budget":
+            if i >= argc:
+	            return 1;
+            model.temp_disk_budget = int(float(argv[i].strip())*(1<<20))
+            i+=1
         elif arg == "-aep" or arg == "--audio-export-params":
             if i >= argc:
 	            return 1;
@@ -150,12 +231,12 @@ def parse_params(model):
         else:
             i-=1;
             break;
-    if i == argc:
+    if i == argc and model.manifest is None:
         return 1;
     for j in range(i,argc):
         print(argv[j].strip())
         model.input_tracks.append(unicode(argv[j].strip()))
-    if audio_remix_params is None:
+    if audio_remix_params is None and not model.direct_remux:
         audio_remix_params = "-c:v copy -c:a copy" if not audio_only else "-c:a copy"
     model.output_params = [[output_pattern,audio_only,audio_remix_params]]
     return 0;
@@ -164,7 +245,9 @@ def error(string):
 def check_params(model):
     if model.quiet:
         model.verbose = False
-    if model.base_fn is None:
+    if model.manifest is not None:
+        return 0
+    if model.base_fn is None and not model.fingerprint_index:
         error("ERROR: No base defined")
         return 1;
     if len(model.input_tracks) == 0:
@@ -174,8 +257,6 @@ def check_params(model):
     if model.has_mapped_output and (op is None or len(op) == 0):
         error("ERROR: No output defined.")
         return 1;
-    if model.transcode_base is None:
-        model.transcode_base = not shenidam.Shenidam(model.shenidam).can_open(model.base_fn)
     try:
         shenidam.check_model(model)
     except shenidam.ModelException as e:
@@ -190,42 +271,140 @@ Options:
 
 -m / --output-mapping filename : output a tab-separated file containing the determined position and length of each file wrt the base track.
 
+-M / --manifest filename : run the jobs listed in the file instead of a single one. Either JSON (a list of objects with "tracks" and optionally "name", "base", "bases", "output", "audio_only", "audio_remix_params" and "mapping") or tab-separated (a JOB, BASE, TRACK and optionally OUTPUT and MAPPING header, then one track per line). Options given here are the defaults of the jobs. Jobs with the same bases are mapped in one run, all of them sharing the -j slots; -m and -tr then write the mapping and timings of all the jobs
+
+-tdb / --temporary-disk-budget megabytes : with --manifest, only start a run while the temporary files of the running ones (estimated at twice the size of their input files) fit in this size
+
+-tr / --timing-report filename : output a tab-separated file of the time (wall and CPU, in seconds) and peak buffer size of each stage of each track mapped by the shenidam executable, followed by the totals of each stage
+
 -b / --base filename : determine the base audio (or audio-visual) file (to which the tracks will be matched) MANDATORY
 
+-ab / --add-base filename : another base the tracks may belong to (can be given several times). Each track is mapped to the base it matches best
+
+-fi / --fingerprint-index filename : locate the tracks through a fingerprint index (an SQLite file, created if needed) of all the bases it holds, then align each track on its best candidates. The bases given with -b and -ab are added to the index (-b is then optional). Requires numpy
+
+-fc / --fingerprint-candidates integer : number of candidate positions from the index aligned for each track (default 3)
+
 -o / --output pattern: determine the pattern of output filenames. Patterns can include the strings {{seq}} (or {{seq/d}} where d is the minimum number of digits - which default to 0), {{file}}, {{base}}, {{ext}} (which includes the starting period) and {{dir}} MANDATORY
 
 -td / --temporary-directory : The temporary directory in which to store the extracted audio files (default is the machine's temporary directory)
 
--tb / --transcode-base or --ntb / --no-transcode-base : Force transcoding (resp. no transcoding) of the base file (default is not to transcode except for a file for which transcoding is necessary)
+-tb / --transcode-base or --ntb / --no-transcode-base : Force transcoding (resp. no transcoding) of the base files, given with -b and -ab (default is not to transcode except for a file for which transcoding is necessary)
 
 -aep / --audio-export-params quoted_param_string : parameters to pass to avconv while exporting. Requires format, and sometimes codec. (default "-c:a pcm_s24le -f wav")
 
 -arp / --audio-remix-params quoted_param_string : parameters to pass to avconv while remixing (replacing the audio from the tracks with shenidam's output). Should set at least -c:a (and -c:v if -a is not set)  (default : if -a is set "-c:a copy", otherwise "-c:v copy -c:a copy")
 
+-dr / --direct-remux : take the audio of each output straight from the base, which avconv seeks into, pads with silence and muxes in a single run, instead of writing the mapped audio of each track first. The audio is encoded: -arp should set the audio codec (default : if -a is set "", otherwise "-c:v copy", leaving avconv's default codec for the output format). Requires an avconv whose adelay filter takes delays in samples
+
+-st / --streaming : stream the audio of the tracks from avconv to shenidam through FIFOs (mono, 32-bit float AU) instead of extracting it to temporary files. Requires a platform with FIFOs.
+
+-px / --proxy : map low-rate mono proxies of the files, then refine each position on short full-rate windows and cut the slices from the base directly. Avoids extracting the whole files at full rate. Requires WAV audio export parameters.
+
+-pw / --proxy-window seconds : length of the track windows used to refine positions with --proxy (default 10)
+
+-cd / --cache-directory directory : where extracted audio and proxies are kept between runs (default {1})
+
+-cs / --cache-size megabytes : size above which the least recently used cache entries are removed (default 2048)
+
+-nc / --no-cache : do not use the cache. The cache directory also keeps the positions found for each base and track, reused unless the files, -s or -rq change, and which files shenidam can open and which tools run, checked again when the files or tools change
+
+-rm / --remap : map all the tracks again instead of reusing stored positions
+
+-j / --jobs integer : number of avconv extractions / remixes run at the same time (default 1)
+
 -sp / --shenidam-params quoted_param_string : extra parameters to pass to shenidam
 
 -se / --shenidam-executable command: the shenidam executable / command
 
 -ae / --avconv-executable command: the avconv executable / command
 
-""".format(sys.argv[0]))
+-ip / --in-process : map the tracks inside this process through libshenidam instead of running the shenidam executable (audio is decoded through avconv pipes, -sp options -s, -rq and -T are honoured)
+
+-lm / --low-memory : keep only a low sample rate copy of the base in memory, reading the full rate audio from disk when refining positions
+
+-sv / --server : map the tracks through one shenidam process in server mode, which loads the base once, instead of the usual one-shot run
+
+-fr / --fft-planner-rigor [0-2] : FFTW planner rigor (0 estimate, 1 measure, 2 patient). Higher plans take longer to create and run faster, best used with --fft-wisdom
+
+-fw / --fft-wisdom filename : FFTW wisdom file, loaded if it exists and updated after each run
+
+-sl / --shenidam-library path : the shenidam shared library to use with --in-process (default is to look up libshenidam)
+
+""".format(sys.argv[0],shenidam.default_cache_dir()))
 
+def write_mapping(filename,tracks,mapping,bases=None):
+    # bases are the bases of the tracks, only written when given. Tracks that could not be mapped are left out.
+    with open(filename,'w') as f:
+        if bases is not None:
+            f.write("FILE\tBASE\tIN\tLENGTH\n")
+            for track,base,x in zip(tracks,bases,mapping):
+                if x is None:
+                    continue
+                f.write("{0}\t{1}\t{2}\t{3}\n".format(track,base,x["determined_in"],x["determined_length"]))
+        else:
+            f.write("FILE\tIN\tLENGTH\n")
+            for track,x in zip(tracks,mapping):
+                if x is None:
+                    continue
+                f.write("{0}\t{1}\t{2}\n".format(track,x["determined_in"],x["determined_length"]))
+def write_timing_report(filename,performance):
+    with open(filename,'w') as f:
+        f.write("FILE\tSTAGE\tWALL_TIME\tCPU_TIME\tPEAK_BYTES\n")
+        for x in performance:
+            f.write("{0}\t{1}\t{2}\t{3}\t{4}\n".format(x["file"],x["stage"],x["wall_time"],x["cpu_time"],x["peak_bytes"]))
+        for x in shenidam.performance_totals(performance):
+            f.write("TOTAL ({0} tracks)\t{1}\t{2}\t{3}\t{4}\n".format(x["tracks"],x["stage"],x["wall_time"],x["cpu_time"],x["peak_bytes"]))
 def save_mapping(processor):
     if processor.output_mapping:
-        with open(processor.output_mapping,'w') as f:
-            f.write("FILE\tIN\tLENGTH\n")
-            for filename,x in zip(processor.input_tracks,processor.mapping):
-                f.write("{0}\t{1}\t{2}\n".format(filename,x["determined_in"],x["determined_length"]))
+        bases = None
+        if processor.alternative_bases or processor.fingerprint_index is not None:
+            bases = [processor.mapped_base(x) if x is not None else None for x in processor.mapping]
+        write_mapping(processor.output_mapping,processor.input_tracks,processor.mapping,bases)
+def save_timing_report(processor):
+    if processor.timing_report:
+        write_timing_report(processor.timing_report,processor.performance)
+def run_manifest(model):
+    try:
+        jobs = shenidam.load_manifest(model.manifest,model)
+        shenidam.check_model_tools(model)
+        for x in (model.output_mapping,model.timing_report):
+            if x:
+                shenidam.check_file_write(x)
+    except shenidam.ModelException as e:
+        error("ERROR: "+unicode(e))
+        return 1
+    shenidam.BatchScheduler(jobs,model,shenidam.StreamNotifier(sys.stderr)).run()
+    for job in jobs:
+        if job.error is not None:
+            error("ERROR: job '{0}': {1}".format(job.name,unicode(job.error)))
+        elif job.output_mapping:
+            write_mapping(job.output_mapping,job.input_tracks,job.mapping,[x["base"] for x in job.mapping] if job.alternative_bases or model.fingerprint_index else None)
+    done = [job for job in jobs if job.error is None]
+    if model.output_mapping:
+        with open(model.output_mapping,'w') as f:
+            f.write("JOB\tFILE\tBASE\tIN\tLENGTH\n")
+            for job in done:
+                for track,x in zip(job.input_tracks,job.mapping):
+                    f.write("{0}\t{1}\t{2}\t{3}\t{4}\n".format(job.name,track,x["base"],x["determined_in"],x["determined_length"]))
+    if model.timing_report:
+        write_timing_report(model.timing_report,[x for job in done for x in job.performance])
+    return 0 if len(done) == len(jobs) else 1
 def main():
     model = shenidam.FileProcessorModel()
     if (parse_params(model) or check_params(model)):
         usage()
         return 1;
-    
+    if model.manifest is not None:
+        return run_manifest(model)
     processor = shenidam.ShenidamFileProcessor(model,shenidam.StreamNotifier(sys.stderr))
     processor.convert()
     save_mapping(processor)
-    return 0
+    save_timing_report(processor)
+    unmapped = [x for x,y in zip(processor.input_tracks,processor.mapping) if y is None]
+    for x in unmapped:
+        error("ERROR: Track '{0}' could not be mapped".format(x))
+    return 1 if unmapped else 0
 
 if __name__ == "__main__":
     sys.exit(main())
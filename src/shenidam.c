@@ -18,16 +18,24 @@
 
  */
 
+#define _POSIX_C_SOURCE 200809L
 #include <complex.h>
 #include <stdlib.h>
 #include <stdio.h>
 #include <string.h>
 #include <math.h>
+#include <unistd.h>
+#include <pthread.h>
+#include <time.h>
 #include "shenidam.h"
+#include "shenidam_kernels.h"
 #include "fftw3.h"
 #include "float.h"
 #include "samplerate.h"
 #include "config.h"
+#ifdef _OPENMP
+#include <omp.h>
+#endif
 
 
 inline intmax_t max(intmax_t a, intmax_t b)
@@ -47,23 +55,94 @@ typedef fftwf_plan FFT_PLAN;
 #define FFT_BACKWARD fftwf_plan_dft_c2r_1d
 #define FFT_MALLOC fftwf_malloc
 #define FFT_FREE fftwf_free
-#define FFT_EXECUTE fftwf_execute
+#define FFT_EXECUTE_FORWARD fftwf_execute_dft_r2c
+#define FFT_EXECUTE_BACKWARD fftwf_execute_dft_c2r
 #define FFT_DESTROY_PLAN fftwf_destroy_plan
 
+enum
+{
+	FFT_DIRECTION_FORWARD,
+	FFT_DIRECTION_BACKWARD
+};
+
+static const unsigned planner_flags[] = {FFTW_ESTIMATE, FFTW_MEASURE, FFTW_PATIENT};
+
+typedef struct fft_plan_t
+{
+	size_t size;
+	int direction;
+	FFT_PLAN plan;
+	struct fft_plan_t* next;
+} fft_plan_t;
+
+typedef struct base_spectrum_t
+{
+	size_t size;
+	sample_f* spectrum;
+	int users; /* correlations using the spectrum, which is not freed meanwhile */
+	struct base_spectrum_t* next;
+} base_spectrum_t;
 
+/* The spectra kept per base once not in use, the most recently used ones. */
+#define MAX_BASE_SPECTRA 2
+
+typedef struct
+{
+	double sample_rate;
+	sample_d* working;
+	sample_d* fullres; /* NULL when the full rate samples are read on demand */
+	size_t num_samples_working;
+	size_t num_samples_fullres;
+	base_spectrum_t* spectra;
+	shenidam_read_callback read;
+	void* read_data;
+	double mean; /* normalization of the samples read on demand */
+	double scale;
+} base_t;
+
+/* Buffers kept from one track to the next (they only grow), so that matching does not allocate once warmed up. */
+typedef struct workspace_t
+{
+	sample_d* converted; /* the track samples as floats, before resampling */
+	size_t converted_size;
+	sample_d* track; /* the padded track, transformed in place */
+	size_t track_size;
+	sample_d* correlation; /* the product of the spectra, transformed back in place */
+	size_t correlation_size;
+	sample_d* base; /* a window or block of the base, transformed in place */
+	size_t base_size;
+	struct workspace_t* next;
+} workspace_t;
 
 typedef struct
 {
 	double working_sample_rate;
-	double base_sample_rate;
-	sample_d* base_working;
-	sample_d* base_fullres;
-	size_t base_num_samples_working;
-	size_t base_num_samples_fullres;
+	base_t* bases; /* the first one is the base set by shenidam_set_base_audio */
+	int num_bases;
 	int num_threads;
 	int src_converter;
+	fft_plan_t* plans;
+	int planner_rigor;
+	int fft_sizes;
+	size_t block_size; /* in working rate samples, 0 for a single transform */
+	workspace_t* workspaces; /* not in use */
+	int timings; /* whether the stages are timed */
+	pthread_mutex_t lock; /* guards the spectra of the bases and the workspaces */
+	pthread_mutex_t read_lock; /* serializes the read callbacks */
 } shenidam_t_impl ;
 
+/* FFTW's planner (and wisdom) is global and not thread-safe, executing plans is. */
+static pthread_mutex_t planner_lock = PTHREAD_MUTEX_INITIALIZER;
+
+/* The stage timings of the last matching call of each thread. */
+static __thread shenidam_stage_timing_t last_timings[NUM_STAGES];
+
+typedef struct
+{
+	double wall_time;
+	double cpu_time;
+} stage_clock_t;
+
 
 
 
@@ -79,6 +158,10 @@ const char* shenidam_get_error_message(int error)
 		return "Base signal not set";
 	case (NULL_OBJECT):
 		return "NULL shenidam object";
+	case (IO_ERROR):
+		return "Could not read or write file";
+	case (ALLOCATION_ERROR):
+		return "Could not allocate memory";
 	}
 	return "Unknown error";
 }
@@ -112,88 +195,118 @@ static void fft_ehfree(void* pointer)
 {
 	FFT_FREE(pointer);
 }
-static void normalize(sample_d* samples,size_t num_samples_d)
+static void get_normalization(double sum,double sum_sq,size_t num_samples_d,double* mean,double* scale)
 {
-	double mean = 0;
-	double var = 0;
-	
-	for(size_t i = 0; i < num_samples_d; i++)
+	*mean = sum / num_samples_d;
+	*scale = sqrt(sum_sq-(*mean)*(*mean));
+	if (*scale == 0)
 	{
-		mean += samples[i];
-		var += samples[i]*samples[i];
+		*scale = 1;
 	}
-	mean /= num_samples_d;;
-	var = sqrt(var-mean*mean);
-	if (var == 0)
+}
+static void apply_normalization(sample_d* samples,size_t num_samples_d,double mean,double scale)
+{
+	shenidam_best_kernels()->normalize(samples,num_samples_d,mean,1/scale);
+}
+static void normalize(sample_d* samples,size_t num_samples_d)
+{
+	double sum,sum_sq;
+	shenidam_best_kernels()->sum(samples,num_samples_d,&sum,&sum_sq);
+	double mean,scale;
+	get_normalization(sum,sum_sq,num_samples_d,&mean,&scale);
+	apply_normalization(samples,num_samples_d,mean,scale);
+}
+/* The size in bytes of a buffer transformed in place at size: the real samples, padded to hold the spectrum. */
+static size_t transform_buffer_size(size_t size)
+{
+	return sizeof(sample_f)*(size/2 + 1);
+}
+static FFT_PLAN get_plan_unlocked(shenidam_t_impl* impl,size_t size,int direction)
+{
+	for (fft_plan_t* cur = impl->plans; cur != NULL; cur = cur->next)
 	{
-		for(size_t i = 0; i < num_samples_d; i++)
+		if (cur->size == size && cur->direction == direction)
 		{
-			samples[i]=(samples[i]-mean);
+			return cur->plan;
 		}
 	}
-	else
+	fft_plan_t* entry = (fft_plan_t*)ehmalloc(sizeof(fft_plan_t));
+	sample_d* buffer = fft_ehmalloc(transform_buffer_size(size));
+	FFT_PLAN plan = NULL;
+	if (entry != NULL && buffer != NULL)
 	{
-		for(size_t i = 0; i < num_samples_d; i++)
+#ifdef SHENIDAM_FFT_THREADED
+		fftwf_plan_with_nthreads(impl->num_threads);
+#endif
+		/* Planning may overwrite the buffer, the (in place) plan is then executed on the caller's buffers. */
+		if (direction == FFT_DIRECTION_FORWARD)
+		{
+			plan = FFT_FORWARD(size,buffer,(sample_f*)buffer,planner_flags[impl->planner_rigor]);
+		}
+		else
 		{
-			samples[i]=(samples[i]-mean)/var;
+			plan = FFT_BACKWARD(size,(sample_f*)buffer,buffer,planner_flags[impl->planner_rigor]);
 		}
 	}
+	fft_ehfree(buffer);
+	if (plan == NULL)
+	{
+		ehfree(entry);
+		return NULL;
+	}
+	entry->size = size;
+	entry->direction = direction;
+	entry->plan = plan;
+	entry->next = impl->plans;
+	impl->plans = entry;
+	return plan;
 }
-static sample_f* fft(sample_d* samples_d,size_t num_samples_d,int num_threads)
-{
 
-	size_t num_samples_f = num_samples_d/2 + 1;
-	sample_f* samples_f = ehmalloc(sizeof(sample_f)*num_samples_f);
-	sample_d* buffer_d = fft_ehmalloc(sizeof(sample_d)*num_samples_d);
-	sample_f* buffer_f = fft_ehmalloc(sizeof(sample_f)*num_samples_f);
-#ifdef SHENIDAM_FFT_THREADED
-    if (num_threads)
-    {
-        fftwf_plan_with_nthreads(num_threads);
-    }
-#endif
-	FFT_PLAN plan = FFT_FORWARD(num_samples_d,buffer_d,buffer_f,FFTW_ESTIMATE);
-	memcpy(buffer_d,samples_d,sizeof(sample_d)*num_samples_d);
-	FFT_EXECUTE(plan);
-	FFT_DESTROY_PLAN(plan);
-	memcpy(samples_f,buffer_f,sizeof(sample_f)*num_samples_f);
-
-	fft_ehfree(buffer_d);
-	fft_ehfree(buffer_f);
-	return samples_f;
+static FFT_PLAN get_plan(shenidam_t_impl* impl,size_t size,int direction)
+{
+	pthread_mutex_lock(&planner_lock);
+	FFT_PLAN plan = get_plan_unlocked(impl,size,direction);
+	pthread_mutex_unlock(&planner_lock);
+	return plan;
 }
 
-static sample_d* ifft(sample_f* samples_f,size_t num_samples_d,int num_threads)
+static void free_plans(shenidam_t_impl* impl)
 {
+	pthread_mutex_lock(&planner_lock);
+	fft_plan_t* cur = impl->plans;
+	while (cur != NULL)
+	{
+		fft_plan_t* next = cur->next;
+		FFT_DESTROY_PLAN(cur->plan);
+		ehfree(cur);
+		cur = next;
+	}
+	impl->plans = NULL;
+	pthread_mutex_unlock(&planner_lock);
+}
 
-	size_t num_samples_f = num_samples_d/2 + 1;
-	sample_d* samples_d = ehmalloc(sizeof(sample_d)*num_samples_d);
-	sample_d* buffer_d = fft_ehmalloc(sizeof(sample_d)*num_samples_d);
-	sample_f* buffer_f = fft_ehmalloc(sizeof(sample_f)*num_samples_f);
-#ifdef SHENIDAM_FFT_THREADED
-    if (num_threads)
-    {
-        fftwf_plan_with_nthreads(num_threads);
-    }
-#endif
-	FFT_PLAN plan = FFT_BACKWARD(num_samples_d,buffer_f,buffer_d,FFTW_ESTIMATE);
-	memcpy(buffer_f,samples_f,sizeof(sample_f)*num_samples_f);
-	FFT_EXECUTE(plan);
-	FFT_DESTROY_PLAN(plan);
-	memcpy(samples_d,buffer_d,sizeof(sample_d)*num_samples_d);
-
-	fft_ehfree(buffer_d);
-	fft_ehfree(buffer_f);
-	return samples_d;
+/* buffer must come from fft_ehmalloc and hold transform_buffer_size(size) bytes, it receives the spectrum. */
+static int fft(shenidam_t_impl* impl,sample_d* buffer,size_t size)
+{
+	FFT_PLAN plan = get_plan(impl,size,FFT_DIRECTION_FORWARD);
+	if (plan == NULL)
+	{
+		return ALLOCATION_ERROR;
+	}
+	FFT_EXECUTE_FORWARD(plan,buffer,(sample_f*)buffer);
+	return SUCCESS;
 }
 
-static sample_d* resize(sample_d* samples_in, size_t num_samples_in,size_t num_samples_out)
+/* buffer must come from fft_ehmalloc and hold transform_buffer_size(size) bytes, it receives the size real samples. */
+static int ifft(shenidam_t_impl* impl,sample_f* buffer,size_t size)
 {
-	sample_d* res = (sample_d*)ehmalloc(sizeof(sample_d)*num_samples_out);
-	memset(res,0,sizeof(sample_d)*num_samples_out);
-	int min_num_samples = num_samples_out< num_samples_in?num_samples_out:num_samples_in;
-	memcpy(res,samples_in,min_num_samples*sizeof(sample_d));
-	return res;
+	FFT_PLAN plan = get_plan(impl,size,FFT_DIRECTION_BACKWARD);
+	if (plan == NULL)
+	{
+		return ALLOCATION_ERROR;
+	}
+	FFT_EXECUTE_BACKWARD(plan,buffer,(sample_d*)buffer);
+	return SUCCESS;
 }
 
 static sample_f* resize_f(sample_f* samples_in, size_t num_samples_in,size_t num_samples_out)
@@ -215,10 +328,8 @@ typedef union
 	double* double_ptr;
 } polymorph_ptr;
 
-static int convert_to_samples(int format,void* samples_in,size_t num_samples,sample_d** samples_out)
+static int convert_samples(int format,void* samples_in,size_t num_samples,sample_d* s_out)
 {
-	*samples_out = (sample_d*) ehmalloc(sizeof(sample_d)*num_samples);
-	sample_d* s_out = *samples_out;
     if (format == FORMAT_SINGLE)
     {
         memcpy(s_out,samples_in,sizeof(sample_d)*num_samples);
@@ -235,27 +346,47 @@ static int convert_to_samples(int format,void* samples_in,size_t num_samples,sam
 		PROCESS_TYPE_F(FORMAT_LONG_LONG,long long,long_long_ptr)
 		PROCESS_TYPE_F(FORMAT_DOUBLE,double,double_ptr)
 	default:
-		free(s_out);
 		return 1;
 	}
 	return 0;
 }
 
-static sample_d* resample(sample_d* samples_in,size_t num_samples_in,double sample_rate_ratio, size_t *num_samples_out, int num_threads, int src_converter)
+static int convert_to_samples(int format,void* samples_in,size_t num_samples,sample_d** samples_out)
+{
+	*samples_out = (sample_d*) ehmalloc(sizeof(sample_d)*num_samples);
+	if (*samples_out == NULL)
+	{
+		return 1;
+	}
+	if (convert_samples(format,samples_in,num_samples,*samples_out))
+	{
+		ehfree(*samples_out);
+		return 1;
+	}
+	return 0;
+}
+
+/* Resamples into samples_out, which holds max_num_samples_out samples, and returns the number of samples written. */
+static size_t resample_into(sample_d* samples_in,size_t num_samples_in,double sample_rate_ratio,sample_d* samples_out,size_t max_num_samples_out,int src_converter)
 {
 	SRC_DATA src_data;
 	src_data.data_in = samples_in;
-	src_data.data_out = ehmalloc(*num_samples_out*sizeof(sample_d));
+	src_data.data_out = samples_out;
 	src_data.input_frames = num_samples_in;
-	src_data.output_frames = *num_samples_out;
+	src_data.output_frames = max_num_samples_out;
 	src_data.src_ratio = sample_rate_ratio;
 	src_simple(&src_data,src_converter,1);
-	*num_samples_out = src_data.output_frames_gen;
-	return src_data.data_out;
+	return src_data.output_frames_gen;
 }
-static size_t get_common_size(size_t minimal_size)
+static sample_d* resample(sample_d* samples_in,size_t num_samples_in,double sample_rate_ratio, size_t *num_samples_out, int num_threads, int src_converter)
 {
-	size_t res = 1;
+	sample_d* samples_out = ehmalloc(*num_samples_out*sizeof(sample_d));
+	*num_samples_out = resample_into(samples_in,num_samples_in,sample_rate_ratio,samples_out,*num_samples_out,src_converter);
+	return samples_out;
+}
+static size_t next_power_of_two(size_t minimal_size)
+{
+	size_t res = 2;
 	while(res < minimal_size)
 	{
 		res<<=1;
@@ -263,6 +394,216 @@ static size_t get_common_size(size_t minimal_size)
 	return res;
 }
 
+/*
+ * The transform size for at least minimal_size samples: the next power of two, or the smallest of 2^k, 5*2^k/8,
+ * 3*2^k/4 and 7*2^k/8 (smooth sizes, for which FFTW is about as fast as for powers of two). At most four sizes per
+ * octave, so that tracks of different lengths share their plans and base spectra.
+ */
+static size_t get_common_size(shenidam_t_impl* impl,size_t minimal_size)
+{
+	size_t res = next_power_of_two(minimal_size);
+	if (impl->fft_sizes == FFT_SIZES_POWER_OF_TWO || res < 16)
+	{
+		return res;
+	}
+	for (size_t eighths = 5; eighths < 8; eighths++)
+	{
+		if (res/8*eighths >= minimal_size)
+		{
+			return res/8*eighths;
+		}
+	}
+	return res;
+}
+
+/*
+ * The smallest size of the spectra cached for all the bases in [first_base, first_base + num_bases) between
+ * minimal_size and max_size, or 0 if there is none.
+ */
+static size_t get_cached_size(shenidam_t_impl* impl,int first_base,int num_bases,size_t minimal_size,size_t max_size)
+{
+	size_t res = 0;
+	pthread_mutex_lock(&impl->lock);
+	for (base_spectrum_t* cur = impl->bases[first_base].spectra; cur != NULL; cur = cur->next)
+	{
+		if (cur->size < minimal_size || cur->size > max_size || (res != 0 && cur->size >= res))
+		{
+			continue;
+		}
+		int cached = 1;
+		for (int b = first_base + 1; b < first_base + num_bases && cached; b++)
+		{
+			cached = 0;
+			for (base_spectrum_t* other = impl->bases[b].spectra; other != NULL && !cached; other = other->next)
+			{
+				cached = other->size == cur->size;
+			}
+		}
+		if (cached)
+		{
+			res = cur->size;
+		}
+	}
+	pthread_mutex_unlock(&impl->lock);
+	return res;
+}
+
+/* Frees the spectra of the base past the MAX_BASE_SPECTRA most recently used ones that are not in use, under impl->lock. */
+static void trim_base_spectra(base_t* base)
+{
+	int kept = 0;
+	base_spectrum_t** link = &base->spectra;
+	while (*link != NULL)
+	{
+		base_spectrum_t* cur = *link;
+		if (kept < MAX_BASE_SPECTRA || cur->users > 0)
+		{
+			kept++;
+			link = &cur->next;
+			continue;
+		}
+		*link = cur->next;
+		fft_ehfree(cur->spectrum);
+		ehfree(cur);
+	}
+}
+
+static base_spectrum_t* get_base_spectrum_unlocked(shenidam_t_impl* impl,base_t* base,size_t common_size)
+{
+	for (base_spectrum_t** link = &base->spectra; *link != NULL; link = &(*link)->next)
+	{
+		base_spectrum_t* cur = *link;
+		if (cur->size == common_size)
+		{
+			*link = cur->next;
+			cur->next = base->spectra;
+			base->spectra = cur;
+			cur->users++;
+			return cur;
+		}
+	}
+	base_spectrum_t* entry = (base_spectrum_t*)ehmalloc(sizeof(base_spectrum_t));
+	if (entry == NULL)
+	{
+		return NULL;
+	}
+	sample_d* samples = fft_ehmalloc(transform_buffer_size(common_size));
+	if (samples != NULL)
+	{
+		size_t num_samples = min(base->num_samples_working,common_size);
+		memcpy(samples,base->working,sizeof(sample_d)*num_samples);
+		memset(samples+num_samples,0,transform_buffer_size(common_size)-sizeof(sample_d)*num_samples);
+	}
+	if (samples == NULL || fft(impl,samples,common_size))
+	{
+		fft_ehfree(samples);
+		ehfree(entry);
+		return NULL;
+	}
+	entry->spectrum = (sample_f*)samples;
+	entry->size = common_size;
+	entry->users = 1;
+	entry->next = base->spectra;
+	base->spectra = entry;
+	trim_base_spectra(base);
+	return entry;
+}
+
+/* The spectrum of the base at common_size, in use until given back with release_base_spectrum. */
+static base_spectrum_t* get_base_spectrum(shenidam_t_impl* impl,base_t* base,size_t common_size)
+{
+	pthread_mutex_lock(&impl->lock);
+	base_spectrum_t* spectrum = get_base_spectrum_unlocked(impl,base,common_size);
+	pthread_mutex_unlock(&impl->lock);
+	return spectrum;
+}
+
+static void release_base_spectrum(shenidam_t_impl* impl,base_t* base,base_spectrum_t* spectrum)
+{
+	pthread_mutex_lock(&impl->lock);
+	spectrum->users--;
+	trim_base_spectra(base);
+	pthread_mutex_unlock(&impl->lock);
+}
+
+/* Makes *buffer (from fft_ehmalloc) hold at least size bytes, without keeping its contents. */
+static int reserve(sample_d** buffer,size_t* capacity,size_t size)
+{
+	if (*capacity >= size)
+	{
+		return SUCCESS;
+	}
+	fft_ehfree(*buffer);
+	*buffer = fft_ehmalloc(size);
+	*capacity = *buffer != NULL ? size : 0;
+	return *buffer != NULL ? SUCCESS : ALLOCATION_ERROR;
+}
+
+/* A workspace for the calling thread, to be given back with release_workspace. */
+static workspace_t* acquire_workspace(shenidam_t_impl* impl)
+{
+	pthread_mutex_lock(&impl->lock);
+	workspace_t* workspace = impl->workspaces;
+	if (workspace != NULL)
+	{
+		impl->workspaces = workspace->next;
+	}
+	pthread_mutex_unlock(&impl->lock);
+	if (workspace == NULL)
+	{
+		workspace = (workspace_t*)ehmalloc(sizeof(workspace_t));
+		if (workspace != NULL)
+		{
+			memset(workspace,0,sizeof(workspace_t));
+		}
+	}
+	return workspace;
+}
+
+static void release_workspace(shenidam_t_impl* impl,workspace_t* workspace)
+{
+	pthread_mutex_lock(&impl->lock);
+	workspace->next = impl->workspaces;
+	impl->workspaces = workspace;
+	pthread_mutex_unlock(&impl->lock);
+}
+
+static void free_workspaces(shenidam_t_impl* impl)
+{
+	workspace_t* cur = impl->workspaces;
+	while (cur != NULL)
+	{
+		workspace_t* next = cur->next;
+		fft_ehfree(cur->converted);
+		fft_ehfree(cur->track);
+		fft_ehfree(cur->correlation);
+		fft_ehfree(cur->base);
+		ehfree(cur);
+		cur = next;
+	}
+	impl->workspaces = NULL;
+}
+
+static void free_bases(shenidam_t_impl* impl)
+{
+	for (int i = 0; i < impl->num_bases; i++)
+	{
+		base_spectrum_t* cur = impl->bases[i].spectra;
+		while (cur != NULL)
+		{
+			base_spectrum_t* next = cur->next;
+			fft_ehfree(cur->spectrum);
+			ehfree(cur);
+			cur = next;
+		}
+		ehfree(impl->bases[i].working);
+		ehfree(impl->bases[i].fullres);
+	}
+	ehfree(impl->bases);
+	impl->bases = NULL;
+	impl->num_bases = 0;
+}
+
 shenidam_t shenidam_create(double base_sample_rate,int num_threads)
 {
     if (num_threads <= 1)
@@ -278,8 +619,16 @@ shenidam_t shenidam_create(double base_sample_rate,int num_threads)
 	}
 	
 	shenidam_t_impl* res = (shenidam_t_impl*)malloc(sizeof(shenidam_t_impl));
-	res->base_working = NULL;
-	res->base_fullres = NULL;
+	res->bases = NULL;
+	res->num_bases = 0;
+	res->plans = NULL;
+	res->planner_rigor = PLANNER_ESTIMATE;
+	res->fft_sizes = FFT_SIZES_SMOOTH;
+	res->block_size = 0;
+	res->workspaces = NULL;
+	res->timings = 0;
+	pthread_mutex_init(&res->lock,NULL);
+	pthread_mutex_init(&res->read_lock,NULL);
 	res->working_sample_rate = base_sample_rate;
 	res->num_threads = num_threads;
 	res->src_converter = SRC_SINC_FASTEST;
@@ -297,8 +646,138 @@ int shenidam_set_resampling_quality(shenidam_t shenidam_obj,int src_converter)
 		return INVALID_ARGUMENT;
 	}
 	impl->src_converter = src_converter;
+	return SUCCESS;
+}
+int shenidam_set_planner_rigor(shenidam_t shenidam_obj,int rigor)
+{
+	if (shenidam_obj == NULL)
+	{
+		return NULL_OBJECT;
+	}
+	shenidam_t_impl* impl =((shenidam_t_impl*)shenidam_obj);
+	if (rigor < PLANNER_ESTIMATE || rigor > PLANNER_PATIENT)
+	{
+		return INVALID_ARGUMENT;
+	}
+	if (rigor != impl->planner_rigor)
+	{
+		free_plans(impl);
+		impl->planner_rigor = rigor;
+	}
+	return SUCCESS;
+}
+int shenidam_set_fft_sizes(shenidam_t shenidam_obj,int fft_sizes)
+{
+	if (shenidam_obj == NULL)
+	{
+		return NULL_OBJECT;
+	}
+	shenidam_t_impl* impl =((shenidam_t_impl*)shenidam_obj);
+	if (fft_sizes != FFT_SIZES_SMOOTH && fft_sizes != FFT_SIZES_POWER_OF_TWO)
+	{
+		return INVALID_ARGUMENT;
+	}
+	impl->fft_sizes = fft_sizes;
+	return SUCCESS;
+}
+int shenidam_set_block_size(shenidam_t shenidam_obj,double block_length)
+{
+	if (shenidam_obj == NULL)
+	{
+		return NULL_OBJECT;
+	}
+	shenidam_t_impl* impl =((shenidam_t_impl*)shenidam_obj);
+	if (block_length < 0)
+	{
+		return INVALID_ARGUMENT;
+	}
+	impl->block_size = (size_t)ceil(block_length*impl->working_sample_rate);
+	return SUCCESS;
+}
+int shenidam_set_timings(shenidam_t shenidam_obj,int enabled)
+{
+	if (shenidam_obj == NULL)
+	{
+		return NULL_OBJECT;
+	}
+	((shenidam_t_impl*)shenidam_obj)->timings = enabled != 0;
+	return SUCCESS;
+}
+int shenidam_get_timings(shenidam_t shenidam_obj,shenidam_stage_timing_t* timings)
+{
+	if (shenidam_obj == NULL)
+	{
+		return NULL_OBJECT;
+	}
+	if (timings == NULL)
+	{
+		return INVALID_ARGUMENT;
+	}
+	memcpy(timings,last_timings,sizeof(last_timings));
+	return SUCCESS;
+}
+int shenidam_import_wisdom(const char* filename)
+{
+	if (filename == NULL)
+	{
+		return INVALID_ARGUMENT;
+	}
+	pthread_mutex_lock(&planner_lock);
+	int imported = fftwf_import_wisdom_from_filename(filename);
+	pthread_mutex_unlock(&planner_lock);
+	return imported ? SUCCESS : IO_ERROR;
+}
+int shenidam_export_wisdom(const char* filename)
+{
+	if (filename == NULL)
+	{
+		return INVALID_ARGUMENT;
+	}
+	/* Write next to the target and rename, so that concurrent runs never see a partial file. */
+	size_t length = strlen(filename);
+	char* temp_filename = ehmalloc(length + 8);
+	if (temp_filename == NULL)
+	{
+		return ALLOCATION_ERROR;
+	}
+	sprintf(temp_filename,"%s.XXXXXX",filename);
+	int fd = mkstemp(temp_filename);
+	FILE* f = fd < 0 ? NULL : fdopen(fd,"w");
+	int res = IO_ERROR;
+	if (f != NULL)
+	{
+		pthread_mutex_lock(&planner_lock);
+		fftwf_export_wisdom_to_file(f);
+		pthread_mutex_unlock(&planner_lock);
+		if (!fclose(f) && !rename(temp_filename,filename))
+		{
+			res = SUCCESS;
+		}
+	}
+	else if (fd >= 0)
+	{
+		close(fd);
+	}
+	if (res != SUCCESS && fd >= 0)
+	{
+		remove(temp_filename);
+	}
+	ehfree(temp_filename);
+	return res;
 }
 int shenidam_set_base_audio(shenidam_t shenidam_obj,int format, void* samples,size_t num_samples,double sample_rate)
+{
+	if (shenidam_obj == NULL)
+	{
+		return NULL_OBJECT;
+	}
+	if (((shenidam_t_impl*)shenidam_obj)->num_bases)
+	{
+		return ALREADY_SET_BASE_SIGNAL;
+	}
+	return shenidam_add_base_audio(shenidam_obj,format,samples,num_samples,sample_rate,NULL);
+}
+int shenidam_add_base_audio(shenidam_t shenidam_obj,int format, void* samples,size_t num_samples,double sample_rate,int* base_index)
 {
 	if (shenidam_obj == NULL)
 	{
@@ -306,133 +785,324 @@ int shenidam_set_base_audio(shenidam_t shenidam_obj,int format, void* samples,si
 	}
 	sample_d* base,*temp;
 	shenidam_t_impl* impl =((shenidam_t_impl*)shenidam_obj);
-
-	if (impl->base_working!=NULL)
+	if (sample_rate <= 0 || num_samples == 0)
 	{
-		return ALREADY_SET_BASE_SIGNAL;
+		return INVALID_ARGUMENT;
 	}
+	base_t* bases = (base_t*)realloc(impl->bases,(impl->num_bases+1)*sizeof(base_t));
+	if (bases == NULL)
+	{
+		return ALLOCATION_ERROR;
+	}
+	impl->bases = bases;
 	if (convert_to_samples(format, samples, num_samples,&base))
 	{
 		return INVALID_ARGUMENT;
 	}
+	base_t* entry = &impl->bases[impl->num_bases];
 	normalize(base,num_samples);
-	impl->base_fullres = malloc(num_samples*sizeof(sample_d));
-	memcpy(impl->base_fullres,base,num_samples*sizeof(sample_d));
+	entry->fullres = malloc(num_samples*sizeof(sample_d));
+	memcpy(entry->fullres,base,num_samples*sizeof(sample_d));
 
-	impl->base_num_samples_fullres = num_samples;
+	entry->num_samples_fullres = num_samples;
 	size_t num_samples_new = (size_t)round(num_samples * impl->working_sample_rate/sample_rate);
 	temp = resample(base,num_samples,impl->working_sample_rate/sample_rate,&num_samples_new,impl->num_threads,impl->src_converter);
 	ehfree(base);
 	base = temp;
-	impl->base_num_samples_working = num_samples_new;
-
-	impl->base_working = base;
-	impl->base_sample_rate = sample_rate;
+	entry->num_samples_working = num_samples_new;
 
+	entry->working = base;
+	entry->sample_rate = sample_rate;
+	entry->spectra = NULL;
+	entry->read = NULL;
+	entry->read_data = NULL;
+	if (base_index != NULL)
+	{
+		*base_index = impl->num_bases;
+	}
+	impl->num_bases++;
 	return SUCCESS;
 }
 
-int shenidam_refine_audio_range(shenidam_t shenidam_obj,int input_format,void* samples,size_t track_num_samples,double track_sample_rate, intmax_t *in_point)
+/* Number of base samples read at once by shenidam_add_base_audio_callback. */
+#define BASE_READ_BLOCK 65536
+
+int shenidam_add_base_audio_callback(shenidam_t shenidam_obj,shenidam_read_callback read,void* read_data,size_t num_samples,double sample_rate,int* base_index)
 {
 	if (shenidam_obj == NULL)
 	{
 		return NULL_OBJECT;
 	}
 	shenidam_t_impl* impl =((shenidam_t_impl*)shenidam_obj);
+	if (read == NULL || sample_rate <= 0 || num_samples == 0)
+	{
+		return INVALID_ARGUMENT;
+	}
+	double sample_rate_ratio = impl->working_sample_rate/sample_rate;
+	size_t capacity = (size_t)ceil(num_samples*sample_rate_ratio) + 1;
+	sample_d* working = ehmalloc(sizeof(sample_d)*capacity);
+	sample_d* block = ehmalloc(sizeof(sample_d)*BASE_READ_BLOCK);
+	int error;
+	SRC_STATE* src = src_new(impl->src_converter,1,&error);
+	if (working == NULL || block == NULL || src == NULL)
+	{
+		ehfree(working);
+		ehfree(block);
+		if (src != NULL)
+		{
+			src_delete(src);
+		}
+		return ALLOCATION_ERROR;
+	}
+	/* Decimated block by block: only the working rate signal is kept. */
+	double sum = 0;
+	double sum_sq = 0;
+	size_t num_read = 0;
+	size_t num_samples_working = 0;
+	int end_of_input = 0;
+	error = SUCCESS;
+	while (!end_of_input)
+	{
+		size_t wanted = min(BASE_READ_BLOCK,num_samples - num_read);
+		size_t got = wanted > 0 ? read(read_data,num_read,block,wanted) : 0;
+		double block_sum,block_sum_sq;
+		shenidam_best_kernels()->sum(block,got,&block_sum,&block_sum_sq);
+		sum += block_sum;
+		sum_sq += block_sum_sq;
+		num_read += got;
+		end_of_input = got < wanted || num_read == num_samples;
+		SRC_DATA src_data;
+		src_data.data_in = block;
+		src_data.input_frames = got;
+		src_data.src_ratio = sample_rate_ratio;
+		src_data.end_of_input = end_of_input;
+		do
+		{
+			src_data.data_out = working + num_samples_working;
+			src_data.output_frames = capacity - num_samples_working;
+			if (src_process(src,&src_data))
+			{
+				error = INVALID_ARGUMENT;
+				break;
+			}
+			num_samples_working += src_data.output_frames_gen;
+			src_data.data_in += src_data.input_frames_used;
+			src_data.input_frames -= src_data.input_frames_used;
+		} while (src_data.input_frames > 0 && num_samples_working < capacity);
+		if (error)
+		{
+			break;
+		}
+	}
+	src_delete(src);
+	ehfree(block);
+	if (error || num_read == 0)
+	{
+		ehfree(working);
+		return error ? error : INVALID_ARGUMENT;
+	}
+	base_t* bases = (base_t*)realloc(impl->bases,(impl->num_bases+1)*sizeof(base_t));
+	if (bases == NULL)
+	{
+		ehfree(working);
+		return ALLOCATION_ERROR;
+	}
+	impl->bases = bases;
+	base_t* entry = &impl->bases[impl->num_bases];
+	get_normalization(sum,sum_sq,num_read,&entry->mean,&entry->scale);
+	apply_normalization(working,num_samples_working,entry->mean,entry->scale);
+	entry->working = working;
+	entry->num_samples_working = num_samples_working;
+	entry->fullres = NULL;
+	entry->num_samples_fullres = num_read;
+	entry->sample_rate = sample_rate;
+	entry->spectra = NULL;
+	entry->read = read;
+	entry->read_data = read_data;
+	if (base_index != NULL)
+	{
+		*base_index = impl->num_bases;
+	}
+	impl->num_bases++;
+	return SUCCESS;
+}
 
-	if (impl->base_working == NULL)
+/* Copies the normalized full rate samples [in, in+num_samples) of the base, with zeros outside of it. */
+static void read_base(shenidam_t_impl* impl,base_t* base_obj,intmax_t in,size_t num_samples,sample_d* out)
+{
+	memset(out,0,sizeof(sample_d)*num_samples);
+	intmax_t first = max(in,0);
+	intmax_t last = min(in+(intmax_t)num_samples,base_obj->num_samples_fullres);
+	if (first >= last)
 	{
-		return BASE_SIGNAL_NOT_SET;
+		return;
 	}
-	if (track_sample_rate <= 0)
+	if (base_obj->fullres != NULL)
 	{
-		return INVALID_ARGUMENT;
+		memcpy(out+(first-in),base_obj->fullres+first,sizeof(sample_d)*(last-first));
+		return;
 	}
-	if (track_num_samples == 0)
+	pthread_mutex_lock(&impl->read_lock);
+	base_obj->read(base_obj->read_data,first,out+(first-in),last-first);
+	pthread_mutex_unlock(&impl->read_lock);
+	apply_normalization(out+(first-in),last-first,base_obj->mean,base_obj->scale);
+}
+
+/* Longest part of the track (in seconds) compared with the base when refining. */
+#define REFINE_WINDOW_SECONDS 8.0
+
+static size_t format_size(int format)
+{
+	switch (format)
+	{
+	case(FORMAT_BYTE):
+		return sizeof(signed char);
+	case(FORMAT_SHORT):
+		return sizeof(short);
+	case(FORMAT_INT):
+		return sizeof(int);
+	case(FORMAT_LONG):
+		return sizeof(long);
+	case(FORMAT_LONG_LONG):
+		return sizeof(long long);
+	case(FORMAT_SINGLE):
+		return sizeof(float);
+	case(FORMAT_DOUBLE):
+		return sizeof(double);
+	}
+	return 0;
+}
+
+/*
+ * Converts num_samples samples to floats in workspace->track (holding buffer_size bytes), normalized and resampled by
+ * sample_rate_ratio, keeping at most max_num_samples_out samples and zeroing the rest of the buffer. Returns the number
+ * of samples kept in *num_samples_out.
+ */
+static int prepare_track(shenidam_t_impl* impl,workspace_t* workspace,int input_format,void* samples,size_t num_samples,double sample_rate_ratio,size_t max_num_samples_out,size_t buffer_size,size_t* num_samples_out)
+{
+	if (reserve(&workspace->track,&workspace->track_size,buffer_size))
+	{
+		return ALLOCATION_ERROR;
+	}
+	sample_d* converted = workspace->track;
+	if (sample_rate_ratio != 1)
+	{
+		if (reserve(&workspace->converted,&workspace->converted_size,sizeof(sample_d)*num_samples))
+		{
+			return ALLOCATION_ERROR;
+		}
+		converted = workspace->converted;
+	}
+	else
+	{
+		num_samples = min(num_samples,max_num_samples_out);
+	}
+	if (convert_samples(input_format,samples,num_samples,converted))
 	{
 		return INVALID_ARGUMENT;
 	}
+	normalize(converted,num_samples);
+	*num_samples_out = num_samples;
+	if (sample_rate_ratio != 1)
+	{
+		*num_samples_out = resample_into(converted,num_samples,sample_rate_ratio,workspace->track,max_num_samples_out,impl->src_converter);
+	}
+	memset(workspace->track + *num_samples_out,0,buffer_size - sizeof(sample_d)*(*num_samples_out));
+	return SUCCESS;
+}
 
-	double sample_rate_ratio_base_work = impl->base_sample_rate/impl->working_sample_rate;
+/*
+ * Searches the in point (in base samples) within the error of the coarse match, by correlating a window
+ * of the track, resampled to the base rate, with the matching part of the base around it.
+ * The peak is interpolated with a parabola, giving a fractional in point.
+ */
+static int refine_audio_range(shenidam_t_impl* impl,workspace_t* workspace,base_t* base_obj,int input_format,void* samples,size_t track_num_samples,double track_sample_rate, double *in_point)
+{
+	double sample_rate_ratio_base_work = base_obj->sample_rate/impl->working_sample_rate;
 	int radius = ceil(sample_rate_ratio_base_work);
 	if (radius <= 1)
 	{
 		return SUCCESS;
 	}
-	sample_d* track;
-	sample_d* base;
-	sample_d* temp_d;
-	base = impl->base_fullres;
-	if (convert_to_samples(input_format, samples, track_num_samples,&track))
+	size_t sample_size = format_size(input_format);
+	if (sample_size == 0)
 	{
 		return INVALID_ARGUMENT;
 	}
-	normalize(track,track_num_samples);
-	double sample_rate_ratio = impl->base_sample_rate/track_sample_rate;
-	double track_num_samples_base = track_num_samples;
-	if (sample_rate_ratio != 1)
+	double sample_rate_ratio = base_obj->sample_rate/track_sample_rate;
+	intmax_t in_track = round(*in_point);
+	intmax_t out_track = in_track + round(track_num_samples*sample_rate_ratio);
+
+	intmax_t overlapping_in = max(0,in_track) + radius;
+	intmax_t overlapping_out = min(base_obj->num_samples_fullres,out_track) - radius;
+	if (overlapping_in >= overlapping_out)
 	{
-		size_t track_num_samples_temp = (size_t)ceil(track_num_samples*sample_rate_ratio);
-		temp_d = resample(track,track_num_samples,sample_rate_ratio,&track_num_samples_temp,impl->num_threads,impl->src_converter);
-		free(track);
-		track = temp_d;
-		track_num_samples_base = track_num_samples_temp;
+		return SUCCESS;
 	}
+	intmax_t window = min(overlapping_out - overlapping_in,(intmax_t)ceil(REFINE_WINDOW_SECONDS*base_obj->sample_rate));
+	intmax_t window_in = overlapping_in + (overlapping_out - overlapping_in - window)/2;
 
-	intmax_t in_track = *in_point;
-	intmax_t out_track = in_track + round(track_num_samples_base*impl->base_sample_rate/track_sample_rate);
-
-	intmax_t in_base = 0;
-	intmax_t out_base = impl->base_num_samples_fullres;
+	/* Only the track samples covering the window are converted and resampled. */
+	intmax_t track_in = max(0,(intmax_t)floor((window_in - *in_point)/sample_rate_ratio));
+	size_t track_window = min(track_num_samples - track_in,(intmax_t)ceil(window/sample_rate_ratio) + 1);
+	size_t max_window_samples = min(window,sample_rate_ratio != 1 ? (intmax_t)ceil(track_window*sample_rate_ratio) : (intmax_t)track_window);
 
-	intmax_t overlapping_in = max(in_base,in_track);
-	intmax_t overlapping_out = min(out_base,out_track);
+	/* Where the window starts in the base according to the coarse in point. */
+	double window_start = *in_point + track_in*sample_rate_ratio;
+	intmax_t base_in = (intmax_t)floor(window_start) - radius;
+	size_t base_window = max_window_samples + 2*radius + 1;
+	size_t common_size = get_common_size(impl,base_window);
+	size_t common_size_f = common_size / 2 + 1;
+	size_t buffer_size = transform_buffer_size(common_size);
 
-	if (overlapping_in > overlapping_out)
+	size_t window_samples;
+	int error = prepare_track(impl,workspace,input_format,(char*)samples + track_in*sample_size,track_window,sample_rate_ratio,max_window_samples,buffer_size,&window_samples);
+	if (error)
 	{
-		return SUCCESS;//Shouldn't happen
+		return error;
 	}
-
-	
-	sample_d* buffer = calloc((2*radius+1),sizeof(sample_d));
-
-	for (int j = -radius ; j <= radius; j++)
+	if (reserve(&workspace->base,&workspace->base_size,buffer_size))
 	{
-		for (intmax_t base_sample = overlapping_in + radius; base_sample < overlapping_out - radius; base_sample++)
-		{
-			intmax_t track_sample = base_sample - *in_point;
-			
-			sample_d a = base[base_sample ];
-			sample_d b = track[track_sample + j];
-			buffer[j+radius] += a * b;
-		}
+		return ALLOCATION_ERROR;
 	}
+	sample_d* base = workspace->base;
+	read_base(impl,base_obj,base_in,base_window,base);
+	memset(base+base_window,0,buffer_size-sizeof(sample_d)*base_window);
+	if (fft(impl,base,common_size) || fft(impl,workspace->track,common_size))
+	{
+		return ALLOCATION_ERROR;
+	}
+	shenidam_best_kernels()->conj_multiply((float*)workspace->track,base,base,common_size_f);
+	if (ifft(impl,(sample_f*)base,common_size))
+	{
+		return ALLOCATION_ERROR;
+	}
+	sample_d* correlation = base;
 
-	free(track);
-
-	double maxV = -DBL_MAX;
-	int iMax = -1;
-	for (int i = 0 ; i < 2*radius + 1; i++)
+	int iMax = shenidam_best_kernels()->argmax(correlation,2*radius + 1);
+	double maxV = correlation[iMax];
+	double offset = 0;
+	if (iMax > 0 && iMax < 2*radius)
 	{
-		if (buffer[i] > maxV)
+		double left = correlation[iMax - 1];
+		double right = correlation[iMax + 1];
+		double curvature = left - 2*maxV + right;
+		if (curvature < 0)
 		{
-			maxV = buffer[i];
-			iMax = i;
+			offset = 0.5*(left - right)/curvature;
 		}
 	}
-	*in_point -= iMax - radius;
-	
+	*in_point += base_in + iMax + offset - window_start;
+	return SUCCESS;
 }
 
-int shenidam_get_audio_range(shenidam_t shenidam_obj,int input_format,void* samples,size_t track_num_samples,double track_sample_rate,intmax_t* in_point,size_t* length)
+static int check_refine_arguments(shenidam_t shenidam_obj,size_t track_num_samples,double track_sample_rate)
 {
 	if (shenidam_obj == NULL)
 	{
 		return NULL_OBJECT;
 	}
-	shenidam_t_impl* impl =((shenidam_t_impl*)shenidam_obj);
-
-	if (impl->base_working == NULL)
+	if (((shenidam_t_impl*)shenidam_obj)->num_bases == 0)
 	{
 		return BASE_SIGNAL_NOT_SET;
 	}
@@ -444,80 +1114,345 @@ int shenidam_get_audio_range(shenidam_t shenidam_obj,int input_format,void* samp
 	{
 		return INVALID_ARGUMENT;
 	}
-	sample_d* track;
-	
-	sample_d* base;
-	sample_d* temp_d;
-	sample_d* convolved;
-	sample_f* track_f;
-	sample_f* base_f;
-	base = impl->base_working;
-	if (convert_to_samples(input_format, samples, track_num_samples,&track))
+	return SUCCESS;
+}
+
+static int refine_first_base(shenidam_t_impl* impl,int input_format,void* samples,size_t track_num_samples,double track_sample_rate, double *in_point)
+{
+	workspace_t* workspace = acquire_workspace(impl);
+	if (workspace == NULL)
 	{
-		return INVALID_ARGUMENT;
+		return ALLOCATION_ERROR;
 	}
-	normalize(track,track_num_samples);
-
-	double sample_rate_ratio = impl->working_sample_rate/track_sample_rate;
-	double track_num_samples_working = track_num_samples;
-	
-	
+	int error = refine_audio_range(impl,workspace,&impl->bases[0],input_format,samples,track_num_samples,track_sample_rate,in_point);
+	release_workspace(impl,workspace);
+	return error;
+}
 
-	if (sample_rate_ratio != 1)
+int shenidam_refine_audio_range(shenidam_t shenidam_obj,int input_format,void* samples,size_t track_num_samples,double track_sample_rate, intmax_t *in_point)
+{
+	int error = check_refine_arguments(shenidam_obj,track_num_samples,track_sample_rate);
+	if (error)
 	{
-		size_t track_num_samples_temp = (size_t)ceil(track_num_samples*sample_rate_ratio);
+		return error;
+	}
+	double in = *in_point;
+	error = refine_first_base((shenidam_t_impl*)shenidam_obj,input_format,samples,track_num_samples,track_sample_rate,&in);
+	*in_point = round(in);
+	return error;
+}
 
-		temp_d = resample(track,track_num_samples,sample_rate_ratio,&track_num_samples_temp,impl->num_threads,impl->src_converter);
-		free(track);
-		track = temp_d;
-		track_num_samples_working = track_num_samples_temp;
+int shenidam_refine_audio_range_subsample(shenidam_t shenidam_obj,int input_format,void* samples,size_t track_num_samples,double track_sample_rate, double *in_point)
+{
+	int error = check_refine_arguments(shenidam_obj,track_num_samples,track_sample_rate);
+	if (error)
+	{
+		return error;
 	}
-	size_t common_size = get_common_size(track_num_samples_working + impl->base_num_samples_working);
+	return refine_first_base((shenidam_t_impl*)shenidam_obj,input_format,samples,track_num_samples,track_sample_rate,in_point);
+}
+
+/*
+ * Cross-correlates the track spectrum with the base at common_size, giving the coarse in point
+ * at the working rate and the correlation peak.
+ */
+static int correlate(shenidam_t_impl* impl,workspace_t* workspace,base_t* base,sample_f* track_f,size_t track_num_samples_working,size_t common_size,intmax_t* in_point,double* peak)
+{
 	size_t common_size_f = common_size / 2 + 1;
-	temp_d = resize(track,track_num_samples_working,common_size);
-	ehfree(track);
-	track = temp_d;
-	temp_d = resize(base,impl->base_num_samples_working,common_size);
-	base = temp_d;
-
-	track_f = fft(track,common_size,impl->num_threads);
-	ehfree(track);
-	base_f = fft(base,common_size,impl->num_threads);
-	ehfree(base);
-	for (size_t i = 0; i < common_size_f;i++)
+	if (reserve(&workspace->correlation,&workspace->correlation_size,transform_buffer_size(common_size)))
 	{
-		track_f[i]=conjf(track_f[i])*base_f[i];
+		return ALLOCATION_ERROR;
 	}
-	ehfree(base_f);
-	convolved = ifft(track_f,common_size,impl->num_threads);
-	ehfree(track_f);
-	sample_d maxv = -DBL_MAX;
-	intmax_t in = 0;
-	for(size_t i = 0; i < common_size;i++)
+	base_spectrum_t* base_f = get_base_spectrum(impl,base,common_size);
+	if (base_f == NULL)
 	{
-		double temp = convolved[i];
-		if (temp > maxv)
+		return ALLOCATION_ERROR;
+	}
+	sample_f* product = (sample_f*)workspace->correlation;
+	shenidam_best_kernels()->conj_multiply((float*)track_f,(float*)base_f->spectrum,(float*)product,common_size_f);
+	release_base_spectrum(impl,base,base_f);
+	if (ifft(impl,product,common_size))
+	{
+		return ALLOCATION_ERROR;
+	}
+	sample_d* convolved = workspace->correlation;
+	intmax_t in = shenidam_best_kernels()->argmax(convolved,common_size);
+	sample_d maxv = convolved[in];
+
+	if (in > (track_num_samples_working<base->num_samples_working?common_size-track_num_samples_working:base->num_samples_working))
+	{
+		in -= common_size;
+	}
+	*in_point = in;
+	*peak = maxv;
+	return SUCCESS;
+}
+
+/*
+ * Overlap-save version of correlate: the lags are covered by blocks of fft_size - track_num_samples_working + 1,
+ * each one correlating the matching part of the base with the track spectrum at fft_size. Memory depends on
+ * fft_size only, and the blocks are processed in parallel when built with OpenMP, each thread in its own workspace.
+ * The blocks take OpenMP's thread count (OMP_NUM_THREADS, by default the processor's), not the FFTW one, which is 1
+ * unless set.
+ */
+static int correlate_partitioned(shenidam_t_impl* impl,base_t* base,sample_f* track_f,size_t track_num_samples_working,size_t fft_size,intmax_t* in_point,double* peak)
+{
+	size_t fft_size_f = fft_size / 2 + 1;
+	intmax_t hop = fft_size - track_num_samples_working + 1;
+	intmax_t first_lag = 1 - (intmax_t)track_num_samples_working;
+	intmax_t last_lag = base->num_samples_working - 1;
+	intmax_t num_blocks = (last_lag - first_lag + hop)/hop;
+	double best = -DBL_MAX;
+	intmax_t best_in = 0;
+	int error = SUCCESS;
+#ifdef _OPENMP
+	#pragma omp parallel num_threads(omp_get_max_threads())
+#endif
+	{
+		workspace_t* workspace = acquire_workspace(impl);
+		int block_error = workspace != NULL ? reserve(&workspace->base,&workspace->base_size,transform_buffer_size(fft_size)) : ALLOCATION_ERROR;
+#ifdef _OPENMP
+		#pragma omp for schedule(dynamic)
+#endif
+		for (intmax_t j = 0; j < num_blocks; j++)
+		{
+			if (block_error)
+			{
+				continue;
+			}
+			intmax_t start = first_lag + j*hop;
+			sample_d* block = workspace->base;
+			for (size_t i = 0; i < fft_size; i++)
+			{
+				intmax_t k = start + i;
+				block[i] = k >= 0 && k < (intmax_t)base->num_samples_working ? base->working[k] : 0;
+			}
+			if (fft(impl,block,fft_size))
+			{
+				block_error = ALLOCATION_ERROR;
+				continue;
+			}
+			sample_f* block_f = (sample_f*)block;
+			shenidam_best_kernels()->conj_multiply((float*)track_f,(float*)block_f,(float*)block_f,fft_size_f);
+			if (ifft(impl,block_f,fft_size))
+			{
+				block_error = ALLOCATION_ERROR;
+				continue;
+			}
+			sample_d* correlation = block;
+			/* Only the first hop lags are free of wrap-around. */
+			intmax_t num_lags = min(hop,last_lag - start + 1);
+			size_t block_max = shenidam_best_kernels()->argmax(correlation,num_lags);
+			double block_best = correlation[block_max];
+			intmax_t block_in = start + block_max;
+#ifdef _OPENMP
+			#pragma omp critical(shenidam_partitioned_peak)
+#endif
+			if (block_best > best || (block_best == best && block_in < best_in))
+			{
+				best = block_best;
+				best_in = block_in;
+			}
+		}
+		if (workspace != NULL)
 		{
-			maxv = temp;
-			in = i;
+			release_workspace(impl,workspace);
+		}
+		if (block_error)
+		{
+#ifdef _OPENMP
+			#pragma omp critical(shenidam_partitioned_peak)
+#endif
+			error = block_error;
 		}
 	}
+	*in_point = best_in;
+	*peak = best;
+	return error;
+}
 
-	
-	
+/* The correlation peak divided by the norm of the overlapping part of the base, which makes peaks comparable between bases. */
+static double get_score(base_t* base,size_t track_num_samples_working,intmax_t in,double peak)
+{
+	double energy = 0;
+	intmax_t overlapping_out = min(base->num_samples_working,in+(intmax_t)track_num_samples_working);
+	for (intmax_t i = max(in,0); i < overlapping_out; i++)
+	{
+		energy += base->working[i]*base->working[i];
+	}
+	return energy > 0 ? peak/sqrt(energy) : 0;
+}
 
-	if (in > (track_num_samples_working<impl->base_num_samples_working?common_size-track_num_samples_working:impl->base_num_samples_working))
+static void start_stage(shenidam_t_impl* impl,stage_clock_t* clock)
+{
+	if (!impl->timings)
 	{
-		in -= common_size;
+		return;
 	}
-	
-	double sample_rate_ratio_base_work = impl->base_sample_rate/impl->working_sample_rate;
-	ehfree(convolved);
-	*in_point = round(in*sample_rate_ratio_base_work);
-	*length = round(track_num_samples*impl->base_sample_rate/track_sample_rate);
-	shenidam_refine_audio_range(shenidam_obj,input_format,samples,track_num_samples,track_sample_rate,in_point);
-	
-	return SUCCESS;
+	struct timespec t;
+	clock_gettime(CLOCK_MONOTONIC,&t);
+	clock->wall_time = t.tv_sec + t.tv_nsec*1e-9;
+	clock_gettime(CLOCK_THREAD_CPUTIME_ID,&t);
+	clock->cpu_time = t.tv_sec + t.tv_nsec*1e-9;
+}
+
+/* Adds the time since start_stage to the stage, which held buffers of num_bytes. */
+static void end_stage(shenidam_t_impl* impl,stage_clock_t* clock,int stage,size_t num_bytes)
+{
+	if (!impl->timings)
+	{
+		return;
+	}
+	stage_clock_t end;
+	start_stage(impl,&end);
+	last_timings[stage].wall_time += end.wall_time - clock->wall_time;
+	last_timings[stage].cpu_time += end.cpu_time - clock->cpu_time;
+	last_timings[stage].peak_bytes = max(last_timings[stage].peak_bytes,num_bytes);
+}
+
+/* Matches the track against bases [first_base, first_base + num_bases), keeping the best score. */
+static int match_audio_range(shenidam_t_impl* impl,workspace_t* workspace,int first_base,int num_bases,int input_format,void* samples,size_t track_num_samples,double track_sample_rate,int* base_index,intmax_t* in_point,size_t* length)
+{
+	double sample_rate_ratio = impl->working_sample_rate/track_sample_rate;
+	/* An upper bound of the resampled length, the transform size does not wait for the resampling. */
+	size_t max_num_samples_working = sample_rate_ratio != 1 ? (size_t)ceil(track_num_samples*sample_rate_ratio) : track_num_samples;
+	/* One transform size for all the bases, so that the track spectrum is computed once. */
+	size_t longest_base = 0;
+	for (int b = first_base; b < first_base + num_bases; b++)
+	{
+		longest_base = max(longest_base,impl->bases[b].num_samples_working);
+	}
+	size_t minimal_size = max_num_samples_working + longest_base;
+	size_t common_size = get_common_size(impl,minimal_size);
+	/* Partitioned only when the blocks are shorter than the whole. */
+	int partitioned = 0;
+	if (impl->block_size > 0)
+	{
+		size_t block_fft_size = get_common_size(impl,impl->block_size + max_num_samples_working - 1);
+		if (block_fft_size < common_size)
+		{
+			common_size = block_fft_size;
+			partitioned = 1;
+		}
+	}
+	if (!partitioned)
+	{
+		/* A larger size with the base spectra already cached, up to the power of two, saves transforming the whole bases again. */
+		size_t cached_size = get_cached_size(impl,first_base,num_bases,minimal_size,next_power_of_two(minimal_size));
+		if (cached_size != 0)
+		{
+			common_size = cached_size;
+		}
+	}
+	stage_clock_t clock;
+	start_stage(impl,&clock);
+	size_t track_num_samples_working;
+	int error = prepare_track(impl,workspace,input_format,samples,track_num_samples,sample_rate_ratio,max_num_samples_working,transform_buffer_size(common_size),&track_num_samples_working);
+	end_stage(impl,&clock,STAGE_RESAMPLING,workspace->converted_size + workspace->track_size);
+	if (error)
+	{
+		return error;
+	}
+	start_stage(impl,&clock);
+	if (fft(impl,workspace->track,common_size))
+	{
+		return ALLOCATION_ERROR;
+	}
+	sample_f* track_f = (sample_f*)workspace->track;
+	double best_score = -DBL_MAX;
+	intmax_t best_in = 0;
+	int best = first_base;
+	for (int b = first_base; b < first_base + num_bases; b++)
+	{
+		intmax_t in;
+		double peak;
+		if (partitioned)
+		{
+			error = correlate_partitioned(impl,&impl->bases[b],track_f,track_num_samples_working,common_size,&in,&peak);
+		}
+		else
+		{
+			error = correlate(impl,workspace,&impl->bases[b],track_f,track_num_samples_working,common_size,&in,&peak);
+		}
+		if (error)
+		{
+			return error;
+		}
+		double score = num_bases > 1 ? get_score(&impl->bases[b],track_num_samples_working,in,peak) : peak;
+		if (score > best_score)
+		{
+			best_score = score;
+			best_in = in;
+			best = b;
+		}
+	}
+	/* The base spectra are cached in the shenidam object, the partitioned blocks are in other workspaces. */
+	end_stage(impl,&clock,STAGE_FFT,workspace->track_size + workspace->correlation_size + (partitioned ? transform_buffer_size(common_size) : 0));
+
+	base_t* base = &impl->bases[best];
+	double sample_rate_ratio_base_work = base->sample_rate/impl->working_sample_rate;
+	double in = best_in*sample_rate_ratio_base_work;
+	*length = round(track_num_samples*base->sample_rate/track_sample_rate);
+	if (base_index != NULL)
+	{
+		*base_index = best;
+	}
+	start_stage(impl,&clock);
+	error = refine_audio_range(impl,workspace,base,input_format,samples,track_num_samples,track_sample_rate,&in);
+	end_stage(impl,&clock,STAGE_REFINEMENT,workspace->converted_size + workspace->track_size + workspace->base_size);
+	*in_point = round(in);
+	return error;
+}
+
+static int get_best_audio_range(shenidam_t_impl* impl,int first_base,int num_bases,int input_format,void* samples,size_t track_num_samples,double track_sample_rate,int* base_index,intmax_t* in_point,size_t* length)
+{
+	if (track_sample_rate <= 0)
+	{
+		return INVALID_ARGUMENT;
+	}
+	if (track_num_samples == 0)
+	{
+		return INVALID_ARGUMENT;
+	}
+	memset(last_timings,0,sizeof(last_timings));
+	workspace_t* workspace = acquire_workspace(impl);
+	if (workspace == NULL)
+	{
+		return ALLOCATION_ERROR;
+	}
+	int error = match_audio_range(impl,workspace,first_base,num_bases,input_format,samples,track_num_samples,track_sample_rate,base_index,in_point,length);
+	release_workspace(impl,workspace);
+	return error;
+}
+
+int shenidam_get_audio_range(shenidam_t shenidam_obj,int input_format,void* samples,size_t track_num_samples,double track_sample_rate,intmax_t* in_point,size_t* length)
+{
+	if (shenidam_obj == NULL)
+	{
+		return NULL_OBJECT;
+	}
+	shenidam_t_impl* impl =((shenidam_t_impl*)shenidam_obj);
+
+	if (impl->num_bases == 0)
+	{
+		return BASE_SIGNAL_NOT_SET;
+	}
+	return get_best_audio_range(impl,0,1,input_format,samples,track_num_samples,track_sample_rate,NULL,in_point,length);
+}
+
+int shenidam_get_best_audio_range(shenidam_t shenidam_obj,int input_format,void* samples,size_t track_num_samples,double track_sample_rate,int* base_index,intmax_t* in_point,size_t* length)
+{
+	if (shenidam_obj == NULL)
+	{
+		return NULL_OBJECT;
+	}
+	shenidam_t_impl* impl =((shenidam_t_impl*)shenidam_obj);
+
+	if (impl->num_bases == 0)
+	{
+		return BASE_SIGNAL_NOT_SET;
+	}
+	return get_best_audio_range(impl,0,impl->num_bases,input_format,samples,track_num_samples,track_sample_rate,base_index,in_point,length);
 }
 
 int shenidam_destroy(shenidam_t shenidam_obj)
@@ -528,8 +1463,11 @@ int shenidam_destroy(shenidam_t shenidam_obj)
 	}
 
 	shenidam_t_impl* impl =((shenidam_t_impl*)shenidam_obj);
-	ehfree(impl->base_working);
-	ehfree(impl->base_fullres);
+	free_bases(impl);
+	free_workspaces(impl);
+	free_plans(impl);
+	pthread_mutex_destroy(&impl->lock);
+	pthread_mutex_destroy(&impl->read_lock);
 	ehfree(impl);
 	return SUCCESS;
 }
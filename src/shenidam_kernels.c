@@ -0,0 +1,518 @@
+/*
+    Copyright 2010 Nabil Stendardo <nabil@stendardo.org>
+
+    This file is part of Shenidam.
+
+    Shenidam is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) version 2 of the same License.
+
+    Shenidam is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with Shenidam.  If not, see <http://www.gnu.org/licenses/>.
+
+ */
+#include <string.h>
+#include <stdint.h>
+#include <pthread.h>
+#include "shenidam_kernels.h"
+
+/*
+ * The vector versions are compiled with target attributes, whatever the flags of the build,
+ * and chosen at run time from the processor's features.
+ */
+#if defined(__GNUC__) && (defined(__x86_64__) || defined(__i386__))
+#define SHENIDAM_KERNELS_X86
+#include <immintrin.h>
+#endif
+
+static void sum_scalar(const float* samples,size_t num_samples,double* sum,double* sum_sq)
+{
+	double s = 0;
+	double s_sq = 0;
+	for (size_t i = 0; i < num_samples; i++)
+	{
+		s += samples[i];
+		s_sq += samples[i]*samples[i];
+	}
+	*sum = s;
+	*sum_sq = s_sq;
+}
+
+static void normalize_scalar(float* samples,size_t num_samples,float mean,float inverse_scale)
+{
+	for (size_t i = 0; i < num_samples; i++)
+	{
+		samples[i] = (samples[i] - mean)*inverse_scale;
+	}
+}
+
+static void conj_multiply_scalar(const float* a,const float* b,float* out,size_t num_values)
+{
+	for (size_t i = 0; i < 2*num_values; i += 2)
+	{
+		float re = a[i]*b[i] + a[i+1]*b[i+1];
+		float im = a[i]*b[i+1] - a[i+1]*b[i];
+		out[i] = re;
+		out[i+1] = im;
+	}
+}
+
+static size_t argmax_scalar(const float* samples,size_t num_samples)
+{
+	size_t res = 0;
+	for (size_t i = 1; i < num_samples; i++)
+	{
+		if (samples[i] > samples[res])
+		{
+			res = i;
+		}
+	}
+	return res;
+}
+
+static void average_channels_scalar(const float* frames,size_t num_frames,int channels,float* out)
+{
+	for (size_t k = 0; k < num_frames; k++)
+	{
+		float s = 0;
+		for (int j = 0 ; j < channels; j++)
+		{
+			s += frames[k*channels + j];
+		}
+		out[k] = s/channels;
+	}
+}
+
+static const shenidam_kernels_t kernels_scalar = {"scalar",sum_scalar,normalize_scalar,conj_multiply_scalar,argmax_scalar,average_channels_scalar};
+
+#ifdef SHENIDAM_KERNELS_X86
+
+/* The first index from start holding value, given that one does. */
+static size_t find_first(const float* samples,size_t start,size_t num_samples,float value)
+{
+	for (size_t i = start; i < num_samples; i++)
+	{
+		if (samples[i] == value)
+		{
+			return i;
+		}
+	}
+	return 0;
+}
+
+__attribute__((target("sse2")))
+static void sum_sse2(const float* samples,size_t num_samples,double* sum,double* sum_sq)
+{
+	__m128d s = _mm_setzero_pd();
+	__m128d s_sq = _mm_setzero_pd();
+	size_t i = 0;
+	for (; i + 4 <= num_samples; i += 4)
+	{
+		__m128 v = _mm_loadu_ps(samples + i);
+		__m128d lo = _mm_cvtps_pd(v);
+		__m128d hi = _mm_cvtps_pd(_mm_movehl_ps(v,v));
+		s = _mm_add_pd(s,_mm_add_pd(lo,hi));
+		s_sq = _mm_add_pd(s_sq,_mm_add_pd(_mm_mul_pd(lo,lo),_mm_mul_pd(hi,hi)));
+	}
+	double parts[2];
+	double parts_sq[2];
+	_mm_storeu_pd(parts,s);
+	_mm_storeu_pd(parts_sq,s_sq);
+	double tail,tail_sq;
+	sum_scalar(samples + i,num_samples - i,&tail,&tail_sq);
+	*sum = parts[0] + parts[1] + tail;
+	*sum_sq = parts_sq[0] + parts_sq[1] + tail_sq;
+}
+
+__attribute__((target("sse2")))
+static void normalize_sse2(float* samples,size_t num_samples,float mean,float inverse_scale)
+{
+	__m128 m = _mm_set1_ps(mean);
+	__m128 f = _mm_set1_ps(inverse_scale);
+	size_t i = 0;
+	for (; i + 4 <= num_samples; i += 4)
+	{
+		_mm_storeu_ps(samples + i,_mm_mul_ps(_mm_sub_ps(_mm_loadu_ps(samples + i),m),f));
+	}
+	normalize_scalar(samples + i,num_samples - i,mean,inverse_scale);
+}
+
+__attribute__((target("sse2")))
+static void conj_multiply_sse2(const float* a,const float* b,float* out,size_t num_values)
+{
+	const __m128 odd_sign = _mm_castsi128_ps(_mm_set_epi32(INT32_MIN,0,INT32_MIN,0));
+	size_t i = 0;
+	for (; i + 2 <= num_values; i += 2)
+	{
+		__m128 va = _mm_loadu_ps(a + 2*i);
+		__m128 vb = _mm_loadu_ps(b + 2*i);
+		__m128 re = _mm_shuffle_ps(va,va,_MM_SHUFFLE(2,2,0,0));
+		__m128 im = _mm_shuffle_ps(va,va,_MM_SHUFFLE(3,3,1,1));
+		__m128 swapped = _mm_shuffle_ps(vb,vb,_MM_SHUFFLE(2,3,0,1));
+		__m128 cross = _mm_xor_ps(_mm_mul_ps(im,swapped),odd_sign);
+		_mm_storeu_ps(out + 2*i,_mm_add_ps(_mm_mul_ps(re,vb),cross));
+	}
+	conj_multiply_scalar(a + 2*i,b + 2*i,out + 2*i,num_values - i);
+}
+
+__attribute__((target("sse2")))
+static size_t argmax_sse2(const float* samples,size_t num_samples)
+{
+	if (num_samples < 8)
+	{
+		return argmax_scalar(samples,num_samples);
+	}
+	__m128 m = _mm_loadu_ps(samples);
+	size_t i = 4;
+	for (; i + 4 <= num_samples; i += 4)
+	{
+		m = _mm_max_ps(m,_mm_loadu_ps(samples + i));
+	}
+	m = _mm_max_ps(m,_mm_shuffle_ps(m,m,_MM_SHUFFLE(1,0,3,2)));
+	m = _mm_max_ps(m,_mm_shuffle_ps(m,m,_MM_SHUFFLE(2,3,0,1)));
+	float best = _mm_cvtss_f32(m);
+	size_t tail = i + argmax_scalar(samples + i,num_samples - i);
+	if (tail < num_samples && samples[tail] > best)
+	{
+		return tail;
+	}
+	__m128 target = _mm_set1_ps(best);
+	for (size_t j = 0; j < i; j += 4)
+	{
+		int mask = _mm_movemask_ps(_mm_cmpeq_ps(_mm_loadu_ps(samples + j),target));
+		if (mask)
+		{
+			return j + __builtin_ctz(mask);
+		}
+	}
+	return find_first(samples,i,num_samples,best);
+}
+
+__attribute__((target("sse2")))
+static void average_channels_sse2(const float* frames,size_t num_frames,int channels,float* out)
+{
+	if (channels == 1)
+	{
+		memcpy(out,frames,sizeof(float)*num_frames);
+		return;
+	}
+	if (channels != 2)
+	{
+		average_channels_scalar(frames,num_frames,channels,out);
+		return;
+	}
+	__m128 divisor = _mm_set1_ps(2);
+	size_t k = 0;
+	for (; k + 4 <= num_frames; k += 4)
+	{
+		__m128 v0 = _mm_loadu_ps(frames + 2*k);
+		__m128 v1 = _mm_loadu_ps(frames + 2*k + 4);
+		__m128 left = _mm_shuffle_ps(v0,v1,_MM_SHUFFLE(2,0,2,0));
+		__m128 right = _mm_shuffle_ps(v0,v1,_MM_SHUFFLE(3,1,3,1));
+		_mm_storeu_ps(out + k,_mm_div_ps(_mm_add_ps(left,right),divisor));
+	}
+	average_channels_scalar(frames + 2*k,num_frames - k,channels,out + k);
+}
+
+static const shenidam_kernels_t kernels_sse2 = {"sse2",sum_sse2,normalize_sse2,conj_multiply_sse2,argmax_sse2,average_channels_sse2};
+
+__attribute__((target("avx2,fma")))
+static void sum_avx2(const float* samples,size_t num_samples,double* sum,double* sum_sq)
+{
+	__m256d s = _mm256_setzero_pd();
+	__m256d s_sq = _mm256_setzero_pd();
+	size_t i = 0;
+	for (; i + 8 <= num_samples; i += 8)
+	{
+		__m256d lo = _mm256_cvtps_pd(_mm_loadu_ps(samples + i));
+		__m256d hi = _mm256_cvtps_pd(_mm_loadu_ps(samples + i + 4));
+		s = _mm256_add_pd(s,_mm256_add_pd(lo,hi));
+		s_sq = _mm256_fmadd_pd(lo,lo,s_sq);
+		s_sq = _mm256_fmadd_pd(hi,hi,s_sq);
+	}
+	double parts[4];
+	double parts_sq[4];
+	_mm256_storeu_pd(parts,s);
+	_mm256_storeu_pd(parts_sq,s_sq);
+	double tail,tail_sq;
+	sum_scalar(samples + i,num_samples - i,&tail,&tail_sq);
+	*sum = parts[0] + parts[1] + parts[2] + parts[3] + tail;
+	*sum_sq = parts_sq[0] + parts_sq[1] + parts_sq[2] + parts_sq[3] + tail_sq;
+}
+
+__attribute__((target("avx2,fma")))
+static void normalize_avx2(float* samples,size_t num_samples,float mean,float inverse_scale)
+{
+	__m256 m = _mm256_set1_ps(mean);
+	__m256 f = _mm256_set1_ps(inverse_scale);
+	size_t i = 0;
+	for (; i + 8 <= num_samples; i += 8)
+	{
+		_mm256_storeu_ps(samples + i,_mm256_mul_ps(_mm256_sub_ps(_mm256_loadu_ps(samples + i),m),f));
+	}
+	normalize_scalar(samples + i,num_samples - i,mean,inverse_scale);
+}
+
+__attribute__((target("avx2,fma")))
+static void conj_multiply_avx2(const float* a,const float* b,float* out,size_t num_values)
+{
+	size_t i = 0;
+	for (; i + 4 <= num_values; i += 4)
+	{
+		__m256 va = _mm256_loadu_ps(a + 2*i);
+		__m256 vb = _mm256_loadu_ps(b + 2*i);
+		__m256 re = _mm256_moveldup_ps(va);
+		__m256 im = _mm256_movehdup_ps(va);
+		__m256 swapped = _mm256_permute_ps(vb,_MM_SHUFFLE(2,3,0,1));
+		_mm256_storeu_ps(out + 2*i,_mm256_fmsubadd_ps(re,vb,_mm256_mul_ps(im,swapped)));
+	}
+	conj_multiply_scalar(a + 2*i,b + 2*i,out + 2*i,num_values - i);
+}
+
+__attribute__((target("avx2,fma")))
+static size_t argmax_avx2(const float* samples,size_t num_samples)
+{
+	if (num_samples < 16)
+	{
+		return argmax_scalar(samples,num_samples);
+	}
+	__m256 m = _mm256_loadu_ps(samples);
+	size_t i = 8;
+	for (; i + 8 <= num_samples; i += 8)
+	{
+		m = _mm256_max_ps(m,_mm256_loadu_ps(samples + i));
+	}
+	__m128 h = _mm_max_ps(_mm256_castps256_ps128(m),_mm256_extractf128_ps(m,1));
+	h = _mm_max_ps(h,_mm_shuffle_ps(h,h,_MM_SHUFFLE(1,0,3,2)));
+	h = _mm_max_ps(h,_mm_shuffle_ps(h,h,_MM_SHUFFLE(2,3,0,1)));
+	float best = _mm_cvtss_f32(h);
+	size_t tail = i + argmax_scalar(samples + i,num_samples - i);
+	if (tail < num_samples && samples[tail] > best)
+	{
+		return tail;
+	}
+	__m256 target = _mm256_set1_ps(best);
+	for (size_t j = 0; j < i; j += 8)
+	{
+		int mask = _mm256_movemask_ps(_mm256_cmp_ps(_mm256_loadu_ps(samples + j),target,_CMP_EQ_OQ));
+		if (mask)
+		{
+			return j + __builtin_ctz(mask);
+		}
+	}
+	return find_first(samples,i,num_samples,best);
+}
+
+__attribute__((target("avx2,fma")))
+static void average_channels_avx2(const float* frames,size_t num_frames,int channels,float* out)
+{
+	if (channels == 1)
+	{
+		memcpy(out,frames,sizeof(float)*num_frames);
+		return;
+	}
+	__m256 divisor = _mm256_set1_ps(channels);
+	size_t k = 0;
+	if (channels == 2)
+	{
+		for (; k + 8 <= num_frames; k += 8)
+		{
+			__m256 v0 = _mm256_loadu_ps(frames + 2*k);
+			__m256 v1 = _mm256_loadu_ps(frames + 2*k + 8);
+			__m256 s = _mm256_add_ps(_mm256_shuffle_ps(v0,v1,_MM_SHUFFLE(2,0,2,0)),_mm256_shuffle_ps(v0,v1,_MM_SHUFFLE(3,1,3,1)));
+			/* The shuffles work within 128 bit lanes, which leaves the pairs of frames out of order. */
+			s = _mm256_castpd_ps(_mm256_permute4x64_pd(_mm256_castps_pd(s),_MM_SHUFFLE(3,1,2,0)));
+			_mm256_storeu_ps(out + k,_mm256_div_ps(s,divisor));
+		}
+	}
+	else
+	{
+		__m256i index = _mm256_mullo_epi32(_mm256_setr_epi32(0,1,2,3,4,5,6,7),_mm256_set1_epi32(channels));
+		for (; k + 8 <= num_frames; k += 8)
+		{
+			const float* base = frames + k*channels;
+			__m256 s = _mm256_setzero_ps();
+			for (int j = 0; j < channels; j++)
+			{
+				s = _mm256_add_ps(s,_mm256_i32gather_ps(base + j,index,4));
+			}
+			_mm256_storeu_ps(out + k,_mm256_div_ps(s,divisor));
+		}
+	}
+	average_channels_scalar(frames + k*channels,num_frames - k,channels,out + k);
+}
+
+static const shenidam_kernels_t kernels_avx2 = {"avx2",sum_avx2,normalize_avx2,conj_multiply_avx2,argmax_avx2,average_channels_avx2};
+
+__attribute__((target("avx512f")))
+static void sum_avx512(const float* samples,size_t num_samples,double* sum,double* sum_sq)
+{
+	__m512d s = _mm512_setzero_pd();
+	__m512d s_sq = _mm512_setzero_pd();
+	size_t i = 0;
+	for (; i + 16 <= num_samples; i += 16)
+	{
+		__m512d lo = _mm512_cvtps_pd(_mm256_loadu_ps(samples + i));
+		__m512d hi = _mm512_cvtps_pd(_mm256_loadu_ps(samples + i + 8));
+		s = _mm512_add_pd(s,_mm512_add_pd(lo,hi));
+		s_sq = _mm512_fmadd_pd(lo,lo,s_sq);
+		s_sq = _mm512_fmadd_pd(hi,hi,s_sq);
+	}
+	double tail,tail_sq;
+	sum_scalar(samples + i,num_samples - i,&tail,&tail_sq);
+	*sum = _mm512_reduce_add_pd(s) + tail;
+	*sum_sq = _mm512_reduce_add_pd(s_sq) + tail_sq;
+}
+
+__attribute__((target("avx512f")))
+static void normalize_avx512(float* samples,size_t num_samples,float mean,float inverse_scale)
+{
+	__m512 m = _mm512_set1_ps(mean);
+	__m512 f = _mm512_set1_ps(inverse_scale);
+	size_t i = 0;
+	for (; i + 16 <= num_samples; i += 16)
+	{
+		_mm512_storeu_ps(samples + i,_mm512_mul_ps(_mm512_sub_ps(_mm512_loadu_ps(samples + i),m),f));
+	}
+	normalize_scalar(samples + i,num_samples - i,mean,inverse_scale);
+}
+
+__attribute__((target("avx512f")))
+static void conj_multiply_avx512(const float* a,const float* b,float* out,size_t num_values)
+{
+	size_t i = 0;
+	for (; i + 8 <= num_values; i += 8)
+	{
+		__m512 va = _mm512_loadu_ps(a + 2*i);
+		__m512 vb = _mm512_loadu_ps(b + 2*i);
+		__m512 re = _mm512_moveldup_ps(va);
+		__m512 im = _mm512_movehdup_ps(va);
+		__m512 swapped = _mm512_permute_ps(vb,_MM_SHUFFLE(2,3,0,1));
+		_mm512_storeu_ps(out + 2*i,_mm512_fmsubadd_ps(re,vb,_mm512_mul_ps(im,swapped)));
+	}
+	conj_multiply_scalar(a + 2*i,b + 2*i,out + 2*i,num_values - i);
+}
+
+__attribute__((target("avx512f")))
+static size_t argmax_avx512(const float* samples,size_t num_samples)
+{
+	if (num_samples < 32)
+	{
+		return argmax_scalar(samples,num_samples);
+	}
+	__m512 m = _mm512_loadu_ps(samples);
+	size_t i = 16;
+	for (; i + 16 <= num_samples; i += 16)
+	{
+		m = _mm512_max_ps(m,_mm512_loadu_ps(samples + i));
+	}
+	float best = _mm512_reduce_max_ps(m);
+	size_t tail = i + argmax_scalar(samples + i,num_samples - i);
+	if (tail < num_samples && samples[tail] > best)
+	{
+		return tail;
+	}
+	__m512 target = _mm512_set1_ps(best);
+	for (size_t j = 0; j < i; j += 16)
+	{
+		__mmask16 mask = _mm512_cmp_ps_mask(_mm512_loadu_ps(samples + j),target,_CMP_EQ_OQ);
+		if (mask)
+		{
+			return j + __builtin_ctz(mask);
+		}
+	}
+	return find_first(samples,i,num_samples,best);
+}
+
+__attribute__((target("avx512f")))
+static void average_channels_avx512(const float* frames,size_t num_frames,int channels,float* out)
+{
+	if (channels == 1)
+	{
+		memcpy(out,frames,sizeof(float)*num_frames);
+		return;
+	}
+	__m512 divisor = _mm512_set1_ps(channels);
+	size_t k = 0;
+	if (channels == 2)
+	{
+		__m512i left = _mm512_setr_epi32(0,2,4,6,8,10,12,14,16,18,20,22,24,26,28,30);
+		__m512i right = _mm512_setr_epi32(1,3,5,7,9,11,13,15,17,19,21,23,25,27,29,31);
+		for (; k + 16 <= num_frames; k += 16)
+		{
+			__m512 v0 = _mm512_loadu_ps(frames + 2*k);
+			__m512 v1 = _mm512_loadu_ps(frames + 2*k + 16);
+			__m512 s = _mm512_add_ps(_mm512_permutex2var_ps(v0,left,v1),_mm512_permutex2var_ps(v0,right,v1));
+			_mm512_storeu_ps(out + k,_mm512_div_ps(s,divisor));
+		}
+	}
+	else
+	{
+		__m512i index = _mm512_mullo_epi32(_mm512_setr_epi32(0,1,2,3,4,5,6,7,8,9,10,11,12,13,14,15),_mm512_set1_epi32(channels));
+		for (; k + 16 <= num_frames; k += 16)
+		{
+			const float* base = frames + k*channels;
+			__m512 s = _mm512_setzero_ps();
+			for (int j = 0; j < channels; j++)
+			{
+				s = _mm512_add_ps(s,_mm512_i32gather_ps(index,base + j,4));
+			}
+			_mm512_storeu_ps(out + k,_mm512_div_ps(s,divisor));
+		}
+	}
+	average_channels_scalar(frames + k*channels,num_frames - k,channels,out + k);
+}
+
+static const shenidam_kernels_t kernels_avx512 = {"avx512",sum_avx512,normalize_avx512,conj_multiply_avx512,argmax_avx512,average_channels_avx512};
+
+#endif
+
+const shenidam_kernels_t* shenidam_get_kernels(int level)
+{
+	switch (level)
+	{
+	case KERNELS_SCALAR:
+		return &kernels_scalar;
+#ifdef SHENIDAM_KERNELS_X86
+	case KERNELS_SSE2:
+		__builtin_cpu_init();
+		return __builtin_cpu_supports("sse2") ? &kernels_sse2 : NULL;
+	case KERNELS_AVX2:
+		__builtin_cpu_init();
+		return __builtin_cpu_supports("avx2") && __builtin_cpu_supports("fma") ? &kernels_avx2 : NULL;
+	case KERNELS_AVX512:
+		__builtin_cpu_init();
+		return __builtin_cpu_supports("avx512f") ? &kernels_avx512 : NULL;
+#endif
+	default:
+		return NULL;
+	}
+}
+
+static pthread_once_t best_kernels_once = PTHREAD_ONCE_INIT;
+static const shenidam_kernels_t* best_kernels = &kernels_scalar;
+
+static void choose_kernels(void)
+{
+	for (int level = NUM_KERNELS - 1; level > KERNELS_SCALAR; level--)
+	{
+		const shenidam_kernels_t* kernels = shenidam_get_kernels(level);
+		if (kernels != NULL)
+		{
+			best_kernels = kernels;
+			return;
+		}
+	}
+}
+
+const shenidam_kernels_t* shenidam_best_kernels(void)
+{
+	pthread_once(&best_kernels_once,choose_kernels);
+	return best_kernels;
+}
@@ -0,0 +1,64 @@
+/*
+    Copyright 2010 Nabil Stendardo <nabil@stendardo.org>
+
+    This file is part of Shenidam.
+
+    Shenidam is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) version 2 of the same License.
+
+    Shenidam is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with Shenidam.  If not, see <http://www.gnu.org/licenses/>.
+
+ */
+#ifndef SHENIDAM_KERNELS_H
+#define SHENIDAM_KERNELS_H
+
+#include <stddef.h>
+
+#ifdef __cplusplus
+extern "C" {
+#endif
+
+/* The per-sample loops of the library and of the command line client, in one version per instruction set. */
+typedef struct
+{
+	const char* name;
+	/* The sum and the sum of squares of the samples. */
+	void (*sum)(const float* samples,size_t num_samples,double* sum,double* sum_sq);
+	/* samples[i] = (samples[i] - mean)*inverse_scale */
+	void (*normalize)(float* samples,size_t num_samples,float mean,float inverse_scale);
+	/* out[i] = conj(a[i])*b[i], on num_values interleaved complex values (out may be b). */
+	void (*conj_multiply)(const float* a,const float* b,float* out,size_t num_values);
+	/* The index of the first largest sample (0 when there is none). */
+	size_t (*argmax)(const float* samples,size_t num_samples);
+	/* The average of the channels of each interleaved frame. */
+	void (*average_channels)(const float* frames,size_t num_frames,int channels,float* out);
+} shenidam_kernels_t;
+
+enum SHENIDAM_KERNELS
+{
+	KERNELS_SCALAR,
+	KERNELS_SSE2,
+	KERNELS_AVX2,
+	KERNELS_AVX512,
+	NUM_KERNELS
+};
+
+/* The kernels of that level, or NULL if they are not built or the processor does not support them. */
+const shenidam_kernels_t* shenidam_get_kernels(int level);
+
+/* The kernels of the highest level supported, chosen once. */
+const shenidam_kernels_t* shenidam_best_kernels(void);
+
+#ifdef __cplusplus
+}
+#endif
+
+#endif
@@ -36,10 +36,16 @@
 #include <cstring>
 #include <sstream>
 #include <thread>
+#include <mutex>
+#include <atomic>
 #include <iostream>
+#include <cctype>
+#include <cinttypes>
+#include <algorithm>
 
 
 #include "shenidam.h"
+#include "shenidam_kernels.h"
 #include "samplerate.h"
 #include "sndfile.h"
 
@@ -51,27 +57,31 @@ template<typename T> std::string to_string(T value)
     ss << value;
     return ss.str();
 }
+/*
+ * Reads the whole file, averaging the channels block by block. The file may be a pipe
+ * of unknown length: info->frames is set to the number of frames actually read.
+ */
 static int read_sndfile_average(SNDFILE* sndfile,SF_INFO* info,float** result)
 {
-	size_t n = (size_t) std::ceil(info->frames/1024.0);
-	float *res = *result =(float*) std::malloc(sizeof(float)*n*1024);
-	float* frame = (float*)std::malloc(sizeof(float)*info->channels*1024);
-
-	for (size_t i = 0; i < n;i++)
+	const sf_count_t block = 1024;
+	size_t capacity = info->seekable && info->frames > 0 ? (size_t)info->frames : 1024*1024;
+	size_t num_frames = 0;
+	float *res = (float*) std::malloc(sizeof(float)*capacity);
+	float* frame = (float*)std::malloc(sizeof(float)*info->channels*block);
+	sf_count_t read;
+	while((read = sf_readf_float(sndfile,frame,block)) > 0)
 	{
-
-		sf_readf_float(sndfile,frame,1024);
-		for (int k = 0; k < 1024; k++)
+		if (num_frames + read > capacity)
 		{
-			float s = 0;
-			for (int j = 0 ; j < info->channels; j++)
-			{
-				s+=frame[k*info->channels + j];
-			}
-			res[i*1024+k]=s/info->channels;
+			capacity = 2*capacity > num_frames + read ? 2*capacity : num_frames + read;
+			res = (float*) std::realloc(res,sizeof(float)*capacity);
 		}
+		shenidam_best_kernels()->average_channels(frame,read,info->channels,res+num_frames);
+		num_frames += read;
 	}
 	std::free(frame);
+	info->frames = num_frames;
+	*result = res;
 	return 0;
 }
 bool quiet = false;
@@ -81,10 +91,14 @@ bool base_set = false;
 bool default_output = false;
 bool send_messages = false;
 bool can_open_mode = false;
+bool server_mode = false;
+bool low_memory = false;
+bool timings = false;
 double size_test_track = 300;
 std::vector<std::string> in_tracks;
 std::vector<std::string> out_tracks;
 std::string base_filename;
+std::vector<std::string> alternative_bases;
 double sample_rate = 1000;
 int num_files = 0;
 double threshold = 1;
@@ -92,40 +106,300 @@ int num_tries = 5;
 bool return_only = false;
 bool version = false;
 int num_threads = 1;
+int num_jobs = 1;
 int src_converter = SRC_SINC_FASTEST;
+int planner_rigor = PLANNER_ESTIMATE;
+double block_length = 0;
+std::string wisdom_filename;
 #ifdef SHENIDAM_ENABLE_TEST_MODE
 boost::mt19937 gen(std::time(0));
 #endif
 
 
-void send_message(std::string event)
+std::string format_message(std::string event)
 {
-    if (send_messages)
+    return "MESSAGE:" + event + ";";
+}
+
+std::string format_message(std::string event,std::string key,std::string value)
+{
+    return "MESSAGE:" + event + ";" + key + ":" + value + ";";
+}
+
+std::string format_message(std::string event,std::map<std::string,std::string> kv)
+{
+    std::string res = "MESSAGE:" + event + ";";
+    for(std::map<std::string,std::string>::iterator p =kv.begin();p!= kv.end();p++)
     {
-        std::cout << "MESSAGE:"<< event << ";" << std::endl;
+        res += p->first + ":" + p->second + ";";
     }
+    return res;
 }
 
-void send_message(std::string event,std::string key,std::string value)
+void print_message(const std::string& message)
 {
     if (send_messages)
     {
-        std::cout << "MESSAGE:"<< event << ";" << key << ":" << value << ";" << std::endl;
+        std::cout << message << std::endl;
     }
 }
 
+void send_message(std::string event)
+{
+    print_message(format_message(event));
+}
+
+void send_message(std::string event,std::string key,std::string value)
+{
+    print_message(format_message(event,key,value));
+}
+
 void send_message(std::string event,std::map<std::string,std::string> kv)
 {
-    
-    if (send_messages)
+    print_message(format_message(event,kv));
+}
+
+/*
+ * Messages of tracks mapped concurrently, printed in track order: the messages of the
+ * first unfinished track are printed as they come, the others are held until it finishes.
+ */
+class OrderedMessages
+{
+public:
+    OrderedMessages(int num_tracks) : messages(num_tracks), finished(num_tracks,false), next(0)
+    {
+    }
+    void add(int track,const std::string& message)
+    {
+        std::lock_guard<std::mutex> guard(lock);
+        if (track == next)
+        {
+            print_message(message);
+        }
+        else
+        {
+            messages[track].push_back(message);
+        }
+    }
+    void finish(int track)
+    {
+        std::lock_guard<std::mutex> guard(lock);
+        finished[track] = true;
+        while (next < (int)finished.size() && finished[next])
+        {
+            next++;
+            if (next < (int)finished.size())
+            {
+                for (size_t i = 0; i < messages[next].size(); i++)
+                {
+                    print_message(messages[next][i]);
+                }
+                messages[next].clear();
+            }
+        }
+    }
+private:
+    std::vector<std::vector<std::string> > messages;
+    std::vector<bool> finished;
+    int next;
+    std::mutex lock;
+};
+/*
+ * Just enough JSON for the server mode: requests are flat objects whose values are strings,
+ * numbers, booleans or null. Values are stored without their quotes.
+ */
+static void skip_whitespace(const std::string& s,size_t& p)
+{
+    while (p < s.size() && std::isspace((unsigned char)s[p]))
     {
-        std::cout << "MESSAGE:"<<event<<";";
-        for(std::map<std::string,std::string>::iterator p =kv.begin();p!= kv.end();p++)
+        p++;
+    }
+}
+static bool parse_json_string(const std::string& s,size_t& p,std::string& out)
+{
+    if (p >= s.size() || s[p] != '"')
+    {
+        return false;
+    }
+    p++;
+    out.clear();
+    while (p < s.size() && s[p] != '"')
+    {
+        char c = s[p++];
+        if (c != '\\')
+        {
+            out += c;
+            continue;
+        }
+        if (p >= s.size())
+        {
+            return false;
+        }
+        c = s[p++];
+        switch (c)
         {
-            std::cout << p->first << ":" << p->second << ";";
+            case '"':
+            case '\\':
+            case '/':
+                out += c;
+                break;
+            case 'b':
+                out += '\b';
+                break;
+            case 'f':
+                out += '\f';
+                break;
+            case 'n':
+                out += '\n';
+                break;
+            case 'r':
+                out += '\r';
+                break;
+            case 't':
+                out += '\t';
+                break;
+            case 'u':
+            {
+                if (p + 4 > s.size())
+                {
+                    return false;
+                }
+                unsigned long code = strtoul(s.substr(p,4).c_str(),NULL,16);
+                p += 4;
+                if (code < 0x80)
+                {
+                    out += (char)code;
+                }
+                else if (code < 0x800)
+                {
+                    out += (char)(0xC0 | (code >> 6));
+                    out += (char)(0x80 | (code & 0x3F));
+                }
+                else
+                {
+                    out += (char)(0xE0 | (code >> 12));
+                    out += (char)(0x80 | ((code >> 6) & 0x3F));
+                    out += (char)(0x80 | (code & 0x3F));
+                }
+                break;
+            }
+            default:
+                return false;
         }
-        std::cout << std::endl;
     }
+    if (p >= s.size())
+    {
+        return false;
+    }
+    p++;
+    return true;
+}
+bool parse_json_object(const std::string& s,std::map<std::string,std::string>& res)
+{
+    size_t p = 0;
+    skip_whitespace(s,p);
+    if (p >= s.size() || s[p++] != '{')
+    {
+        return false;
+    }
+    skip_whitespace(s,p);
+    if (p < s.size() && s[p] == '}')
+    {
+        p++;
+    }
+    else
+    {
+        while (true)
+        {
+            std::string key,value;
+            skip_whitespace(s,p);
+            if (!parse_json_string(s,p,key))
+            {
+                return false;
+            }
+            skip_whitespace(s,p);
+            if (p >= s.size() || s[p++] != ':')
+            {
+                return false;
+            }
+            skip_whitespace(s,p);
+            if (p < s.size() && s[p] == '"')
+            {
+                if (!parse_json_string(s,p,value))
+                {
+                    return false;
+                }
+            }
+            else
+            {
+                size_t start = p;
+                while (p < s.size() && s[p] != ',' && s[p] != '}' && !std::isspace((unsigned char)s[p]))
+                {
+                    p++;
+                }
+                value = s.substr(start,p-start);
+                if (value.empty() || value[0] == '{' || value[0] == '[')
+                {
+                    return false;
+                }
+            }
+            res[key] = value;
+            skip_whitespace(s,p);
+            if (p >= s.size())
+            {
+                return false;
+            }
+            char c = s[p++];
+            if (c == '}')
+            {
+                break;
+            }
+            if (c != ',')
+            {
+                return false;
+            }
+        }
+    }
+    skip_whitespace(s,p);
+    return p == s.size();
+}
+std::string json_string(const std::string& s)
+{
+    std::string res = "\"";
+    for (size_t i = 0; i < s.size(); i++)
+    {
+        unsigned char c = s[i];
+        if (c == '"' || c == '\\')
+        {
+            res += '\\';
+            res += c;
+        }
+        else if (c < 0x20)
+        {
+            char escaped[8];
+            snprintf(escaped,sizeof(escaped),"\\u%04x",c);
+            res += escaped;
+        }
+        else
+        {
+            res += c;
+        }
+    }
+    return res + "\"";
+}
+/* The values of kv are JSON already. */
+std::string format_json(const std::map<std::string,std::string>& kv)
+{
+    std::string res = "{";
+    for(std::map<std::string,std::string>::const_iterator p =kv.begin();p!= kv.end();p++)
+    {
+        if (p != kv.begin())
+        {
+            res += ",";
+        }
+        res += json_string(p->first) + ":" + p->second;
+    }
+    return res + "}";
 }
 #ifdef SHENIDAM_ENABLE_TEST_MODE
 double randn(double m, double s)
@@ -214,6 +488,16 @@ int parse_options(int argc, char** argv)
                return 1;
            }
         }
+        else if (arg == "-j" || arg == "--jobs")
+        {
+           if (i == argc) return 1;
+           num_jobs = strtol(argv[i++],NULL,10);
+           if (num_jobs <= 0)
+           {
+               fprintf(stderr,"ERROR: Invalid number of jobs!\n");
+               return 1;
+           }
+        }
         #ifdef SHENIDAM_ENABLE_TEST_MODE
         else if (arg == "-t" || arg == "--test")
         {
@@ -249,6 +533,11 @@ int parse_options(int argc, char** argv)
             base_filename = argv[i++];
             base_set = true;
         }
+        else if (arg == "-ab" || arg == "--add-base")
+        {
+            if (i == argc) return 1;
+            alternative_bases.push_back(std::string(argv[i++]));
+        }
         else if (arg == "-i" || arg == "--input")
         {
             if (!in_tracks.empty())
@@ -349,6 +638,31 @@ int parse_options(int argc, char** argv)
 				}
 			}
 		}
+        else if (arg == "-P" || arg == "--planner-rigor")
+        {
+            if (i == argc) return 1;
+            planner_rigor = strtol(argv[i++],NULL,10);
+            if (planner_rigor < PLANNER_ESTIMATE || planner_rigor > PLANNER_PATIENT)
+            {
+                fprintf(stderr,"ERROR: Invalid planner rigor. Range is from 0 to 2.\n");
+                return 1;
+            }
+        }
+        else if (arg == "-B" || arg == "--block-size")
+        {
+            if (i == argc) return 1;
+            block_length = strtod(argv[i++],NULL);
+            if (block_length < 0)
+            {
+                fprintf(stderr,"ERROR: Invalid block size.\n");
+                return 1;
+            }
+        }
+        else if (arg == "-W" || arg == "--wisdom-file")
+        {
+            if (i == argc) return 1;
+            wisdom_filename = argv[i++];
+        }
         else if (arg == "-tt" || arg == "--test-threshold")
         {
             if (i == argc) return 1;
@@ -373,6 +687,18 @@ int parse_options(int argc, char** argv)
         {
             can_open_mode = true;
         }
+        else if (arg == "-lm" || arg == "--low-memory")
+        {
+            low_memory = true;
+        }
+        else if (arg == "-tm" || arg == "--timings")
+        {
+            timings = true;
+        }
+        else if (arg == "-S" || arg == "--server")
+        {
+            server_mode = true;
+        }
         else
         {
             return 1;
@@ -386,7 +712,8 @@ void usage()
 			"\t-q\t--quiet\n\t\tsuppress messages\n\n"
 			"\t-v\t--verbose\n\t\tverbose mode\n\n"
 			"\t-b track_filename\n\t--base track_filename\n\t\tset the base track"
-			"\t-i\t--input [filename_1 .. filename_n]\n\t\tset the n input tracks\n\n"
+			"\t-ab\t--add-base track_filename\n\t\tadd a candidate base (may be repeated): each track is mapped to the base it matches best, and position messages gain the base and base_index keys (0 is the -b base)\n\n"
+			"\t-i\t--input [filename_1 .. filename_n]\n\t\tset the n input tracks (which may be pipes or FIFOs carrying a streamable format such as AU)\n\n"
 			"\t-o\t--output [filename_1 .. filename_n]\n\t\tset the n output tracks\n\n"
 			"\t-d\t--default-output [filename_1 .. filename_n]\n\t\tset the n output tracks\n\n"
 			"\t-m\t--send_messages [filename_1 .. filename_n]\n\t\tSend messages/events to standard output\n\n"
@@ -398,111 +725,572 @@ void usage()
 			"\t-nt\t--num-tries integer\n\t\tNumber of tries for test mode (default 5). More means more precise boundary and processing time.\n\n"
 			"\t-tt\t--test-threshold real\n\t\tThreshold for determining a correct match in test mode (Default 1 second)\n\n"
 			"\t-ts\t--test-track-size real\n\t\tSize in seconds of generated track for test mode (Default 120s, needs to be less than the audio signal's length.)\n\n"
-			"\t-c\t--can-open-base\n\t\tTest to see if the base can be opened (and return a non-zero value if not)\n\n"
+			"\t-c\t--can-open-base\n\t\tTest to see if the base, and the input tracks if given (in which case the base is optional), can be opened (and return a non-zero value if any cannot). With -m, a can-open-file, cannot-open-file or file-not-seekable message is sent for each file\n\n"
+			"\t-S\t--server\n\t\tServer mode: read JSON requests from standard input, one per line, and answer each with a JSON line on standard output.\n"
+			"\t\tRequests are {\"command\":\"load-base\",\"file\":...}, {\"command\":\"map\",\"file\":...[,\"output\":...]},\n"
+			"\t\t{\"command\":\"write-slice\",\"file\":...,\"in\":...,\"length\":...} and {\"command\":\"quit\"}. The base set with -b, if any, is loaded first.\n\n"
+			"\t-lm\t--low-memory\n\t\tKeep only the working rate signal of the bases in memory, reading the few seconds of full rate audio needed to refine each position from the base files (which must be seekable)\n\n"
+			"\t-tm\t--timings\n\t\tWith -m, send a stage-timing message per track and stage (decode, resampling, fft, refinement, writing) with its wall time, CPU time and peak buffer size\n\n"
 			"\t-V\t--version\n\t\tPrint shenidam version and return success\n\n"
 			"\t-r\t--shenidam-return-only\n\t\tDo nothing and return success (check and see if the executable works)\n\n"
-			"\t-T\t--num-threads integer\n\t\tNumber of threads for fourier transform (default is number of cores) \n\n");
+			"\t-T\t--num-threads integer\n\t\tNumber of threads for fourier transform (default is number of cores) \n\n"
+			"\t-j\t--jobs integer\n\t\tNumber of tracks mapped concurrently against the base (default 1). Messages are still sent in track order.\n\n"
+			"\t-P\t--planner-rigor [0-2]\n\t\tFFTW planner rigor: 0 estimate, 1 measure, 2 patient (higher plans longer for faster transforms. Default is 0.)\n\n"
+			"\t-B\t--block-size real\n\t\tCorrelate the base by blocks of this many seconds (default 0, the whole base at once). Bounds memory by the block size for very long bases, blocks are processed in parallel when built with OpenMP.\n\n"
+			"\t-W\t--wisdom-file filename\n\t\tLoad FFTW wisdom from this file if it exists, and save the updated wisdom to it when done\n\n");
 
 }
 
+shenidam_t create_processor()
+{
+	if (!wisdom_filename.empty() && shenidam_import_wisdom(wisdom_filename.c_str()) && verbose)
+	{
+		fprintf(stderr,"Could not load wisdom file '%s', starting without wisdom.\n",wisdom_filename.c_str());
+	}
+	shenidam_t processor = shenidam_create(sample_rate,num_threads);
+	shenidam_set_resampling_quality(processor,src_converter);
+	shenidam_set_planner_rigor(processor,planner_rigor);
+	shenidam_set_block_size(processor,block_length);
+	shenidam_set_timings(processor,timings);
+	return processor;
+}
+void save_wisdom()
+{
+	if (!wisdom_filename.empty() && shenidam_export_wisdom(wisdom_filename.c_str()) && !quiet)
+	{
+		fprintf(stderr,"WARNING: Could not save wisdom file '%s'.\n",wisdom_filename.c_str());
+	}
+}
 std::string get_default_output_filename(std::string input_filename)
 {
 	return input_filename + ".shenidam";
 }
+/* Returns the channel average of the file, or NULL if it cannot be opened. */
+float* read_track(const std::string& filename,SF_INFO* info)
+{
+	std::memset(info,0,sizeof(SF_INFO));
+	SNDFILE* track = sf_open(filename.c_str(),SFM_READ,info);
+	if (track == NULL)
+	{
+		return NULL;
+	}
+	float* samples;
+	read_sndfile_average(track,info,&samples);
+	sf_close(track);
+	return samples;
+}
+/* A base file kept open in low memory mode, from which the library reads full rate samples. */
+struct BaseReader
+{
+	SNDFILE* file;
+	SF_INFO info;
+	std::vector<float> frames;
+};
+std::map<shenidam_t,std::vector<BaseReader*> > base_readers;
+
+static size_t read_base_samples(void* read_data,size_t offset,float* buffer,size_t num_samples)
+{
+	const size_t block = 4096;
+	BaseReader* reader = (BaseReader*)read_data;
+	if (sf_seek(reader->file,offset,SEEK_SET) < 0)
+	{
+		return 0;
+	}
+	reader->frames.resize(block*reader->info.channels);
+	size_t num_read = 0;
+	while (num_read < num_samples)
+	{
+		sf_count_t read = sf_readf_float(reader->file,&reader->frames[0],std::min(block,num_samples-num_read));
+		if (read <= 0)
+		{
+			break;
+		}
+		shenidam_best_kernels()->average_channels(&reader->frames[0],read,reader->info.channels,buffer+num_read);
+		num_read += read;
+	}
+	return num_read;
+}
+/*
+ * Reads the base, or in low memory mode opens it for reading through read_base_samples.
+ * Returns false if it cannot be opened (or, in low memory mode, is not seekable).
+ */
+bool open_base(const std::string& filename,SF_INFO* info,float** samples,BaseReader** reader)
+{
+	*samples = NULL;
+	*reader = NULL;
+	if (!low_memory)
+	{
+		*samples = read_track(filename,info);
+		return *samples != NULL;
+	}
+	BaseReader* res = new BaseReader();
+	std::memset(&res->info,0,sizeof(SF_INFO));
+	res->file = sf_open(filename.c_str(),SFM_READ,&res->info);
+	if (res->file == NULL || !res->info.seekable)
+	{
+		if (res->file != NULL)
+		{
+			sf_close(res->file);
+		}
+		delete res;
+		return false;
+	}
+	*info = res->info;
+	*reader = res;
+	return true;
+}
+/* Adds a base opened by open_base to the processor, which then owns its reader. */
+int add_base(shenidam_t processor,float* samples,BaseReader* reader,SF_INFO* info)
+{
+	if (reader == NULL)
+	{
+		int error = shenidam_add_base_audio(processor,FORMAT_SINGLE,(void*)samples,info->frames,(double)info->samplerate,NULL);
+		std::free(samples);
+		return error;
+	}
+	base_readers[processor].push_back(reader);
+	return shenidam_add_base_audio_callback(processor,read_base_samples,reader,info->frames,(double)info->samplerate,NULL);
+}
+void destroy_processor(shenidam_t processor)
+{
+	shenidam_destroy(processor);
+	std::vector<BaseReader*>& readers = base_readers[processor];
+	for (size_t i = 0; i < readers.size(); i++)
+	{
+		sf_close(readers[i]->file);
+		delete readers[i];
+	}
+	base_readers.erase(processor);
+}
+/* Sets the base of a new processor, replacing *processor (a processor's base cannot be set twice). */
+int load_base(shenidam_t* processor,const std::string& filename,SF_INFO* base_info)
+{
+	float* base_b;
+	BaseReader* reader;
+	if (!open_base(filename,base_info,&base_b,&reader))
+	{
+		return 1;
+	}
+	if (*processor != NULL)
+	{
+		destroy_processor(*processor);
+	}
+	*processor = create_processor();
+	return add_base(*processor,base_b,reader,base_info);
+}
+int write_slice(SNDFILE* base,SF_INFO* base_info,const std::string& out_fn,intmax_t in,size_t length)
+{
+	SF_INFO out_info = *base_info;
+	out_info.frames = length;
+	SNDFILE* out = sf_open(out_fn.c_str(),SFM_WRITE,&out_info);
+	if (out == NULL)
+	{
+		fprintf(stderr,"ERROR: Could not open output file '%s'.\n",out_fn.c_str());
+		return 1;
+	}
+	int error = copy_partial_sndfile(base,base_info,out,in,length);
+	sf_close(out);
+	return error;
+}
+/* Wall and CPU time of the calling thread since construction. */
+struct StageClock
+{
+	StageClock() : wall(now(CLOCK_MONOTONIC)), cpu(now(CLOCK_THREAD_CPUTIME_ID)) {}
+	static double now(clockid_t clock)
+	{
+		struct timespec t;
+		clock_gettime(clock,&t);
+		return t.tv_sec + t.tv_nsec*1e-9;
+	}
+	shenidam_stage_timing_t elapsed(size_t peak_bytes) const
+	{
+		shenidam_stage_timing_t res;
+		res.wall_time = now(CLOCK_MONOTONIC) - wall;
+		res.cpu_time = now(CLOCK_THREAD_CPUTIME_ID) - cpu;
+		res.peak_bytes = peak_bytes;
+		return res;
+	}
+	double wall;
+	double cpu;
+};
+std::string format_timing(const std::string& file,const std::string& stage,const shenidam_stage_timing_t& timing)
+{
+	std::map<std::string,std::string> kv;
+	kv["file"]=file;
+	kv["stage"]=stage;
+	kv["wall_time"]=to_string(timing.wall_time);
+	kv["cpu_time"]=to_string(timing.cpu_time);
+	kv["peak_bytes"]=to_string(timing.peak_bytes);
+	return format_message("stage-timing",kv);
+}
+int map_track(shenidam_t processor,int i,std::vector<SNDFILE*>& bases,std::vector<SF_INFO>& base_infos,OrderedMessages& messages)
+{
+	std::string input_fn = in_tracks[i];
+	size_t length;
+	intmax_t in;
+	SF_INFO track_info;
+	StageClock decode_clock;
+	float* track_b = read_track(input_fn,&track_info);
+	if (track_b == NULL)
+	{
+		fprintf(stderr,"ERROR: Could not open track '%s'.\n",input_fn.c_str());
+		return 0;
+	}
+	messages.add(i,format_message("track-read","file",input_fn));
+	if (timings)
+	{
+		messages.add(i,format_timing(input_fn,"decode",decode_clock.elapsed(sizeof(float)*(track_info.frames + 1024*track_info.channels))));
+	}
+	int base_index = 0;
+	int error;
+	if (alternative_bases.empty())
+	{
+		error = shenidam_get_audio_range(processor,FORMAT_SINGLE,(void*)track_b,track_info.frames,(double)track_info.samplerate,&in,&length);
+	}
+	else
+	{
+		error = shenidam_get_best_audio_range(processor,FORMAT_SINGLE,(void*)track_b,track_info.frames,(double)track_info.samplerate,&base_index,&in,&length);
+	}
+	std::free(track_b);
+	if (error)
+	{
+		fprintf(stderr,"ERROR: Error mapping track to base .\n");
+		return 0;
+	}
+	if (timings)
+	{
+		static const char* stage_names[NUM_STAGES] = {"resampling","fft","refinement"};
+		shenidam_stage_timing_t stages[NUM_STAGES];
+		shenidam_get_timings(processor,stages);
+		for (int s = 0; s < NUM_STAGES; s++)
+		{
+			messages.add(i,format_timing(input_fn,stage_names[s],stages[s]));
+		}
+	}
+	std::map<std::string,std::string> kv;
+	kv["determined_in"]=to_string(in);
+	kv["determined_length"]=to_string(length);
+	kv["file"]=input_fn;
+	if (!alternative_bases.empty())
+	{
+		kv["base"]= base_index ? alternative_bases[base_index-1] : base_filename;
+		kv["base_index"]=to_string(base_index);
+	}
+	messages.add(i,format_message("track-position-determined",kv));
+	if (default_output || out_tracks.size())
+	{
+		std::string out_fn;
+		if (default_output)
+		{
+			out_fn = get_default_output_filename(input_fn);
+		}
+		else
+		{
+			out_fn = out_tracks[i];
+		}
+		StageClock write_clock;
+		if (write_slice(bases[base_index],&base_infos[base_index],out_fn,in,length))
+		{
+			return 1;
+		}
+		messages.add(i,format_message("wrote-file","file",out_fn));
+		if (timings)
+		{
+			messages.add(i,format_timing(input_fn,"writing",write_clock.elapsed(sizeof(float)*1024*base_infos[base_index].channels)));
+		}
+	}
+	messages.add(i,format_message("done"));
+	return 0;
+}
+
 int process_audio()
 {
-	shenidam_t processor = shenidam_create(sample_rate,num_threads);
-	shenidam_set_resampling_quality(processor,src_converter);
+	shenidam_t processor = NULL;
+	SF_INFO base_info;
+	if (load_base(&processor,base_filename,&base_info))
+	{
+		fprintf(stderr,"ERROR: Could not load base '%s'.\n",base_filename.c_str());
+		if (processor != NULL)
+		{
+			destroy_processor(processor);
+		}
+		return 1;
+	}
+	send_message("base-read","file",base_filename);
+	std::vector<std::string> base_filenames(1,base_filename);
+	for (size_t b = 0; b < alternative_bases.size(); b++)
+	{
+		SF_INFO info;
+		float* samples;
+		BaseReader* reader;
+		if (!open_base(alternative_bases[b],&info,&samples,&reader))
+		{
+			fprintf(stderr,"ERROR: Could not open base '%s'.\n",alternative_bases[b].c_str());
+			destroy_processor(processor);
+			return 1;
+		}
+		if (add_base(processor,samples,reader,&info))
+		{
+			fprintf(stderr,"ERROR: Could not load base '%s'.\n",alternative_bases[b].c_str());
+			destroy_processor(processor);
+			return 1;
+		}
+		send_message("base-read","file",alternative_bases[b]);
+		base_filenames.push_back(alternative_bases[b]);
+	}
+
+	OrderedMessages messages(num_files);
+	std::atomic<int> next_track(0);
+	std::atomic<bool> failed(false);
+	/* Each worker has its own handles on the bases for writing the mapped slices. */
+	auto worker = [&]()
+	{
+		std::vector<SNDFILE*> worker_bases;
+		std::vector<SF_INFO> infos(base_filenames.size());
+		for (size_t b = 0; b < base_filenames.size(); b++)
+		{
+			std::memset(&infos[b],0,sizeof(SF_INFO));
+			SNDFILE* worker_base = sf_open(base_filenames[b].c_str(),SFM_READ,&infos[b]);
+			if (worker_base == NULL)
+			{
+				failed = true;
+				break;
+			}
+			worker_bases.push_back(worker_base);
+		}
+		int i;
+		while (!failed && (i = next_track++) < num_files)
+		{
+			if (map_track(processor,i,worker_bases,infos,messages))
+			{
+				failed = true;
+			}
+			messages.finish(i);
+		}
+		for (size_t b = 0; b < worker_bases.size(); b++)
+		{
+			sf_close(worker_bases[b]);
+		}
+	};
+	int num_workers = num_jobs < num_files ? num_jobs : num_files;
+	std::vector<std::thread> workers;
+	for (int w = 1; w < num_workers; w++)
+	{
+		workers.push_back(std::thread(worker));
+	}
+	worker();
+	for (size_t w = 0; w < workers.size(); w++)
+	{
+		workers[w].join();
+	}
+	save_wisdom();
+	destroy_processor(processor);
+	return failed ? 1 : 0;
+}
+
+/* Writes the slice [in, in+length) of the base file to out_fn. */
+int write_base_slice(const std::string& base_fn,const std::string& out_fn,intmax_t in,size_t length)
+{
 	SF_INFO base_info;
 	std::memset(&base_info,0,sizeof(SF_INFO));
-	SNDFILE* base = sf_open(base_filename.c_str(),SFM_READ,&base_info);
+	SNDFILE* base = sf_open(base_fn.c_str(),SFM_READ,&base_info);
 	if (base == NULL)
 	{
 		return 1;
 	}
-	float* base_b;
-	read_sndfile_average(base,&base_info,&base_b);
-	shenidam_set_base_audio(processor,FORMAT_SINGLE,(void*)base_b,base_info.frames,(double)base_info.samplerate);
-	send_message("base-read","file",base_filename);
-	std::free(base_b);
-	for (int i = 0; i < num_files; i++)
-	{
-		std::string input_fn = in_tracks[i];
-		size_t length;
-		intmax_t in;
-		SF_INFO track_info;
-		std::memset(&track_info,0,sizeof(SF_INFO));
-		float* track_b;
-		SNDFILE* track = sf_open(input_fn.c_str(),SFM_READ,&track_info);
-		read_sndfile_average(track,&track_info,&track_b);
-		send_message("track-read","file",input_fn);
-		sf_close(track);
-		if (shenidam_get_audio_range(processor,FORMAT_SINGLE,(void*)track_b,track_info.frames,(double)track_info.samplerate,&in,&length))
+	int error = write_slice(base,&base_info,out_fn,in,length);
+	sf_close(base);
+	return error;
+}
+/*
+ * Server mode: the base stays loaded (and its spectrum cached) between requests. Each
+ * request line gets exactly one response line, with "status" "ok" or "error".
+ */
+int serve()
+{
+	shenidam_t processor = NULL;
+	SF_INFO base_info;
+	std::string loaded_base;
+	if (base_set)
+	{
+		if (load_base(&processor,base_filename,&base_info))
+		{
+			fprintf(stderr,"ERROR: Could not load base '%s'.\n",base_filename.c_str());
+			if (processor != NULL)
+			{
+				destroy_processor(processor);
+			}
+			return 1;
+		}
+		loaded_base = base_filename;
+	}
+	std::string line;
+	while (std::getline(std::cin,line))
+	{
+		std::map<std::string,std::string> request;
+		std::map<std::string,std::string> response;
+		std::string error;
+		bool quit = false;
+		if (line.find_first_not_of(" \t\r") == std::string::npos)
 		{
-			fprintf(stderr,"ERROR: Error mapping track to base .\n");
-			std::free(track);
 			continue;
 		}
-		std::map<std::string,std::string> kv;
-		kv["determined_in"]=to_string(in);
-		kv["determined_length"]=to_string(length);
-		kv["file"]=input_fn;
-		send_message("track-position-determined",kv);
-		if (default_output || out_tracks.size())
+		if (!parse_json_object(line,request))
 		{
-			SF_INFO out_info = base_info;
-			out_info.frames = length;
-			std::string out_fn;
-			if (default_output)
+			error = "invalid request";
+		}
+		else
+		{
+			std::string command = request["command"];
+			response["command"] = json_string(command);
+			if (command == "quit")
 			{
-				out_fn = get_default_output_filename(input_fn);
+				quit = true;
 			}
-			else
+			else if (command == "load-base")
 			{
-				out_fn = out_tracks[i];
+				if (!request.count("file"))
+				{
+					error = "missing file";
+				}
+				else if (load_base(&processor,request["file"],&base_info))
+				{
+					error = "could not load base";
+					loaded_base.clear();
+				}
+				else
+				{
+					loaded_base = request["file"];
+					response["file"] = json_string(loaded_base);
+					response["channels"] = to_string(base_info.channels);
+					response["sample_rate"] = to_string(base_info.samplerate);
+					response["length"] = to_string(base_info.frames);
+				}
 			}
-			SNDFILE* out = sf_open(out_fn.c_str(),SFM_WRITE,&out_info);
-			
-			if (copy_partial_sndfile(base,&base_info,out,in,length))
+			else if (command == "map")
 			{
-				sf_close(base);
-				sf_close(out);
-				return 1;
+				SF_INFO track_info;
+				float* track_b = NULL;
+				intmax_t in;
+				size_t length;
+				if (loaded_base.empty())
+				{
+					error = "no base loaded";
+				}
+				else if (!request.count("file"))
+				{
+					error = "missing file";
+				}
+				else if ((track_b = read_track(request["file"],&track_info)) == NULL)
+				{
+					error = "could not open track";
+				}
+				else if (shenidam_get_audio_range(processor,FORMAT_SINGLE,(void*)track_b,track_info.frames,(double)track_info.samplerate,&in,&length))
+				{
+					error = "could not map track";
+				}
+				else
+				{
+					response["file"] = json_string(request["file"]);
+					response["determined_in"] = to_string(in);
+					response["determined_length"] = to_string(length);
+					if (request.count("output"))
+					{
+						if (write_base_slice(loaded_base,request["output"],in,length))
+						{
+							error = "could not write slice";
+						}
+						response["output"] = json_string(request["output"]);
+					}
+				}
+				std::free(track_b);
 			}
-			send_message("wrote-file","file",out_fn);
-			sf_close(out);
+			else if (command == "write-slice")
+			{
+				if (loaded_base.empty())
+				{
+					error = "no base loaded";
+				}
+				else if (!request.count("file") || !request.count("in") || !request.count("length"))
+				{
+					error = "missing file, in or length";
+				}
+				else if (write_base_slice(loaded_base,request["file"],strtoimax(request["in"].c_str(),NULL,10),(size_t)strtoull(request["length"].c_str(),NULL,10)))
+				{
+					error = "could not write slice";
+				}
+				else
+				{
+					response["file"] = json_string(request["file"]);
+				}
+			}
+			else
+			{
+				error = "unknown command";
+			}
+		}
+		response["status"] = json_string(error.empty() ? "ok" : "error");
+		if (!error.empty())
+		{
+			response["error"] = json_string(error);
+		}
+		std::cout << format_json(response) << std::endl;
+		if (quit)
+		{
+			break;
 		}
-        send_message("done");
 	}
-	sf_close(base);
+	save_wisdom();
+	if (processor != NULL)
+	{
+		destroy_processor(processor);
+	}
 	return 0;
 }
 
-int file_info()
+int check_file(const std::string& filename)
 {
-    SF_INFO base_info;
-	std::memset(&base_info,0,sizeof(SF_INFO));
-	SNDFILE* base = sf_open(base_filename.c_str(),SFM_READ,&base_info);
-	if (base == NULL)
+    SF_INFO info;
+	std::memset(&info,0,sizeof(SF_INFO));
+	SNDFILE* file = sf_open(filename.c_str(),SFM_READ,&info);
+	if (file == NULL)
 	{
-	    send_message("cannot-open-file","file",base_filename);
+	    send_message("cannot-open-file","file",filename);
 	    return 1;
 	}
-	if (!base_info.seekable)
+	if (!info.seekable)
 	{
-		send_message("file-not-seekable","file",base_filename);
+		send_message("file-not-seekable","file",filename);
+		sf_close(file);
 		return 1;
 	}
 	std::map<std::string,std::string> kv;
-    kv["file"]=base_filename;
-    kv["channels"]= to_string(base_info.channels);
-    kv["sample_rate"]= to_string(base_info.samplerate);
-    kv["length"]= to_string(base_info.frames);
+    kv["file"]=filename;
+    kv["channels"]= to_string(info.channels);
+    kv["sample_rate"]= to_string(info.samplerate);
+    kv["length"]= to_string(info.frames);
 	send_message("can-open-file",kv);
-	sf_close(base);
+	sf_close(file);
 	return 0;
 }
 
+/* Checks the base and the input tracks, with one message each. Returns non-zero if any of them cannot be used. */
+int file_info()
+{
+	std::vector<std::string> filenames;
+	if (base_set)
+	{
+		filenames.push_back(base_filename);
+	}
+	filenames.insert(filenames.end(),in_tracks.begin(),in_tracks.end());
+	int res = 0;
+	for (size_t i = 0; i < filenames.size(); i++)
+	{
+		res |= check_file(filenames[i]);
+	}
+	return res;
+}
+
 #ifdef SHENIDAM_ENABLE_TEST_MODE
 
 bool test_once(shenidam_t processor, float* base,size_t total_num_samples,double sample_rate,size_t num_samples_track, double sigma)
@@ -557,8 +1345,7 @@ bool test_n(shenidam_t processor, float* base,size_t total_num_samples,double sa
 }
 int do_test()
 {
-	shenidam_t processor = shenidam_create(sample_rate,num_threads);
-	shenidam_set_resampling_quality(processor,src_converter);
+	shenidam_t processor = create_processor();
 	SF_INFO base_info;
 	std::memset(&base_info,0,sizeof(SF_INFO));
 	SNDFILE* base = sf_open(base_filename.c_str(),SFM_READ,&base_info);
@@ -601,6 +1388,7 @@ int do_test()
 	double cnsd_db = 10*log(1/(critical_noise_sd*critical_noise_sd));
 	printf("Critical noise %g (%g db)\n",critical_noise_sd,cnsd_db);
 	std::free(base_b);
+	save_wisdom();
 	shenidam_destroy(processor);
 	return 0;
 }
@@ -632,7 +1420,11 @@ int main(int argc, char **argv) {
 	{
 		verbose = false;
 	}
-	if (!base_set)
+	if (server_mode)
+	{
+		return serve();
+	}
+	if (!base_set && !(can_open_mode && in_tracks.size()))
 	{
 		fprintf(stderr,"ERROR: A base file is required.\n");
 		usage();
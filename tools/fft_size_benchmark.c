@@ -0,0 +1,219 @@
+/*
+    Copyright 2010 Nabil Stendardo <nabil@stendardo.org>
+
+    This file is part of Shenidam.
+
+    Shenidam is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) version 2 of the same License.
+
+    Shenidam is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with Shenidam.  If not, see <http://www.gnu.org/licenses/>.
+
+ */
+
+/*
+ * Compares the transform size policies of shenidam_get_audio_range over a sweep of base and
+ * track lengths. Each measurement runs in its own process, so that its peak resident memory
+ * can be reported. Prints one tab-separated line per base length, track length and policy,
+ * then one per base length and policy for mapping tracks of varying lengths (a tenth to a third
+ * of the base) against the same base, from a cold start, which is what a run or the server does.
+ */
+
+#define _DEFAULT_SOURCE /* wait4 */
+#define _POSIX_C_SOURCE 200809L
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <time.h>
+#include <unistd.h>
+#include <sys/types.h>
+#include <sys/wait.h>
+#include <sys/resource.h>
+#include "shenidam.h"
+
+static const double base_lengths[] = {600, 1000, 1800, 3600, 7200};
+static const double track_lengths[] = {30, 120, 600};
+static const double sample_rate = 1000;
+static const int num_varying_tracks = 20;
+
+static unsigned int seed = 1;
+static float noise(void)
+{
+	seed = seed*1103515245u+12345u;
+	return ((seed>>8)&0xffff)/32768.0f-1.0f;
+}
+
+static double now(void)
+{
+	struct timespec t;
+	clock_gettime(CLOCK_MONOTONIC,&t);
+	return t.tv_sec + t.tv_nsec*1e-9;
+}
+
+static float* make_base(size_t base_samples)
+{
+	float* base = malloc(sizeof(float)*base_samples);
+	if (base == NULL)
+	{
+		return NULL;
+	}
+	float acc = 0;
+	for (size_t i = 0; i < base_samples; i++)
+	{
+		acc = 0.5f*acc + noise();
+		base[i] = acc;
+	}
+	return base;
+}
+
+/* The mean time (in seconds) of mapping a track once the plans and the base spectrum exist, or a negative value on error. */
+static double measure(size_t base_samples,size_t track_samples,int fft_sizes,int repeats)
+{
+	float* base = make_base(base_samples);
+	if (base == NULL)
+	{
+		return -1;
+	}
+	shenidam_t processor = shenidam_create(sample_rate,1);
+	shenidam_set_fft_sizes(processor,fft_sizes);
+	double res = -1;
+	if (!shenidam_set_base_audio(processor,FORMAT_SINGLE,base,base_samples,sample_rate))
+	{
+		float* track = base + (base_samples - track_samples)/3;
+		intmax_t in;
+		size_t length;
+		int error = shenidam_get_audio_range(processor,FORMAT_SINGLE,track,track_samples,sample_rate,&in,&length);
+		double start = now();
+		for (int i = 0; i < repeats && !error; i++)
+		{
+			error = shenidam_get_audio_range(processor,FORMAT_SINGLE,track,track_samples,sample_rate,&in,&length);
+		}
+		if (!error)
+		{
+			res = (now() - start)/repeats;
+		}
+	}
+	shenidam_destroy(processor);
+	free(base);
+	return res;
+}
+
+/* The total time (in seconds) of mapping num_varying_tracks tracks of different lengths, or a negative value on error. */
+static double measure_varying(size_t base_samples,int fft_sizes)
+{
+	float* base = make_base(base_samples);
+	if (base == NULL)
+	{
+		return -1;
+	}
+	double start = now();
+	shenidam_t processor = shenidam_create(sample_rate,1);
+	shenidam_set_fft_sizes(processor,fft_sizes);
+	int error = shenidam_set_base_audio(processor,FORMAT_SINGLE,base,base_samples,sample_rate);
+	for (int i = 0; i < num_varying_tracks && !error; i++)
+	{
+		/* Spread over the lengths in an order that does not grow steadily. */
+		int step = (i*7)%num_varying_tracks;
+		size_t track_samples = base_samples/10 + (base_samples/3 - base_samples/10)*step/(num_varying_tracks-1);
+		intmax_t in;
+		size_t length;
+		error = shenidam_get_audio_range(processor,FORMAT_SINGLE,base + (base_samples - track_samples)/3,track_samples,sample_rate,&in,&length);
+	}
+	shenidam_destroy(processor);
+	free(base);
+	return error ? -1 : now() - start;
+}
+
+/* Runs measure (or measure_varying if track_samples is 0) in a child process, giving its result and peak resident memory. */
+static int run_child(size_t base_samples,size_t track_samples,int fft_sizes,int repeats,double* seconds,long* max_rss_kb)
+{
+	int fds[2];
+	if (pipe(fds))
+	{
+		perror("pipe");
+		return 1;
+	}
+	fflush(stdout);
+	pid_t pid = fork();
+	if (pid < 0)
+	{
+		perror("fork");
+		return 1;
+	}
+	if (pid == 0)
+	{
+		close(fds[0]);
+		double res = track_samples > 0 ? measure(base_samples,track_samples,fft_sizes,repeats) : measure_varying(base_samples,fft_sizes);
+		ssize_t written = write(fds[1],&res,sizeof(res));
+		_exit(written == sizeof(res) ? 0 : 1);
+	}
+	close(fds[1]);
+	if (read(fds[0],seconds,sizeof(*seconds)) != sizeof(*seconds))
+	{
+		*seconds = -1;
+	}
+	close(fds[0]);
+	int status;
+	struct rusage usage;
+	wait4(pid,&status,0,&usage);
+	*max_rss_kb = usage.ru_maxrss;
+	return 0;
+}
+
+int main(int argc,char** argv)
+{
+	int repeats = argc > 1 ? atoi(argv[1]) : 3;
+	if (repeats <= 0)
+	{
+		fprintf(stderr,"USAGE: %s [repeats]\n",argv[0]);
+		return 1;
+	}
+	const char* names[] = {"smooth","power-of-two"};
+	double seconds;
+	long max_rss_kb;
+	printf("base_seconds\ttrack_seconds\tfft_sizes\ttime_ms\tmax_rss_kb\n");
+	for (size_t b = 0; b < sizeof(base_lengths)/sizeof(base_lengths[0]); b++)
+	{
+		for (size_t t = 0; t < sizeof(track_lengths)/sizeof(track_lengths[0]); t++)
+		{
+			for (int fft_sizes = FFT_SIZES_SMOOTH; fft_sizes <= FFT_SIZES_POWER_OF_TWO; fft_sizes++)
+			{
+				if (run_child(base_lengths[b]*sample_rate,track_lengths[t]*sample_rate,fft_sizes,repeats,&seconds,&max_rss_kb))
+				{
+					return 1;
+				}
+				if (seconds < 0)
+				{
+					fprintf(stderr,"ERROR: measurement failed for a %gs base and a %gs track\n",base_lengths[b],track_lengths[t]);
+					return 1;
+				}
+				printf("%g\t%g\t%s\t%.2f\t%ld\n",base_lengths[b],track_lengths[t],names[fft_sizes],seconds*1000,max_rss_kb);
+			}
+		}
+	}
+	printf("\nbase_seconds\tvarying_tracks\tfft_sizes\ttotal_time_ms\tmax_rss_kb\n");
+	for (size_t b = 0; b < sizeof(base_lengths)/sizeof(base_lengths[0]); b++)
+	{
+		for (int fft_sizes = FFT_SIZES_SMOOTH; fft_sizes <= FFT_SIZES_POWER_OF_TWO; fft_sizes++)
+		{
+			if (run_child(base_lengths[b]*sample_rate,0,fft_sizes,0,&seconds,&max_rss_kb))
+			{
+				return 1;
+			}
+			if (seconds < 0)
+			{
+				fprintf(stderr,"ERROR: measurement failed for a %gs base and varying tracks\n",base_lengths[b]);
+				return 1;
+			}
+			printf("%g\t%d\t%s\t%.2f\t%ld\n",base_lengths[b],num_varying_tracks,names[fft_sizes],seconds*1000,max_rss_kb);
+		}
+	}
+	return 0;
+}
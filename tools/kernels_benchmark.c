@@ -0,0 +1,179 @@
+/*
+    Copyright 2010 Nabil Stendardo <nabil@stendardo.org>
+
+    This file is part of Shenidam.
+
+    Shenidam is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) version 2 of the same License.
+
+    Shenidam is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with Shenidam.  If not, see <http://www.gnu.org/licenses/>.
+
+ */
+
+/*
+ * Times each vector version of the per-sample kernels against the scalar reference, and checks that
+ * it gives the same result. Prints one tab-separated line per kernel, instruction set and length.
+ */
+
+#define _POSIX_C_SOURCE 200809L
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <math.h>
+#include <time.h>
+#include "shenidam_kernels.h"
+
+static const size_t lengths[] = {4096, 262144, 4194304};
+static const int channels = 2;
+
+static unsigned int seed = 1;
+static float noise(void)
+{
+	seed = seed*1103515245u+12345u;
+	return ((seed>>8)&0xffff)/32768.0f-1.0f;
+}
+
+static double now(void)
+{
+	struct timespec t;
+	clock_gettime(CLOCK_MONOTONIC,&t);
+	return t.tv_sec + t.tv_nsec*1e-9;
+}
+
+enum
+{
+	KERNEL_SUM,
+	KERNEL_NORMALIZE,
+	KERNEL_CONJ_MULTIPLY,
+	KERNEL_ARGMAX,
+	KERNEL_AVERAGE_CHANNELS,
+	NUM_KERNEL_FUNCTIONS
+};
+static const char* kernel_names[] = {"sum","normalize","conj_multiply","argmax","average_channels"};
+
+/* Runs one kernel over the inputs, leaving its result in out (as floats), and returns the time taken. */
+static double run(const shenidam_kernels_t* kernels,int kernel,const float* a,const float* b,float* out,size_t n)
+{
+	double start = now();
+	switch (kernel)
+	{
+	case KERNEL_SUM:
+	{
+		double sum,sum_sq;
+		kernels->sum(a,n,&sum,&sum_sq);
+		out[0] = sum;
+		out[1] = sum_sq;
+		break;
+	}
+	case KERNEL_NORMALIZE:
+		memcpy(out,a,sizeof(float)*n);
+		start = now();
+		kernels->normalize(out,n,0.25f,0.5f);
+		break;
+	case KERNEL_CONJ_MULTIPLY:
+		kernels->conj_multiply(a,b,out,n/2);
+		break;
+	case KERNEL_ARGMAX:
+		out[0] = kernels->argmax(a,n);
+		break;
+	case KERNEL_AVERAGE_CHANNELS:
+		kernels->average_channels(a,n/channels,channels,out);
+		break;
+	}
+	return now() - start;
+}
+
+static size_t result_size(int kernel,size_t n)
+{
+	switch (kernel)
+	{
+	case KERNEL_SUM:
+		return 2;
+	case KERNEL_ARGMAX:
+		return 1;
+	case KERNEL_AVERAGE_CHANNELS:
+		return n/channels;
+	default:
+		return n;
+	}
+}
+
+/* The largest difference between the results, relative to the largest reference value. */
+static double difference(const float* reference,const float* result,size_t n)
+{
+	double largest = 0;
+	double diff = 0;
+	for (size_t i = 0; i < n; i++)
+	{
+		largest = fmax(largest,fabs(reference[i]));
+		diff = fmax(diff,fabs(reference[i] - result[i]));
+	}
+	return largest > 0 ? diff/largest : diff;
+}
+
+int main(int argc,char** argv)
+{
+	int repeats = argc > 1 ? atoi(argv[1]) : 20;
+	if (repeats <= 0)
+	{
+		fprintf(stderr,"USAGE: %s [repeats]\n",argv[0]);
+		return 1;
+	}
+	size_t longest = lengths[sizeof(lengths)/sizeof(lengths[0]) - 1];
+	float* a = malloc(sizeof(float)*longest);
+	float* b = malloc(sizeof(float)*longest);
+	float* reference = malloc(sizeof(float)*longest);
+	float* out = malloc(sizeof(float)*longest);
+	if (a == NULL || b == NULL || reference == NULL || out == NULL)
+	{
+		fprintf(stderr,"ERROR: out of memory\n");
+		return 1;
+	}
+	for (size_t i = 0; i < longest; i++)
+	{
+		a[i] = noise();
+		b[i] = noise();
+	}
+	const shenidam_kernels_t* scalar = shenidam_get_kernels(KERNELS_SCALAR);
+	printf("kernel\tkernels\tsamples\tns_per_sample\tspeedup\trelative_difference\n");
+	for (int kernel = 0; kernel < NUM_KERNEL_FUNCTIONS; kernel++)
+	{
+		for (size_t l = 0; l < sizeof(lengths)/sizeof(lengths[0]); l++)
+		{
+			size_t n = lengths[l];
+			double scalar_time = 0;
+			for (int level = KERNELS_SCALAR; level < NUM_KERNELS; level++)
+			{
+				const shenidam_kernels_t* kernels = shenidam_get_kernels(level);
+				if (kernels == NULL)
+				{
+					continue;
+				}
+				double best = INFINITY;
+				for (int i = 0; i < repeats; i++)
+				{
+					best = fmin(best,run(kernels,kernel,a,b,out,n));
+				}
+				if (kernels == scalar)
+				{
+					scalar_time = best;
+					memcpy(reference,out,sizeof(float)*result_size(kernel,n));
+				}
+				printf("%s\t%s\t%zu\t%.3f\t%.2f\t%g\n",kernel_names[kernel],kernels->name,n,best*1e9/n,scalar_time/best,difference(reference,out,result_size(kernel,n)));
+			}
+		}
+	}
+	free(a);
+	free(b);
+	free(reference);
+	free(out);
+	return 0;
+}
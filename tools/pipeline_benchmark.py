@@ -0,0 +1,377 @@
+"""
+    Copyright 2010 Nabil Stendardo <nabil@stendardo.org>
+
+    This file is part of Shenidam.
+
+    Shenidam is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) version 2 of the same License.
+
+    Shenidam is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with Shenidam.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+# Times the alignment of synthetic bases and tracks, through the whole shenidam-av pipeline (avconv and the shenidam
+# executable) and through the library alone, and writes the results as JSON. Each case runs in its own process, so
+# that its peak RSS is its own. Given a previous result file, the cases that got slower or bigger are reported. Cases
+# that leave a track unmapped are reported as failed, and the run then returns non-zero.
+from __future__ import print_function
+from __future__ import division
+from __future__ import unicode_literals
+import sys
+import os
+import json
+import time
+import shutil
+import struct
+import tempfile
+import platform
+import resource
+import threading
+import itertools
+import subprocess
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),"..","python"))
+import shenidam
+import numpy
+
+MODES = ("pipeline","matcher")
+# The metrics compared with the baseline, which regress when they grow.
+METRICS = ("wall_time","peak_rss_bytes","peak_child_rss_bytes","peak_temp_bytes")
+
+class Settings(object):
+    modes = list(MODES)
+    base_lengths = [60.0]
+    base_rates = [48000]
+    track_rates = [44100]
+    channels = [2]
+    track_length = 10.0
+    num_tracks = 3
+    repeats = 3
+    seed = 1
+    data_dir = os.path.join(tempfile.gettempdir(),"shenidam-benchmark")
+    output = None
+    baseline = None
+    threshold = 0.2
+    min_time_difference = 0.01
+    shenidam = "shenidam"
+    avconv = "avconv"
+    library = None
+    shenidam_params = ""
+
+def parse_list(string,convert):
+    return [convert(x) for x in string.split(",") if x.strip()]
+def parse_params(settings,argv):
+    options = {
+        "-m":("modes",lambda x:parse_list(x,str)),
+        "-bl":("base_lengths",lambda x:parse_list(x,float)),
+        "-br":("base_rates",lambda x:parse_list(x,int)),
+        "-tr":("track_rates",lambda x:parse_list(x,int)),
+        "-ch":("channels",lambda x:parse_list(x,int)),
+        "-tl":("track_length",float),
+        "-n":("num_tracks",int),
+        "-r":("repeats",int),
+        "-sd":("seed",int),
+        "-d":("data_dir",str),
+        "-o":("output",str),
+        "-c":("baseline",str),
+        "-t":("threshold",float),
+        "-se":("shenidam",str),
+        "-ae":("avconv",str),
+        "-sl":("library",str),
+        "-sp":("shenidam_params",str),
+    }
+    i = 1
+    while i < len(argv):
+        if argv[i] not in options or i+1 == len(argv):
+            return 1
+        key,convert = options[argv[i]]
+        try:
+            setattr(settings,key,convert(argv[i+1]))
+        except ValueError:
+            return 1
+        i+=2
+    if not settings.modes or any(x not in MODES for x in settings.modes) or settings.repeats <= 0 or settings.num_tracks <= 0:
+        return 1
+    return 0
+def usage():
+    print("""USAGE: {0} [options]
+Options:
+-m modes : comma-separated list of pipeline (shenidam-av: avconv and the shenidam executable) and matcher (libshenidam) (default both)
+
+-bl seconds[,seconds...] : base lengths (default 60)
+
+-br rate[,rate...] / -tr rate[,rate...] : base and track sample rates (default 48000 and 44100)
+
+-ch channels[,channels...] : channel counts of the bases and tracks (default 2)
+
+-tl seconds : track length (default 10)
+
+-n integer : number of tracks per base (default 3)
+
+-r integer : number of runs of each case, the fastest is kept (default 3)
+
+-sd integer : seed of the synthetic audio (default 1). The same seed and lengths give the same files
+
+-d directory : where the synthetic audio is kept between runs (default {1})
+
+-o filename : write the results as JSON to this file (default standard output)
+
+-c filename : compare with these (previous) results, and return non-zero if a case regressed
+
+-t ratio : relative growth above which a metric regressed (default 0.2)
+
+-se / -ae / -sl : the shenidam executable, the avconv executable and the shenidam library
+
+-sp quoted_param_string : extra parameters to pass to shenidam (also -s, -rq and -T for the matcher)
+""".format(sys.argv[0],Settings.data_dir),file=sys.stderr)
+
+def write_float_wav(filename,samples,sample_rate):
+    # samples is a frames x channels array.
+    channels = samples.shape[1]
+    info = shenidam.WavInfo(struct.pack(str("<HHIIHH"),3,channels,sample_rate,sample_rate*channels*4,channels*4,32),0,0)
+    with open(filename,"wb") as f:
+        shenidam.write_wav_header(f,info,samples.shape[0])
+        f.write(samples.astype("<f4").tobytes())
+def read_float_wav(filename):
+    with open(filename,"rb") as f:
+        info = shenidam.read_wav_header(f)
+        samples = numpy.fromfile(f,dtype="<f4",count=info.num_frames*info.channels)
+    return samples.reshape(-1,info.channels),info.sample_rate
+
+def case_name(mode,base_length,base_rate,track_rate,channels,settings):
+    return "{0}/base-{1:g}s-{2}Hz/track-{3:g}s-{4}Hz/{5}ch".format(mode,base_length,base_rate,settings.track_length,track_rate,channels)
+def generate_case(settings,base_length,base_rate,track_rate,channels):
+    # Returns the base, the tracks and their in points in base samples, generating the files unless they exist.
+    # The base is pink noise under a slow random envelope, the tracks are noisy excerpts of it resampled to the track rate.
+    directory = os.path.join(settings.data_dir,"seed-{0}".format(settings.seed),"base-{0:g}s-{1}Hz-{2}ch".format(base_length,base_rate,channels))
+    base_fn = os.path.join(directory,"base.wav")
+    tracks_dir = os.path.join(directory,"tracks-{0:g}s-{1}Hz".format(settings.track_length,track_rate))
+    track_fns = [os.path.join(tracks_dir,"track-{0}.wav".format(i)) for i in range(settings.num_tracks)]
+    in_points_fn = os.path.join(tracks_dir,"in_points.json")
+    if os.path.exists(in_points_fn):
+        with open(in_points_fn) as f:
+            in_points = json.load(f)
+        if len(in_points) >= settings.num_tracks:
+            return base_fn,track_fns,in_points[:settings.num_tracks]
+    if settings.track_length >= base_length:
+        raise ValueError("Tracks must be shorter than the base")
+    random = numpy.random.RandomState(settings.seed)
+    num_frames = int(base_length*base_rate)
+    knots = numpy.arange(0,num_frames+base_rate,base_rate//10)
+    envelope = numpy.interp(numpy.arange(num_frames),knots,random.uniform(0.1,1.0,len(knots)))
+    spectrum = numpy.fft.rfft(random.standard_normal(num_frames))
+    spectrum[1:] /= numpy.sqrt(numpy.arange(1,len(spectrum)))
+    base = numpy.fft.irfft(spectrum,num_frames)
+    base = (base*envelope*0.2/base.std()).astype("float32")
+    if not os.path.isdir(tracks_dir):
+        os.makedirs(tracks_dir)
+    if not os.path.exists(base_fn):
+        write_float_wav(base_fn,numpy.column_stack([base+random.standard_normal(num_frames).astype("float32")*0.01 for c in range(channels)]),base_rate)
+    track_random = numpy.random.RandomState([settings.seed,track_rate,int(settings.track_length*1000)])
+    track_frames = int(settings.track_length*track_rate)
+    in_points = []
+    for track_fn in track_fns:
+        in_point = int(track_random.randint(0,num_frames-int(settings.track_length*base_rate)))
+        positions = in_point+numpy.arange(track_frames)*base_rate/track_rate
+        track = numpy.interp(positions,numpy.arange(num_frames),base).astype("float32")
+        write_float_wav(track_fn,numpy.column_stack([track*0.8+track_random.standard_normal(track_frames).astype("float32")*0.05 for c in range(channels)]),track_rate)
+        in_points.append(in_point)
+    with open(in_points_fn,"w") as f:
+        json.dump(in_points,f)
+    return base_fn,track_fns,in_points
+
+def cpu_time():
+    times = os.times()
+    return times[0]+times[1]
+def peak_rss_bytes(who):
+    # ru_maxrss is in kilobytes, except on OS X.
+    return resource.getrusage(who).ru_maxrss*(1 if sys.platform == "darwin" else 1024)
+class DirectorySizeMonitor(threading.Thread):
+    # Keeps the largest total size of the files under a directory, sampled while running.
+    def __init__(self,directory,interval=0.02):
+        super(DirectorySizeMonitor,self).__init__()
+        self.daemon = True
+        self.directory = directory
+        self.interval = interval
+        self.peak = 0
+        self.finished = threading.Event()
+    def size(self):
+        res = 0
+        for dirpath,dirnames,filenames in os.walk(self.directory):
+            for x in filenames:
+                try:
+                    res += os.path.getsize(os.path.join(dirpath,x))
+                except OSError:
+                    pass
+        return res
+    def run(self):
+        while not self.finished.is_set():
+            self.peak = max(self.peak,self.size())
+            self.finished.wait(self.interval)
+    def stop(self):
+        self.finished.set()
+        self.join()
+        self.peak = max(self.peak,self.size())
+        return self.peak
+
+def run_pipeline(case):
+    work_dir = tempfile.mkdtemp(prefix="shenidam-benchmark-")
+    try:
+        tmp_dir = os.path.join(work_dir,"tmp")
+        output_dir = os.path.join(work_dir,"output")
+        os.mkdir(tmp_dir)
+        os.mkdir(output_dir)
+        model = shenidam.FileProcessorModel()
+        model.base_fn = case["base"]
+        model.input_tracks = list(case["tracks"])
+        model.output_params = [[os.path.join(output_dir,"{base}{ext}"),True,"-c:a copy"]]
+        model.audio_export_params = "-c:a pcm_f32le -f wav"
+        model.tmp_dir = tmp_dir
+        model.cache_dir = None
+        model.quiet = True
+        model.shenidam = case["shenidam"]
+        model.avconv = case["avconv"]
+        model.shenidam_extra_args = case["shenidam_params"]
+        # Only read as a flag by the processor, which then collects the stage-timing messages.
+        model.timing_report = os.path.join(work_dir,"timings.tsv")
+        with open(os.devnull,"w") as devnull:
+            processor = shenidam.ShenidamFileProcessor(model,shenidam.StreamNotifier(devnull))
+            monitor = DirectorySizeMonitor(tmp_dir)
+            monitor.start()
+            start = time.time()
+            try:
+                processor.convert()
+            finally:
+                wall_time = time.time()-start
+                peak_temp_bytes = monitor.stop()
+        stages = dict((x["stage"],dict((key,x[key]) for key in ("wall_time","cpu_time","peak_bytes"))) for x in processor.performance_report())
+        return {"wall_time":wall_time,"stages":stages,"peak_temp_bytes":peak_temp_bytes,
+            "in_points":[x["determined_in"] if x is not None else None for x in processor.mapping]}
+    finally:
+        shutil.rmtree(work_dir,ignore_errors=True)
+def run_matcher(case):
+    args = shenidam.parse_shenidam_args(case["shenidam_params"])
+    stages = {}
+    def add_stage(stage,timing):
+        total = stages.setdefault(stage,{"wall_time":0.0,"cpu_time":0.0,"peak_bytes":0})
+        total["wall_time"] += timing["wall_time"]
+        total["cpu_time"] += timing["cpu_time"]
+        total["peak_bytes"] = max(total["peak_bytes"],timing["peak_bytes"])
+    start = time.time()
+    in_points = []
+    with shenidam.ShenidamMatcher(args["sample_rate"],args["num_threads"],args["resampling_quality"],case["library"],args["planner_rigor"],None,args["block_size"]) as matcher:
+        matcher.set_timings(True)
+        def decode(filename):
+            wall,cpu = time.time(),cpu_time()
+            samples,sample_rate = read_float_wav(filename)
+            mono = numpy.ascontiguousarray(samples.mean(axis=1,dtype="float32"))
+            add_stage("decode",{"wall_time":time.time()-wall,"cpu_time":cpu_time()-cpu,"peak_bytes":samples.nbytes+mono.nbytes})
+            return mono,sample_rate
+        base,base_rate = decode(case["base"])
+        matcher.set_base_audio(base,base_rate)
+        for track_fn in case["tracks"]:
+            track,track_rate = decode(track_fn)
+            in_point,length = matcher.get_audio_range(track,track_rate)
+            for stage,timing in matcher.get_timings().items():
+                add_stage(stage,timing)
+            in_points.append(in_point)
+    return {"wall_time":time.time()-start,"stages":stages,"peak_temp_bytes":0,"in_points":in_points}
+def run_case(case):
+    res = (run_pipeline if case["mode"] == "pipeline" else run_matcher)(case)
+    res["peak_rss_bytes"] = peak_rss_bytes(resource.RUSAGE_SELF)
+    res["peak_child_rss_bytes"] = peak_rss_bytes(resource.RUSAGE_CHILDREN)
+    # Tracks left unmapped make the case fail, their error is not counted.
+    errors = [abs(x-y) for x,y in zip(res.pop("in_points"),case["in_points"]) if x is not None]
+    res["unmapped_tracks"] = len(case["in_points"])-len(errors)
+    res["max_error_samples"] = max(errors) if errors else None
+    return res
+
+def benchmark(settings):
+    cases = []
+    for base_length,base_rate,track_rate,channels in itertools.product(settings.base_lengths,settings.base_rates,settings.track_rates,settings.channels):
+        base_fn,track_fns,in_points = generate_case(settings,base_length,base_rate,track_rate,channels)
+        for mode in settings.modes:
+            case = {"mode":mode,"base":base_fn,"tracks":track_fns,"in_points":in_points,"shenidam":settings.shenidam,
+                "avconv":settings.avconv,"library":settings.library,"shenidam_params":settings.shenidam_params}
+            runs = []
+            # The result is written to a file, the pipeline prints its commands.
+            result_fd,result_fn = tempfile.mkstemp(prefix="shenidam-benchmark-",suffix=".json")
+            os.close(result_fd)
+            try:
+                for i in range(settings.repeats):
+                    subprocess.check_call([sys.executable,os.path.abspath(__file__),"--run-case",json.dumps(case),result_fn],stdout=sys.stderr)
+                    with open(result_fn) as f:
+                        runs.append(json.load(f))
+            finally:
+                os.remove(result_fn)
+            best = min(runs,key=lambda x:x["wall_time"])
+            best.update({"name":case_name(mode,base_length,base_rate,track_rate,channels,settings),"mode":mode,
+                "base_length":base_length,"base_rate":base_rate,"track_length":settings.track_length,"track_rate":track_rate,
+                "channels":channels,"num_tracks":settings.num_tracks,"wall_times":[x["wall_time"] for x in runs]})
+            print("{0}\t{1:.3f}s".format(best["name"],best["wall_time"]),file=sys.stderr)
+            if best["unmapped_tracks"]:
+                print("FAILED\t{0}\t{1} of {2} tracks not mapped".format(best["name"],best["unmapped_tracks"],len(in_points)),file=sys.stderr)
+            cases.append(best)
+    return {"version":1,"seed":settings.seed,"shenidam_params":settings.shenidam_params,"repeats":settings.repeats,
+        "platform":{"system":platform.system(),"machine":platform.machine(),"python":platform.python_version()},"cases":cases}
+
+def metrics(case):
+    res = dict((x,case[x]) for x in METRICS)
+    for stage,timing in case["stages"].items():
+        res["stages/{0}/wall_time".format(stage)] = timing["wall_time"]
+        res["stages/{0}/peak_bytes".format(stage)] = timing["peak_bytes"]
+    return res
+def compare(results,baseline,threshold,min_time_difference):
+    # Returns the (case, metric, baseline value, value) that grew by more than threshold. Times must also
+    # have grown by min_time_difference seconds, which keeps the noise of very short stages out.
+    baseline_cases = dict((x["name"],x) for x in baseline["cases"])
+    res = []
+    for case in results["cases"]:
+        if case["name"] not in baseline_cases:
+            continue
+        old = metrics(baseline_cases[case["name"]])
+        for metric,value in sorted(metrics(case).items()):
+            if metric not in old:
+                continue
+            difference = value-old[metric]
+            if metric.endswith("time") and difference < min_time_difference:
+                continue
+            if difference > threshold*old[metric]:
+                res.append((case["name"],metric,old[metric],value))
+    return res
+
+def main():
+    if len(sys.argv) == 4 and sys.argv[1] == "--run-case":
+        result = run_case(json.loads(sys.argv[2]))
+        with open(sys.argv[3],"w") as f:
+            json.dump(result,f)
+        return 0
+    settings = Settings()
+    if parse_params(settings,sys.argv):
+        usage()
+        return 1
+    results = benchmark(settings)
+    if settings.output:
+        with open(settings.output,"w") as f:
+            json.dump(results,f,indent=1,sort_keys=True)
+    else:
+        print(json.dumps(results,indent=1,sort_keys=True))
+    failed = any(x["unmapped_tracks"] for x in results["cases"])
+    if settings.baseline:
+        with open(settings.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results,baseline,settings.threshold,settings.min_time_difference)
+        for name,metric,old,new in regressions:
+            print("REGRESSION\t{0}\t{1}\t{2:g}\t{3:g}".format(name,metric,old,new),file=sys.stderr)
+        if regressions:
+            return 1
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())